@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic data for the benchmarks: a template covering the common field types and transformations, and source
+files of any size generated from a template's source field definitions.
+
+    python benchmarks/generators.py CSV 1000000 data.csv
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy
+import pandas
+
+# run as scripts, the benchmarks import the datamonkey of this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datamonkey.models import Configuration, File
+
+TEMPLATE_ID = "fc01da57-fake-fake-fake-3e634296ce3f"
+SOURCE_FORMATS = ["CSV", "FWF", "JSON", "LDJSON", "EXCEL"]
+OUTPUT_FORMATS = ["CSV", "FWF", "JSON", "EXCEL"]
+EXTENSIONS = {"CSV": "csv", "FWF": "txt", "JSON": "json", "LDJSON": "json", "EXCEL": "xlsx"}
+EXCEL_MAX_ROWS = 1048575  # rows below the header
+
+CHUNK_ROWS = 100000  # rows generated at a time, so large files are written with bounded memory
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliett", "kilo", "lima",
+         "mike", "november", "oscar", "papa", "quebec", "romeo", "sierra", "tango", "uniform", "victor", "whiskey",
+         "xray", "yankee", "zulu"]
+
+# name, type, width (FWF) and transformations of the synthetic template's fields
+FIELDS = [
+    ("id", "INT", 10, []),
+    ("amount", "FLOAT", 12, [
+        {"operation": "VALIDATE_BY_RANGE", "parameters": {"min": 0, "max": 100000, "stopOnInvalid": False}},
+        {"operation": "MODIFY_ROUND_NUMBER", "parameters": {"precision": 1}}]),
+    ("name", "STRING", 12, [
+        {"operation": "MODIFY_REMOVE_WHITESPACE", "parameters": {"operator": "BOTH"}},
+        {"operation": "MODIFY_CHANGE_CASE", "parameters": {"operator": "UPPER"}},
+        {"operation": "FILTER_BY_LIST", "parameters": {"operator": "EXCLUDE", "values": ["ZULU"]}}]),
+    ("code", "STRING", 8, [
+        {"operation": "VALIDATE_BY_REGEX", "parameters": {"value": "^[A-Z]{2}[0-9]{4}$", "stopOnInvalid": False}}]),
+    ("created", "DATE", 10, []),
+]
+
+
+def build_template(source_format="CSV", output_format="CSV", fields=FIELDS):
+    """ a synthetic template reading a source format and writing an output format """
+    source_fields, output_fields = [], []
+    start = 0
+    for i, (name, type, width, transformations) in enumerate(fields):
+        col_specs = [start, start + width - 1]
+        start += width
+        source_fields.append({"name": name, "fileIndex": 0, "used": True, "colSpecs": col_specs})
+        output_fields.append({"name": name,
+                              "type": type,
+                              "sourceFields": [i],
+                              "allowNull": type == "STRING",
+                              "replaceNullWith": "",
+                              "colSpecs": col_specs,
+                              "transformations": transformations})
+
+    source_file = {"type": "JSON" if source_format == "LDJSON" else source_format,
+                   "hasHeader": True,
+                   "lineDelimitedJSON": source_format == "LDJSON",
+                   "sheetName": "Sheet1"}
+
+    return {"version": "VERSION_1",
+            "sourceFiles": [source_file],
+            "outputFile": {"type": output_format, "hasHeader": True, "indent": 0,
+                           "name": "output.%s" % EXTENSIONS[output_format]},
+            "sourceFields": source_fields,
+            "outputFields": output_fields}
+
+
+def load_template(template, directory):
+    """ writes a template to a directory and loads its configuration """
+    key = hashlib.sha1(json.dumps(template, sort_keys=True).encode()).hexdigest()
+    template_path = os.path.join(directory, "template_%s.json" % key)
+    with open(template_path, "w") as file:
+        json.dump(template, file)
+    return Configuration(TEMPLATE_ID, template_path)
+
+
+def field_types(configuration):
+    """ the type of each source field, taken from the output field it's mapped to (STRING if it isn't mapped) """
+    types = ["STRING"] * len(configuration.source_fields)
+    for field in configuration.output_fields:
+        if len(field.source_fields) == 1:
+            types[field.source_fields[0]] = field.type
+    return types
+
+
+def generate_values(type, rows, random, start=0):
+    """ rows synthetic values of a field type; a few strings are padded or missing, as in real files """
+    if type == "INT":
+        return numpy.arange(start, start + rows)
+    if type == "FLOAT":
+        return numpy.round(random.uniform(0, 100000, rows), 2)
+    if type in ("DATE", "DATETIME"):
+        days = random.randint(0, 365 * 20, rows)
+        return (pandas.Timestamp("2000-01-01") + pandas.to_timedelta(days, unit="D")).strftime("%Y-%m-%d")
+    if type == "BOOLEAN":
+        return numpy.where(random.rand(rows) < 0.5, "true", "false")
+
+    values = numpy.array(WORDS, dtype=object)[random.randint(0, len(WORDS), rows)]
+    padded = random.rand(rows) < 0.1
+    values[padded] = [" %s " % value for value in values[padded]]
+    values[random.rand(rows) < 0.01] = ""
+    return values
+
+
+def generate_codes(rows, random):
+    letters = numpy.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"), dtype=object)
+    return letters[random.randint(0, 26, rows)] + letters[random.randint(0, 26, rows)] + \
+        pandas.Series(random.randint(0, 10000, rows)).map("{:04d}".format).values
+
+
+def generate_frames(configuration, rows, seed=0, chunk_rows=CHUNK_ROWS):
+    """ yields data frames of at most chunk_rows rows with the template's source fields, rows in total """
+    random = numpy.random.RandomState(seed)
+    types = field_types(configuration)
+    names = [field.name for field in configuration.source_fields]
+
+    for start in range(0, rows, chunk_rows):
+        size = min(chunk_rows, rows - start)
+        columns = {}
+        for name, type in zip(names, types):
+            columns[name] = generate_codes(size, random) if name == "code" else \
+                generate_values(type, size, random, start)
+        yield pandas.DataFrame(columns, columns=names, index=pandas.RangeIndex(start, start + size))
+
+
+def write_source(configuration, file_path, rows, seed=0):
+    """ Writes a source file of the template's format with rows synthetic rows. """
+    source_file = configuration.source_files[0]
+    frames = generate_frames(configuration, rows, seed)
+    temp_path = file_path + ".partial"  # an interrupted run never leaves a short file behind
+
+    if source_file.type == File.EXCEL:
+        if rows > EXCEL_MAX_ROWS:
+            raise ValueError("Excel files hold at most %d rows." % EXCEL_MAX_ROWS)
+
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(temp_path, {"constant_memory": True})
+        worksheet = workbook.add_worksheet(source_file.sheet_name or "Sheet1")
+        worksheet.write_row(0, 0, [field.name for field in configuration.source_fields])
+        for data in frames:
+            for offset, row in enumerate(data.itertuples(index=False)):
+                worksheet.write_row(data.index[0] + offset + 1, 0, row)
+        workbook.close()
+
+    else:
+        with open(temp_path, "w") as file:
+            for number, data in enumerate(frames):
+                if source_file.type == File.CSV:
+                    file.write(data.to_csv(header=number == 0, index=False))
+
+                elif source_file.type == File.FWF:
+                    widths = [field.col_specs[1] - field.col_specs[0] + 1 for field in configuration.source_fields]
+                    if number == 0:
+                        file.write("".join(name.ljust(width) for name, width in zip(data.columns, widths)) + "\n")
+                    lines = data[data.columns[0]].astype(str).str.ljust(widths[0])
+                    for column, width in zip(data.columns[1:], widths[1:]):
+                        lines = lines + data[column].astype(str).str.ljust(width)
+                    file.write("\n".join(lines) + "\n")
+
+                elif source_file.line_delimited_JSON:
+                    file.write(data.to_json(orient="records", lines=True) + "\n")
+
+                else:
+                    records = data.to_json(orient="records")[1:-1]
+                    file.write(("[" if number == 0 else ",\n") + records)
+
+            if source_file.type == File.JSON and not source_file.line_delimited_JSON:
+                file.write("[]" if rows == 0 else "]")
+
+    os.replace(temp_path, file_path)
+    return file_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("format", choices=SOURCE_FORMATS, help="format of the generated file")
+    parser.add_argument("rows", type=int, help="number of rows")
+    parser.add_argument("file_path", help="where the file is written")
+    parser.add_argument("--template", help="template JSON whose source fields are generated, default synthetic")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.template:
+        configuration = Configuration(TEMPLATE_ID, args.template)
+    else:
+        directory = os.path.dirname(os.path.abspath(args.file_path))
+        configuration = load_template(build_template(args.format), directory)
+
+    write_source(configuration, args.file_path, args.rows, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the throughput and peak memory of each reader, each writer, each transformation operation and full
+templates on synthetic data, and compares the results with a stored baseline to catch regressions:
+
+    python benchmarks/suite.py --sizes 10k,1m --save baseline.json
+    python benchmarks/suite.py --sizes 10k,1m --baseline baseline.json
+
+Cases are named read/<format>, write/<format>, operation/<operation> and end_to_end/<format>; --only selects cases
+by regular expression. Every case runs in a fresh process, so peak memory (RSS) isn't inflated by earlier cases.
+Generated source files are kept in --data-dir and reused by later runs. The exit status is 1 if a case regressed.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+
+from collections import OrderedDict
+
+import numpy
+import pandas
+
+# run as scripts, the benchmarks import the datamonkey of this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generators
+
+from datamonkey import FileProcessor, __version__
+from datamonkey.models import Transformation
+from datamonkey.transformations import FUNCTION_MAP, prepare_parameters
+from datamonkey.uniqueness import KeySet
+
+SIZES = OrderedDict([("10k", 10000), ("1m", 1000000), ("10m", 10000000)])
+CHUNK_ROWS = generators.CHUNK_ROWS
+
+# the values each operation is applied to, and its parameters
+DATE_RANGE = {"min": "2005-01-01", "max": "2015-12-31"}
+KEYWORDS = ["kw%03d" % i for i in range(999)] + ["liet"]  # one keyword is found in the generated values
+
+OPERATION_CASES = {
+    "MODIFY_DO_MATH": ("FLOAT", {"operator": "MULTIPLY", "value": 1.5}),
+    "MODIFY_CHANGE_DATE_FORMAT": ("DATE", {"operator": "MM/DD/YYYY"}),
+    "MODIFY_ROUND_NUMBER": ("FLOAT", {"precision": 1}),
+    "MODIFY_TRIM_STRING": ("STRING", {"operator": "LEFT", "value": 2}),
+    "MODIFY_REMOVE_WHITESPACE": ("STRING", {"operator": "BOTH"}),
+    "MODIFY_CHANGE_CASE": ("STRING", {"operator": "UPPER"}),
+    "MODIFY_REMOVE_SUBSTRING": ("STRING", {"value": "a"}),
+    "MODIFY_APPEND_STRING": ("STRING", {"operator": "RIGHT", "value": "_x"}),
+    "MODIFY_REPLACE_VALUE": ("STRING", {"old_value": "a", "new_value": "b"}),
+    "MODIFY_MASK_FIELD": ("STRING", {}),
+    "MODIFY_CAST_TYPE": ("INT", {"value": "STRING"}),
+    "VALIDATE_BY_RANGE": ("INT", {"min": 0, "max": 5000000, "stopOnInvalid": False}),
+    "VALIDATE_BY_VALUE": ("INT", {"operator": "LT", "value": 5000000, "stopOnInvalid": False}),
+    "VALIDATE_BY_DATE_RANGE": ("DATE", dict(DATE_RANGE, stopOnInvalid=False)),
+    "VALIDATE_BY_DATE_VALUE": ("DATE", {"operator": "GE", "value": "2005-01-01", "stopOnInvalid": False}),
+    "VALIDATE_BY_LIST": ("STRING", {"operator": "INCLUDE", "values": generators.WORDS[:13], "stopOnInvalid": False}),
+    "VALIDATE_BY_REGEX": ("STRING", {"value": "^[a-m]", "stopOnInvalid": False}),
+    "VALIDATE_BY_LENGTH": ("STRING", {"operator": "LE", "value": 5, "stopOnInvalid": False}),
+    "VALIDATE_BY_SUBSTRING": ("STRING", {"operator": "EXCLUDE", "value": "o", "stopOnInvalid": False}),
+    "FILTER_BY_RANGE": ("INT", {"min": 0, "max": 5000000}),
+    "FILTER_BY_VALUE": ("INT", {"operator": "LT", "value": 5000000}),
+    "FILTER_BY_DATE_RANGE": ("DATE", DATE_RANGE),
+    "FILTER_BY_DATE_VALUE": ("DATE", {"operator": "GE", "value": "2005-01-01"}),
+    "FILTER_BY_LIST": ("STRING", {"operator": "EXCLUDE", "values": generators.WORDS[:13]}),
+    "FILTER_BY_REGEX": ("STRING", {"value": "^[a-m]"}),
+    "FILTER_BY_SUBSTRING": ("STRING", {"operator": "INCLUDE", "value": "o"}),
+    "FILTER_BY_LENGTH": ("STRING", {"operator": "LE", "value": 5}),
+    "VALIDATE_UNIQUE": ("INT", {"stopOnInvalid": False}),
+    "FILTER_DUPLICATE": ("STRING", {}),
+    "MODIFY_LOOKUP": ("STRING", {"values": dict((word, word.upper()) for word in generators.WORDS[:13])}),
+    # variants of an operation are named OPERATION:variant, e.g. with sets of patterns
+    "FILTER_BY_SUBSTRING:1000": ("STRING", {"operator": "EXCLUDE", "values": KEYWORDS}),
+    "VALIDATE_BY_SUBSTRING:1000": ("STRING", {"operator": "EXCLUDE", "values": KEYWORDS, "stopOnInvalid": False}),
+    "FILTER_BY_REGEX:100": ("STRING", {"values": ["^%s[0-9]" % keyword for keyword in KEYWORDS[:99]] + ["^[a-m]"]}),
+}
+
+
+def source_path(data_dir, source_format, rows):
+    return os.path.join(data_dir, "%s_%d.%s" % (source_format.lower(), rows, generators.EXTENSIONS[source_format]))
+
+
+def prepare_source(data_dir, source_format, rows):
+    """ generates a source file unless an earlier run already did """
+    path = source_path(data_dir, source_format, rows)
+    if not os.path.isfile(path):
+        print("Generating %s..." % os.path.basename(path))
+        configuration = generators.load_template(generators.build_template(source_format), data_dir)
+        generators.write_source(configuration, path, rows)
+    return path
+
+
+def skip_reason(case, rows):
+    kind, name = case.split("/", 1)
+    if name == "EXCEL" and rows > generators.EXCEL_MAX_ROWS:
+        return "Excel files hold at most %d rows" % generators.EXCEL_MAX_ROWS
+    if kind == "operation" and name not in OPERATION_CASES:
+        return "no benchmark parameters for this operation, add them to OPERATION_CASES"
+    return None
+
+
+# *** Cases ***
+# each case returns the seconds spent on the measured work and the bytes it read or wrote (None if not applicable)
+
+def bench_read(source_format, rows, data_dir, work_dir):
+    path = source_path(data_dir, source_format, rows)
+    configuration = generators.load_template(generators.build_template(source_format), work_dir)
+    source_file = configuration.source_files[0]
+    source_file.file_path = path
+
+    start = time.perf_counter()
+    processor = FileProcessor.from_configuration(configuration)
+    data, _ = source_file.process_file(configuration.source_fields, chunk_data=processor.chunk_source)
+    if processor.chunk_source:
+        for chunk in data:
+            pass
+    seconds = time.perf_counter() - start
+
+    return seconds, os.path.getsize(path)
+
+
+def bench_write(output_format, rows, data_dir, work_dir):
+    configuration = generators.load_template(generators.build_template("CSV", output_format), work_dir)
+    output_file = configuration.output_file
+    output_file.file_path = os.path.join(work_dir, output_file.name)
+
+    # one chunk of typed data, written repeatedly under a shifted index
+    data = next(generators.generate_frames(configuration, min(rows, CHUNK_ROWS)))
+    data["created"] = pandas.to_datetime(data["created"])
+
+    start = time.perf_counter()
+    for offset in range(0, rows, CHUNK_ROWS):
+        chunk = data.iloc[:min(CHUNK_ROWS, rows - offset)].copy()
+        chunk.index = chunk.index + offset
+        output_file.append_data(chunk)
+        output_file.flush_output()
+    output_file.generate_output()
+    seconds = time.perf_counter() - start
+
+    return seconds, os.path.getsize(output_file.file_path)
+
+
+def bench_operation(case, rows, data_dir, work_dir):
+    type, parameters = OPERATION_CASES[case]
+    operation = case.split(":")[0]
+    function = FUNCTION_MAP[operation]
+    parameters = prepare_parameters(operation, parameters, type)
+
+    # one chunk of values, transformed repeatedly; values are cast the way the processor casts them
+    values = pandas.Series(generators.generate_values(type, min(rows, CHUNK_ROWS), numpy.random.RandomState(0)))
+    if type == "DATE":
+        values = pandas.to_datetime(values)
+    elif type == "STRING":
+        values = values[values != ""]
+        values = pandas.Series(numpy.resize(values.values, min(rows, CHUNK_ROWS)))
+
+    start = time.perf_counter()
+    if operation in Transformation.column_operations:
+        # column operations take whole chunks, keeping their keys across them; repeated chunks are all duplicates
+        keys = KeySet()
+        for offset in range(0, rows, CHUNK_ROWS):
+            chunk = values.iloc[:min(CHUNK_ROWS, rows - offset)]
+            function(chunk, parameters, keys, chunk.to_frame())
+        keys.close()
+    else:
+        for offset in range(0, rows, CHUNK_ROWS):
+            values.iloc[:min(CHUNK_ROWS, rows - offset)].apply(function, args=(parameters,))
+    seconds = time.perf_counter() - start
+
+    return seconds, None
+
+
+def bench_end_to_end(source_format, rows, data_dir, work_dir):
+    path = source_path(data_dir, source_format, rows)
+    template_path = os.path.join(work_dir, "end_to_end.json")
+    with open(template_path, "w") as file:
+        json.dump(generators.build_template(source_format, "CSV"), file)
+
+    processor = FileProcessor(generators.TEMPLATE_ID, template_file_path=template_path)
+    start = time.perf_counter()
+    processor.process(path, output_file_path=work_dir, error_file_path=work_dir)
+    seconds = time.perf_counter() - start
+
+    return seconds, os.path.getsize(path)
+
+
+CASES = OrderedDict()
+for source_format in generators.SOURCE_FORMATS:
+    CASES["read/%s" % source_format] = (bench_read, source_format)
+for output_format in generators.OUTPUT_FORMATS:
+    CASES["write/%s" % output_format] = (bench_write, output_format)
+for operation in sorted(set(FUNCTION_MAP) | set(OPERATION_CASES)):
+    CASES["operation/%s" % operation] = (bench_operation, operation)
+for source_format in generators.SOURCE_FORMATS:
+    CASES["end_to_end/%s" % source_format] = (bench_end_to_end, source_format)
+
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None  # not available on Windows
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux, bytes on macOS
+
+
+def run_case(case, rows, data_dir, repeat):
+    """ runs in a fresh process: the best of repeat runs, and the peak memory of the process """
+    function, argument = CASES[case]
+    work_dir = tempfile.mkdtemp()
+    try:
+        runs = [function(argument, rows, data_dir, work_dir) for _ in range(repeat)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    seconds, size = min(runs, key=lambda run: run[0])
+    return {"rows": rows,
+            "seconds": seconds,
+            "rowsPerSecond": rows / seconds if seconds else None,
+            "megabytesPerSecond": size / seconds / 1024 ** 2 if size and seconds else None,
+            "peakMemory": peak_memory()}
+
+
+def compare(results, baseline, tolerance):
+    """ lists the cases that got slower, or use more memory, than the baseline allows """
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if not previous or not result.get("rowsPerSecond") or not previous.get("rowsPerSecond"):
+            continue
+
+        change = result["rowsPerSecond"] / previous["rowsPerSecond"] - 1
+        result["throughputChange"] = change
+        if change < -tolerance:
+            regressions.append("%s: throughput %.1f%% lower" % (key, -change * 100))
+
+        if result.get("peakMemory") and previous.get("peakMemory"):
+            memory_change = result["peakMemory"] / previous["peakMemory"] - 1
+            result["memoryChange"] = memory_change
+            if memory_change > tolerance:
+                regressions.append("%s: peak memory %.1f%% higher" % (key, memory_change * 100))
+
+    return regressions
+
+
+def print_results(results):
+    print("\n%-38s %10s %10s %14s %10s %10s %9s" %
+          ("Case", "Rows", "Seconds", "Rows/s", "MB/s", "Peak MB", "vs Base"))
+    for key, result in results.items():
+        if "skipped" in result:
+            print("%-38s %10d   skipped: %s" % (result["case"], result["rows"], result["skipped"]))
+            continue
+
+        print("%-38s %10d %10.3f %14.0f %10s %10.1f %9s" %
+              (result["case"], result["rows"], result["seconds"], result["rowsPerSecond"] or 0,
+               "%.1f" % result["megabytesPerSecond"] if result["megabytesPerSecond"] else "-",
+               (result["peakMemory"] or 0) / 1024 ** 2,
+               "%+.1f%%" % (result["throughputChange"] * 100) if "throughputChange" in result else "-"))
+
+
+def parse_sizes(sizes):
+    return [SIZES[size.lower()] if size.lower() in SIZES else int(size) for size in sizes.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10k,1m,10m", help="comma separated row counts, e.g. 10k,1m,10m or 50000")
+    parser.add_argument("--only", default="", help="regular expression selecting the cases to run")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest is reported")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "datamonkey_benchmarks"),
+                        help="where generated source files are kept between runs")
+    parser.add_argument("--save", help="writes the results to a JSON file, e.g. a new baseline")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative throughput loss or memory growth reported as a regression")
+    parser.add_argument("--list", action="store_true", help="lists the cases and exits")
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if re.search(args.only, case)]
+    if args.list:
+        print("\n".join(cases))
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+
+    results = OrderedDict()
+    for rows in parse_sizes(args.sizes):
+        for case in cases:
+            key = "%s@%d" % (case, rows)
+            reason = skip_reason(case, rows)
+            if reason:
+                results[key] = {"case": case, "rows": rows, "skipped": reason}
+                continue
+
+            kind, name = case.split("/", 1)
+            if kind in ("read", "end_to_end"):
+                prepare_source(args.data_dir, name, rows)
+
+            print("Running %s with %d rows..." % (case, rows))
+            pool = context.Pool(1)
+            try:
+                results[key] = dict(pool.apply(run_case, (case, rows, args.data_dir, args.repeat)), case=case)
+            finally:
+                pool.close()
+                pool.join()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)["results"], args.tolerance)
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"library": __version__,
+                       "python": platform.python_version(),
+                       "pandas": pandas.__version__,
+                       "numpy": numpy.__version__,
+                       "machine": platform.platform(),
+                       "createdAt": time.time(),
+                       "results": results}, file, indent=2)
+
+    if regressions:
+        print("\n%d regression(s) compared with %s:" % (len(regressions), args.baseline))
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks FileProcessor construction time for each way of loading a template:
+a template JSON file (parsed and validated on every run) and a compiled template artifact.
+
+    python benchmarks/template_startup.py --fields 200 --repeat 50
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+# run as scripts, the benchmarks import the datamonkey of this repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datamonkey import FileProcessor
+
+TEMPLATE_ID = "fc01da57-fake-fake-fake-3e634296ce3f"
+
+
+def build_template(number_fields):
+    """ a synthetic FWF -> FWF template with a few transformations per field """
+    source_fields, output_fields = [], []
+    for i in range(number_fields):
+        source_fields.append({"name": "field_%d" % i, "fileIndex": 0, "used": True, "colSpecs": [i * 10, i * 10 + 9]})
+        output_fields.append({"name": "field_%d" % i,
+                              "type": "STRING",
+                              "sourceFields": [i],
+                              "allowNull": True,
+                              "replaceNullWith": "",
+                              "colSpecs": [i * 10, i * 10 + 9],
+                              "transformations": [
+                                  {"operation": "MODIFY_REMOVE_WHITESPACE", "parameters": {"operator": "BOTH"}},
+                                  {"operation": "MODIFY_CHANGE_CASE", "parameters": {"operator": "UPPER"}},
+                                  {"operation": "VALIDATE_BY_LENGTH",
+                                   "parameters": {"operator": "LE", "value": 10, "stopOnInvalid": False}}]})
+
+    return {"version": "VERSION_1",
+            "sourceFiles": [{"type": "FWF", "hasHeader": True}],
+            "outputFile": {"type": "FWF", "hasHeader": True, "name": "output.txt"},
+            "sourceFields": source_fields,
+            "outputFields": output_fields}
+
+
+def time_constructor(template_file_path, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        FileProcessor(TEMPLATE_ID, template_file_path=template_file_path)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fields", type=int, default=200, help="number of fields in the synthetic template")
+    parser.add_argument("--repeat", type=int, default=50, help="number of constructions timed per path")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    template_path = os.path.join(directory, "template.json")
+    artifact_path = os.path.join(directory, "template.dmkt")
+
+    with open(template_path, "w") as file:
+        json.dump(build_template(args.fields), file)
+
+    FileProcessor(TEMPLATE_ID, template_file_path=template_path).configuration.save_artifact(artifact_path)
+
+    results = [("template JSON", time_constructor(template_path, args.repeat)),
+               ("compiled artifact", time_constructor(artifact_path, args.repeat))]
+
+    print("FileProcessor construction, %d fields (mean of %d runs)" % (args.fields, args.repeat))
+    for name, seconds in results:
+        print("  %-20s %8.2f ms" % (name, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
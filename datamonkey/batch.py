@@ -0,0 +1,374 @@
+import os
+import copy
+import time
+import pickle
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from datamonkey.helpers import get_file_size, check_S3_path, validate_file_exists, parse_file_path, LazyModule
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+
+class FileResult:
+    """ Outcome of processing one input of a batch. """
+
+    def __init__(self, index, source_file_paths, output_file_path, error_file_path):
+        self.index = index  # position of the input in the batch
+        self.source_file_paths = source_file_paths
+        self.output_file_path = output_file_path
+        self.error_file_path = error_file_path
+
+        self.succeeded = False
+        self.exception = None  # description of the exception that stopped processing, if any
+        self.input_items = 0
+        self.output_items = 0
+        self.total_errors = 0
+        self.total_warnings = 0
+        self.seconds = 0.0
+        self.data = None  # PYTHON outputs only
+        self.metrics = None  # MetricsCollector of the input, if the processor collects metrics
+
+
+class BatchResult:
+    """
+    Aggregated outcome of FileProcessor.process_many() or process_small_files(); results are listed in the order of
+    the inputs.
+    """
+
+    def __init__(self, results, seconds, data=None):
+        self.results = results
+        self.seconds = seconds
+        self.data = data  # merged PYTHON outputs only
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.succeeded]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.succeeded]
+
+    @property
+    def input_items(self):
+        return sum(result.input_items for result in self.results)
+
+    @property
+    def output_items(self):
+        return sum(result.output_items for result in self.results)
+
+    @property
+    def total_errors(self):
+        return sum(result.total_errors for result in self.results)
+
+    @property
+    def total_warnings(self):
+        return sum(result.total_warnings for result in self.results)
+
+
+def run_batch(processor, inputs, output_dir="", error_dir="", max_workers=None, use_processes=True):
+    """ Processes the inputs concurrently with copies of the processor's compiled configuration. """
+    start = time.time()
+    tasks = _plan_tasks(processor, inputs, output_dir, error_dir)
+    if not tasks:
+        return BatchResult([], 0.0)
+
+    # the compiled configuration is shared with every worker; each run gets its own copy since runs modify its state
+    payload = pickle.dumps(processor.configuration.compile(), protocol=pickle.HIGHEST_PROTOCOL)
+
+    # largest inputs first, so workers that finish early pick up the small ones (longest processing time first)
+    tasks.sort(key=lambda task: task[-1], reverse=True)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+
+    collector = processor.metrics_collector
+    with executor_class(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = [executor.submit(_process_task, payload, processor.max_errors, *task[:-1],
+                                   collect_metrics=collector is not None,
+                                   max_anomalies=collector.max_warnings if collector is not None and
+                                   collector.error_log is not None else None) for task in tasks]
+        results = [future.result() for future in futures]
+
+    results.sort(key=lambda result: result.index)
+
+    if processor.metrics_collector is not None:
+        # the sketches of the inputs that were processed completely merge into metrics of the whole batch
+        processor.metrics_collector.reset()
+        for result in results:
+            if result.succeeded:
+                processor.metrics_collector.merge(result.metrics)
+        processor.metrics_collector.populate(processor.output_fields)
+
+    return BatchResult(results, time.time() - start)
+
+
+def _plan_tasks(processor, inputs, output_dir, error_dir):
+    """ Resolves the source, output and errors paths and the size of each input. """
+    from datamonkey.core import FileProcessor
+
+    output_name = processor.output_file.name
+    output_ext = os.path.splitext(output_name)[1] if output_name else None
+    error_ext = os.path.splitext(FileProcessor.ERROR_FILE_DEFAULT_NAME)[1]
+
+    tasks, names = [], set()
+    for index, item in enumerate(inputs):
+        if isinstance(item, dict):
+            source_file_paths = item["source"]
+            output_file_path = item.get("output")
+            error_file_path = item.get("errors")
+        else:
+            source_file_paths, output_file_path, error_file_path = item, None, None
+
+        if isinstance(source_file_paths, str):
+            source_file_paths = [source_file_paths]
+
+        # files are named after their first source file, made unique in case several sources share a name
+        name = os.path.splitext(os.path.basename(source_file_paths[0]))[0]
+        if name in names:
+            name = "%s_%d" % (name, index)
+        names.add(name)
+
+        if output_file_path is None and output_ext is not None:
+            output_file_path = os.path.join(output_dir, name + output_ext)
+
+        if error_file_path is None:
+            error_file_path = os.path.join(error_dir, "%s_errors_and_warnings%s" % (name, error_ext))
+
+        size = 0
+        for path in source_file_paths:
+            path = os.path.expanduser(path)
+            if check_S3_path(path) or os.path.isfile(path):
+                size += get_file_size(path, check_S3_path(path))
+
+        tasks.append((index, source_file_paths, output_file_path, error_file_path, size))
+
+    return tasks
+
+
+def _process_task(payload, max_errors, index, source_file_paths, output_file_path, error_file_path,
+                  collect_metrics=False, max_anomalies=None):
+    """
+    Runs in a worker: processes one input with its own copy of the configuration. Anomalies are reported when
+    max_anomalies is set.
+    """
+    from datamonkey.core import FileProcessor
+
+    result = FileResult(index, source_file_paths, output_file_path, error_file_path)
+    start = time.time()
+    processor = FileProcessor.from_configuration(pickle.loads(payload), max_errors)
+    if collect_metrics:
+        result.metrics = processor.enable_metrics()
+    if max_anomalies is not None:
+        result.metrics = processor.enable_anomaly_detection(max_anomalies)
+
+    try:
+        result.data = processor.process(source_file_paths, output_file_path=output_file_path or "",
+                                        error_file_path=error_file_path)
+        result.succeeded = True
+
+    except Exception as err:
+        result.exception = "%s: %s" % (err.__class__.__name__, err)
+
+    finally:
+        result.input_items = processor.input_items
+        result.output_items = processor.output_items
+        result.total_errors = processor.error_log.total_errors
+        result.total_warnings = processor.error_log.total_warnings
+        result.seconds = time.time() - start
+        if result.metrics is not None:
+            result.metrics.error_log = None  # the warnings are in the input's errors file
+
+    return result
+
+
+def run_coalesced(processor, inputs, output_dir="", error_dir="", merge=False, output_file_path="", error_file_path="",
+                  batch_rows=1000000):
+    """
+    Reads small inputs of a single source file template into shared batches of about batch_rows rows and processes
+    each batch in one pass. Rows are numbered consecutively across the inputs, so the first row of each input (its
+    offset) identifies which input every output row, error and warning came from.
+    """
+    from datamonkey.core import FileProcessor
+
+    start = time.time()
+    if len(processor.source_files) != 1:
+        raise ValueError("Small files can only be coalesced for configurations with a single source file.")
+
+    tasks = _plan_tasks(processor, inputs, output_dir, error_dir)
+    results = [FileResult(*task[:-1]) for task in tasks]
+    if not results:
+        return BatchResult([], 0.0)
+
+    payload = pickle.dumps(processor.configuration.compile(), protocol=pickle.HIGHEST_PROTOCOL)
+
+    worker = FileProcessor.from_configuration(pickle.loads(payload), processor.max_errors)
+    if merge:
+        # merged errors and warnings are limited as a whole
+        data = _run_merged(worker, results, output_file_path, error_file_path, batch_rows)
+        return BatchResult(results, time.time() - start, data)
+
+    # split errors and warnings are limited per input, so a batch's are all kept until they've been partitioned
+    worker.error_log.max_errors = None
+    try:
+        for batch, source_data, offsets in _read_batches(worker, results, batch_rows):
+            batch_start = time.time()
+            worker.error_log.reset()
+
+            # duplicates are only looked for within each input, as if it was processed on its own
+            worker._release_key_sets()
+            worker.key_offsets = offsets
+
+            try:
+                output_data = worker._transform_chunk(source_data)
+
+            except ValueError:
+                if worker.stage != worker.ERROR:
+                    raise
+
+                # a fatal error in one input mustn't fail the others: the inputs of this batch are processed one by one
+                worker.stage = worker.RETRIEVE_DATA
+                for result in batch:
+                    results[results.index(result)] = _process_task(payload, processor.max_errors, result.index,
+                                                                   result.source_file_paths, result.output_file_path,
+                                                                   result.error_file_path)
+                continue
+
+            owners = _owners(offsets, output_data.index)
+            logs = worker.error_log.partition(offsets, processor.max_errors)
+
+            for i, result in enumerate(batch):
+                output = copy.copy(worker.output_file)
+                output.reset_data()
+                output._first_write = True
+
+                if output.name is not None:
+                    output.file_path = parse_file_path(result.output_file_path or "", output.name)
+                    output.remove_existing_file()
+
+                # rows are renumbered from the start of their own input
+                data = output_data[owners == i]
+                data.index = data.index - offsets[i]
+                output.append_data(data)
+                output.flush_output()
+                output.generate_output()
+
+                logs[i].open(parse_file_path(result.error_file_path, FileProcessor.ERROR_FILE_DEFAULT_NAME))
+                logs[i].close()
+
+                result.succeeded = True
+                result.output_items = len(data)
+                result.total_errors = logs[i].total_errors
+                result.total_warnings = logs[i].total_warnings
+                result.data = output.data if output.type == output.PYTHON else None
+
+            _share_seconds(batch, time.time() - batch_start)
+
+    finally:
+        worker._release_key_sets()  # removes the keys spilled to disk
+
+    return BatchResult(results, time.time() - start)
+
+
+def _run_merged(worker, results, output_file_path, error_file_path, batch_rows):
+    """ Streams every batch to a single output and errors file; locations in the errors name the input they're from. """
+    from datamonkey.core import FileProcessor
+
+    if worker.output_file.name is not None:
+        worker.output_file.file_path = parse_file_path(output_file_path, worker.output_file.name)
+        worker.output_file.remove_existing_file()
+
+    worker.error_file_path = parse_file_path(error_file_path, FileProcessor.ERROR_FILE_DEFAULT_NAME)
+    worker.error_log.open(worker.error_file_path)
+    worker.error_log.origin_offsets, worker.error_log.origin_names = [], []
+
+    try:
+        for batch, source_data, offsets in _read_batches(worker, results, batch_rows):
+            batch_start = time.time()
+            worker.error_log.origin_offsets.extend(offsets)
+            worker.error_log.origin_names.extend(os.path.basename(result.source_file_paths[0]) for result in batch)
+
+            output_data = worker._transform_chunk(source_data)
+            worker._flush_data(output_data)
+            worker._write_errors_and_warnings()
+
+            owners = _owners(offsets, output_data.index)
+            counts = numpy.bincount(owners, minlength=len(batch))
+            for i, result in enumerate(batch):
+                result.succeeded = True
+                result.output_file_path = worker.output_file.file_path
+                result.error_file_path = worker.error_file_path
+                result.output_items = int(counts[i])
+
+            _share_seconds(batch, time.time() - batch_start)
+
+    finally:
+        worker._close_errors_and_warnings()
+        worker._release_key_sets()  # removes the keys spilled to disk
+
+    worker.output_file.generate_output()
+
+    # per input totals, of the errors and warnings that were kept in detail
+    offsets = worker.error_log.origin_offsets
+    read = [result for result in results if result.succeeded]
+    for result, log in zip(read, worker.error_log.partition(offsets) if offsets else []):
+        result.total_errors = log.total_errors
+        result.total_warnings = log.total_warnings
+
+    if worker.output_file.type == worker.output_file.PYTHON:
+        return worker.output_file.data
+
+
+def _read_batches(worker, results, batch_rows):
+    """ Yields the results, combined source data and row offsets of each batch of inputs. """
+    source_file = worker.source_files[0]
+    batch, frames, offsets, rows = [], [], [], 0
+
+    for result in results:
+        try:
+            if len(result.source_file_paths) != 1:
+                raise ValueError("You supplied %d file paths, but 1 source file was defined in the configuration."
+                                 % len(result.source_file_paths))
+
+            source_file.file_path = os.path.expanduser(result.source_file_paths[0])
+            validate_file_exists(source_file.file_path, source_file.s3_path)
+            data, _ = source_file.process_file(worker.source_fields, used_fields=worker.projected_fields)
+
+        except Exception as err:
+            result.exception = "%s: %s" % (err.__class__.__name__, err)
+            continue
+
+        # rows keep counting from the previous input, so every row of the batch has a unique index
+        data.index = pandas.RangeIndex(rows, rows + len(data))
+        result.input_items = len(data)
+
+        batch.append(result)
+        frames.append(data)
+        offsets.append(rows)
+        rows += len(data)
+
+        if rows - offsets[0] >= batch_rows:
+            yield batch, pandas.concat(frames), offsets
+            batch, frames, offsets = [], [], []
+
+    if batch:
+        yield batch, pandas.concat(frames), offsets
+
+
+def _owners(offsets, index):
+    """ the position (within the batch) of the input each row index came from """
+    return numpy.searchsorted(offsets, numpy.asarray(index), side="right") - 1
+
+
+def _share_seconds(batch, seconds):
+    """ splits the time spent on a batch between its inputs by their number of rows """
+    rows = sum(result.input_items for result in batch)
+    for result in batch:
+        result.seconds = seconds * result.input_items / rows if rows else seconds / len(batch)
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import ujson as json
+
+from datamonkey.helpers import check_S3_path, get_file_identity
+from datamonkey.sources import RecordReader
+
+
+class Checkpoint:
+    """
+    Records how far a run got each time a chunk was written to the output, so an interrupted run can continue after
+    the last written chunk instead of starting over. Single CSV, FWF and line delimited JSON sources also record the
+    byte offset the chunk ended at, which resuming seeks to instead of parsing the rows before it. A checkpoint only matches the template version and the exact
+    source files (path, size and modification time, or ETag on S3) it was written for.
+    """
+
+    def __init__(self, file_path, source_file_paths=None):
+        if check_S3_path(file_path):
+            raise ValueError("Checkpoint files can only be stored locally.")
+
+        if isinstance(source_file_paths, str):
+            source_file_paths = [source_file_paths]
+
+        self.file_path = os.path.expanduser(file_path)
+        self.sources = [get_file_identity(os.path.expanduser(path), check_S3_path(path))
+                        for path in source_file_paths or []]
+
+    def save(self, processor):
+        """ Records the state after the last chunk was written; written atomically so a crash never leaves half a file. """
+        from datamonkey import __version__
+
+        output_path = processor.output_file.file_path
+        state = {"id": processor.configuration.id,
+                 "version": processor.configuration.version,
+                 "library": __version__,
+                 "sources": self.sources,
+                 "output": output_path,
+                 "rows": processor.input_items,
+                 "offset": processor.source_data.offset if isinstance(processor.source_data, RecordReader) else None,
+                 "outputRows": processor.output_items,
+                 "outputLength": os.path.getsize(output_path) if os.path.isfile(output_path) else 0,
+                 "errorLog": processor.error_log.checkpoint()}
+
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.file_path)
+
+    def load(self, processor):
+        """ Returns the recorded state, or None if there's nothing to resume. """
+        from datamonkey import __version__
+
+        if not os.path.isfile(self.file_path):
+            return None
+
+        with open(self.file_path) as file:
+            state = json.load(file)
+
+        if state["id"] != processor.configuration.id or state["version"] != processor.configuration.version or \
+                state["library"] != __version__:
+            raise ValueError("The checkpoint %s was written for another version of the template or of DataMonkey; "
+                             "please remove it and process the file again." % self.file_path)
+
+        if state["sources"] != self.sources or state["output"] != processor.output_file.file_path:
+            raise ValueError("The checkpoint %s was written for other (or modified) files; please remove it and "
+                             "process the file again." % self.file_path)
+
+        return state
+
+    def remove(self):
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
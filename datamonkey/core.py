@@ -1,11 +1,22 @@
 # <editor-fold desc="Imports">
-import numpy
-import pandas
+import os
+import re
+import time
 
-from datamonkey.transformations import *
 from datamonkey.helpers import *
 from datamonkey.models import *
-from datamonkey.settings import PANDAS_TYPE_MAP, PYTHON_TYPE_MAP, DMK_TYPE_MAP
+from datamonkey.logs import ErrorLog, ValidationSummary
+from datamonkey.checkpoints import Checkpoint
+from datamonkey.sources import ColumnarReader, RecordReader
+from datamonkey.instrumentation import Instrumentation, TransformationProfiler
+from datamonkey.sketches import MetricsCollector
+from datamonkey.sampling import Sample
+from datamonkey.uniqueness import KeySet
+from datamonkey.settings import PANDAS_TYPE_MAP, PYTHON_TYPE_MAP, MEMOIZE_MIN_ROWS, MEMOIZE_SAMPLE_ROWS, \
+    MEMOIZE_MAX_DISTINCT
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
 
 # </editor-fold>
 
@@ -26,6 +37,9 @@ class FileProcessor:
          "Finalizing output file.",
          "Writing errors and warnings to log file.",
          "Exiting prematurely due to errors encountered.")
+    STAGE_NAMES = {INITIALIZING: "INITIALIZING", RETRIEVE_DATA: "RETRIEVE_DATA", VALIDATE: "VALIDATE", MAP: "MAP",
+                   TRANSFORM: "TRANSFORM", WRITING_DATA: "WRITING_DATA", OUTPUT_DATA: "OUTPUT_DATA",
+                   WRITE_ERRORS: "WRITE_ERRORS", ERROR: "ERROR"}
 
     # de-normalize fields from configuration for convenience / brevity
     @property
@@ -44,36 +58,262 @@ class FileProcessor:
     def output_fields(self):
         return self.configuration.output_fields
 
-    def __init__(self, template_id, template_file_path="", max_errors=None):
-        self.configuration = Configuration(template_id, template_file_path)
+    # stage changes are timed when listeners are attached
+    @property
+    def stage(self):
+        return self._stage
+
+    @stage.setter
+    def stage(self, stage):
+        self._stage = stage
+        if self.instrumentation is not None:
+            self.instrumentation.enter_stage(FileProcessor.STAGE_NAMES[stage])
+
+    # formatted errors and warnings are generated from the error log on request
+    @property
+    def errors(self):
+        return self.error_log.errors
+
+    @property
+    def warnings(self):
+        return self.error_log.warnings
+
+    def __init__(self, template_id, template_file_path="", max_errors=None, template_cache=None, result_cache=None,
+                 source_cache=None):
+        if os.path.splitext(template_file_path)[1] == Configuration.ARTIFACT_EXTENSION:
+            # compiled templates are loaded as-is, without re-validation
+            self.configuration = Configuration.load_artifact(template_file_path, template_id)
+        else:
+            self.configuration = Configuration(template_id, template_file_path, template_cache)
+
+        self._initialize(max_errors)
+        self.result_cache = result_cache  # reuses the results of earlier runs on the same inputs, see ResultCache
+        self.source_cache = source_cache  # reuses parsed source files, see SourceCache
 
+    @classmethod
+    def from_configuration(cls, configuration, max_errors=None):
+        """ creates a processor for a configuration that was already loaded (or compiled) """
+        processor = cls.__new__(cls)
+        processor.configuration = configuration
+        processor._initialize(max_errors)
+        return processor
+
+    def _initialize(self, max_errors):
         self.output_file_path = ""
         self.error_file_path = ""
-        self.errors = []
-        self.warnings = []
         self.max_errors = max_errors
 
+        self.instrumentation = None  # created when the first listener is added
+        self.profiler = None  # times each transformation when profiling is enabled
+        self.metrics_collector = None  # sketches of the output fields when metrics are enabled
         self.stage = self.INITIALIZING
         self.processing_index_start = 0
         self.processing_index_end = 0
+        self.input_items = 0
         self.output_items = 0
+        self.fail_fast = False  # stop at the first fatal error or once max_errors is reached, used when validating
+        self.stopped_early = False
 
+        self.result_cache = None
+        self.source_cache = None
+        self.shared_casts = None  # casts shared with the other templates of a fan-out
         self.source_data = None
+        self.start_row = 0  # data rows the source reader skipped, when resuming from a checkpoint
+        self.sample = None  # the Sample of the source rows processed by the current run, if any
+        self.key_sets = {}  # (output field index, position, input) -> KeySet of a column operation, for the current run
+        self.key_offsets = None  # first rows of coalesced inputs, whose keys are kept apart
         self.chunk_source = self._can_chunk_source()  # splitting source data into chunks will reduce memory footprint
 
+        # only source fields referenced by the output mapping are read from the source files
+        self.projected_fields = self._project_source_fields()
+        projected = set(id(field) for field in self.projected_fields)
+        self.skipped_fields = [field.name for field in self.source_fields if id(field) not in projected]
+
+        location_terms = [self._decode_input_field_type(field) for field in self.output_fields]
+        self.error_log = ErrorLog(self.output_fields, location_terms, max_errors)
+
+    def add_listener(self, listener, trace_memory=False):
+        """
+        Adds a Listener that receives per-chunk and per-run statistics: stage timings, row counts, errors and
+        warnings, bytes read and written and peak memory (traced with tracemalloc if trace_memory is set).
+        """
+        if self.instrumentation is None:
+            self.instrumentation = Instrumentation()
+        self.instrumentation.trace_memory = self.instrumentation.trace_memory or trace_memory
+        self.instrumentation.listeners.append(listener)
+
+    def enable_profiling(self):
+        """
+        Times each transformation of the template separately from now on and returns the TransformationProfiler
+        that collects the timings, for a ranked report of the most expensive transformations.
+        """
+        if self.profiler is None:
+            self.profiler = TransformationProfiler()
+        return self.profiler
+
+    def enable_metrics(self):
+        """
+        Profiles the output fields while processing from now on; when a run completes, each field's metrics hold
+        estimates of its distinct values, quantiles, most frequent values, moments and more. Returns the
+        MetricsCollector, whose sketches can be merged with those of other workers.
+        """
+        if self.metrics_collector is None:
+            self.metrics_collector = MetricsCollector(self.output_fields)
+        return self.metrics_collector
+
+    def enable_anomaly_detection(self, max_warnings=100):
+        """
+        Enables metrics and reports the anomalies their detectors find as warnings: values breaking a sequence of
+        integers or a series of dates, statistical outliers and missing values in fields that are rarely missing.
+        At most max_warnings are reported per field and detector. Returns the MetricsCollector.
+        """
+        collector = self.enable_metrics()
+        collector.error_log = self.error_log
+        collector.max_warnings = max_warnings
+        return collector
+
     def show_configuration_details(self):
         self.configuration.print_details()
 
-    def process(self, source_file_paths, output_file_path="", error_file_path="", source_data=None):
-        """ processes file(s) using a supplied configuration """
+        if self.skipped_fields:
+            print("%d Skipped Fields (not used by any output field): %s" % (len(self.skipped_fields), ', '.join(self.skipped_fields)))
+            print("----------------------------------")
+
+    def process(self, source_file_paths, output_file_path="", error_file_path="", source_data=None, python_null=None,
+                checkpoint_file_path=None, resume=False, sample=None):
+        """
+        processes file(s) using a supplied configuration. PYTHON outputs return nulls as python_null (None or numpy.nan)
+        If a checkpoint_file_path is supplied, progress is recorded there after every chunk written to the output;
+        resume=True continues an interrupted run from its checkpoint instead of starting over.
+        A Sample restricts the run to part of the source rows, e.g. Sample.head(1000) to preview the output.
+        """
+
+        self.output_file.set_python_null(python_null)
+
+        if sample is not None and checkpoint_file_path:
+            raise ValueError("Sampled runs can't be resumed, please process them without a checkpoint.")
+        if checkpoint_file_path and any(transformation.operation in Transformation.unique_operations
+                                        for field in self.output_fields for transformation in field.transformations):
+            raise ValueError("Runs that look for duplicate values can't be resumed, since the values found aren't kept "
+                             "in checkpoints; please process them without a checkpoint.")
+        self.sample = sample
+
+        checkpoint, state = None, None
+        if checkpoint_file_path:
+            if self.output_file.type not in [File.CSV, File.JSON, File.FWF]:
+                raise ValueError("Checkpoints can only be used for CSV, JSON and FWF outputs, which are written while "
+                                 "processing.")
+            checkpoint = Checkpoint(checkpoint_file_path, source_file_paths if source_data is None else None)
 
         if self.output_file.name is not None:
             # only PYHTON configurations will not have a file output
             self.output_file.file_path = parse_file_path(output_file_path, self.output_file.name)
-            self.output_file.remove_existing_file()
+
+            if checkpoint is not None and resume:
+                state = checkpoint.load(self)
+            if state is None:
+                self.output_file.remove_existing_file()
 
         self.error_file_path = parse_file_path(error_file_path, FileProcessor.ERROR_FILE_DEFAULT_NAME)
 
+        self._set_source_files(source_file_paths, source_data)
+
+        cache_key = None
+        if self.result_cache is not None and source_data is None and self.output_file.name is not None and \
+                state is None and self.metrics_collector is None and sample is None:
+            cache_key = self.result_cache.key(self, source_file_paths)
+            if self._restore_results(cache_key):
+                return
+
+        offset = None
+        if checkpoint is not None and source_data is None and self._can_read_records():
+            # the checkpoint records the byte offset of every written chunk, resuming seeks to it; checkpoints that
+            # have none resume by skipping the rows processed before
+            offset = state.get("offset") if state else 0
+
+        self._get_source_data(source_data=source_data, start_row=state["rows"] if state else 0, offset=offset)
+        self._process_data(checkpoint=checkpoint, state=state)
+
+        if cache_key is not None:
+            has_errors_file = self.error_log.total_errors or self.error_log.total_warnings
+            self.result_cache.store(cache_key, self.output_file.file_path,
+                                    self.error_file_path if has_errors_file else None,
+                                    dict(self.error_log.checkpoint(), inputItems=self.input_items,
+                                         outputItems=self.output_items))
+
+        if self.output_file.type == File.PYTHON:
+            return self.output_file.data
+
+    def _restore_results(self, cache_key):
+        """ Puts the results of an earlier run on the same inputs in place; the individual errors aren't restored. """
+        entry = self.result_cache.restore(cache_key, self.output_file.file_path, self.error_file_path)
+        if entry is None:
+            return False
+
+        self.error_log.reset()
+        self.error_log.resume(entry)
+        self.input_items = entry["inputItems"]
+        self.output_items = entry["outputItems"]
+        self.stage = self.OUTPUT_DATA
+        return True
+
+    def validate(self, source_file_paths, error_file_path=None, source_data=None, sample=None):
+        """
+        Runs reading, type-casting and transformations without generating any output and returns a ValidationSummary.
+        Reading stops as soon as a fatal error is found or once max_errors problems have been recorded. Errors and
+        warnings are only written to a file if error_file_path is supplied. A Sample validates part of the rows.
+        """
+        self.sample = sample
+        self.error_file_path = parse_file_path(error_file_path, FileProcessor.ERROR_FILE_DEFAULT_NAME) \
+            if error_file_path else None
+
+        self._set_source_files(source_file_paths, source_data)
+        self._get_source_data(source_data=source_data)
+
+        self.fail_fast = True
+        try:
+            self._process_data(write_output=False)
+
+        except ValueError:
+            if self.stage != self.ERROR:
+                raise  # not a validation failure, e.g. the file doesn't match the template
+            self.stopped_early = True
+
+        finally:
+            self.fail_fast = False
+            self._close_source_data()
+
+        return ValidationSummary(self.error_log, self.input_items, self.stopped_early)
+
+    def process_many(self, inputs, output_dir="", error_dir="", max_workers=None, use_processes=True):
+        """
+        Processes many inputs with this processor's template concurrently and returns a BatchResult.
+
+        Each input is a source file path (or a list of paths for templates with several source files), or a dictionary
+        with the keys 'source', 'output' and 'errors' to set its own output and errors file paths. Otherwise, output and
+        errors files are named after the (first) source file and written to output_dir and error_dir. The largest
+        inputs are started first so a single large file doesn't hold back the end of the batch.
+        """
+        from datamonkey.batch import run_batch
+        return run_batch(self, inputs, output_dir, error_dir, max_workers, use_processes)
+
+    def process_small_files(self, inputs, output_dir="", error_dir="", merge=False, output_file_path="",
+                            error_file_path="", batch_rows=None):
+        """
+        Processes many small inputs of a single source file template by coalescing them into shared batches, so the
+        mapping, type-casting and transformations run once per batch instead of once per file. Rows are tagged with
+        the file they came from; outputs and errors are split back into one file per input (named as in
+        process_many) or, if merge is set, written to a single output and errors file. Returns a BatchResult.
+
+        Split inputs fail on their own and max_errors applies to each of them. A merged run stops with a ValueError at
+        the first fatal error, whichever input it's in.
+        """
+        from datamonkey.batch import run_coalesced
+        return run_coalesced(self, inputs, output_dir, error_dir, merge, output_file_path, error_file_path,
+                             batch_rows or FileProcessor.CHUNKSIZE)
+
+    def _set_source_files(self, source_file_paths, source_data=None):
+        """ assigns the supplied paths to the configured source files and verifies they exist """
         if source_data is None:
             if not source_file_paths:
                 raise ValueError("Please supply at least one source file path for processing.")
@@ -83,7 +323,7 @@ class FileProcessor:
                 source_file_paths = [source_file_paths]
 
             if len(source_file_paths) != len(self.source_files):
-                raise ValueError("You supplied %d file paths, but %d source files were defined in the configuration. You can call FileProcess.list_configuration_details() for more information on the expected source files for this configuration." % len(source_file_paths), len(self.source_files))
+                raise ValueError("You supplied %d file paths, but %d source files were defined in the configuration. You can call FileProcess.list_configuration_details() for more information on the expected source files for this configuration." % (len(source_file_paths), len(self.source_files)))
 
             # verify all files exist
             for i, path in enumerate(source_file_paths):
@@ -95,26 +335,40 @@ class FileProcessor:
                 validate_file_exists(source_file.file_path, source_file.s3_path)
                 check_file_size(source_file.file_path, source_file.s3_path)
 
-        self._get_source_data(source_data=source_data)
-        self._process_data()
-
-        if self.output_file.type == File.PYTHON:
-            return self.output_file.data
-
-    def _get_source_data(self, source_data=None):
+    def _get_source_data(self, source_data=None, start_row=0, offset=None):
         """ pull source data from all files and combine if multiple sources.
-        Users can also manually pass a list of dictionaries directly from Python """
+        Users can also manually pass a list of dictionaries directly from Python.
+        The first start_row rows are skipped, they were processed before resuming. If an offset is given, the source
+        file is read with a RecordReader from that byte offset, which is where the first start_row rows end. """
+        if self.instrumentation is not None:
+            self.instrumentation.start_run(self)
         self.stage = self.RETRIEVE_DATA
+        self.start_row = 0
+
+        nrows, skip_row = None, None
+        if self.sample is not None:
+            self.sample.reset()
+            if self.sample.mode == Sample.RANGE:
+                start_row, nrows = self.sample.start, self.sample.nrows
+            elif self.sample.mode == Sample.BERNOULLI:
+                skip_row = self.sample.skip_row  # only chunked files skip rows while parsing
 
         if source_data is None:
-            if self.chunk_source:
-                # returns a generator if file type can be chunked
-                source_data, _ = self.source_files[0].process_file(self.source_fields, chunk_data=True)
+            if offset is not None:
+                source_data = self.source_files[0].read_records(self.source_fields, self.projected_fields, offset)
+                self.start_row = start_row
+
+            elif self.chunk_source:
+                # returns a generator if file type can be chunked, the reader skips rows while parsing
+                source_data = self._read_source_file(self.source_files[0], self.source_fields, chunk_data=True,
+                                                     start_row=start_row, nrows=nrows, skip_row=skip_row)
+                self.start_row = start_row
 
             else:
                 for source_file in self.source_files:
                     fields = [field for field in self.source_fields if field.file_index == source_file.file_index]
-                    data, _ = source_file.process_file(fields)
+                    data = self._read_source_file(source_file, fields,
+                                                  nrows=None if nrows is None else start_row + nrows)
 
                     if source_data is None:
                         source_data = data
@@ -122,25 +376,58 @@ class FileProcessor:
                         for column in data.columns:
                             source_data[column] = data[column]
 
+                source_data = source_data.iloc[start_row:]
+
             self.source_data = source_data
 
         else:
             self.source_data = pandas.DataFrame.from_records(source_data)
-            for field in self.source_fields:
+            for field in self.projected_fields:
                 if field.name not in self.source_data.columns:
                     raise ValueError("Expected field '%s' was not found in the provided data. "
                                      "If this field is no longer required, please update the file template." % field.name)
 
+            self.source_data = self.source_data[[field.name for field in self.projected_fields]].iloc[
+                start_row:None if nrows is None else start_row + nrows]
+
+    def _read_source_file(self, source_file, fields, chunk_data=False, start_row=0, nrows=None, skip_row=None):
+        """
+        parses a source file, or reads its columns from the source cache if one is set; sampled runs read the file,
+        so the readers stop at the last row they need
+        """
+        if self.source_cache is not None and self.sample is None:
+            return self.source_cache.read(source_file, fields, self.projected_fields, chunk_data, start_row)
+
+        data, _ = source_file.process_file(fields, chunk_data=chunk_data, used_fields=self.projected_fields,
+                                           start_row=start_row, nrows=nrows, skip_row=skip_row)
+        return data
+
     def _get_next_chunk(self):
+        sample = self.sample
+        if sample is not None and sample.mode == Sample.RESERVOIR:
+            return sample.next_chunk(self._read_chunk)
+
+        data = self._read_chunk()
+        if data is not None and sample is not None and sample.mode == Sample.BERNOULLI:
+            data = sample.select(data)
+        return data
+
+    def _read_chunk(self):
+        self.stage = self.RETRIEVE_DATA
         if self.source_data is None:
             raise ValueError("Source data has not been set.")
 
-        elif type(self.source_data) is pandas.io.parsers.TextFileReader:
+        elif isinstance(self.source_data, (pandas.io.parsers.TextFileReader, ColumnarReader, RecordReader)):
             try:
-                return self.source_data.get_chunk(FileProcessor.CHUNKSIZE)
+                data = self.source_data.get_chunk(FileProcessor.CHUNKSIZE)
             except StopIteration:
                 return None
 
+            if self.start_row:
+                # rows keep their position in the file, as if the skipped rows had been read
+                data.index = data.index + self.start_row
+            return data
+
         elif type(self.source_data) is pandas.DataFrame:
             if len(self.source_data):
                 # return a chunk of the data and erase it from the source data -- to balance out the size increase in output data
@@ -150,27 +437,103 @@ class FileProcessor:
             else:
                 return None
 
-    def _process_data(self):
+    def _process_data(self, write_output=True, checkpoint=None, state=None):
         """ Reads in source files, transforms the data, outputs the results """
+        self._start_run(state)
+        instrumentation = self.instrumentation
+
+        try:
+            while True:
+                if instrumentation is not None:
+                    instrumentation.start_chunk(self)
+
+                data = self._get_next_chunk()
+                if data is None:
+                    if instrumentation is not None:
+                        instrumentation.cancel_chunk()
+                    break
+
+                rows_in = len(data)
+                rows_out = self._process_chunk(data, write_output)
+
+                if instrumentation is not None:
+                    instrumentation.finish_chunk(self, rows_in, rows_out)
+
+                if checkpoint is not None:
+                    checkpoint.save(self)
+
+                if self.fail_fast and self._error_budget_used():
+                    # no need to read the rest of the file
+                    self.stopped_early = True
+                    break
+
+            if write_output:
+                self.stage = self.OUTPUT_DATA
+                self.output_file.generate_output()  # append all data to output file or return processed data for python configs
+
+        except BaseException:
+            if instrumentation is not None:
+                instrumentation.finish_run(self, succeeded=False)
+            raise
+
+        finally:
+            self._close_errors_and_warnings()
+            self._release_key_sets()
+
+        if self.metrics_collector is not None:
+            self.metrics_collector.populate(self.output_fields)
+
+        if instrumentation is not None:
+            instrumentation.finish_run(self, succeeded=True)
+
+        if checkpoint is not None:
+            checkpoint.remove()  # the run is complete, there's nothing left to resume
+
+    def _start_run(self, state=None):
+        """ Resets the output, the error log and the counters before the first chunk is processed """
         self.output_file.reset_data()  # reset data in case processor instance is used multiple times
+        self.output_file._first_write = True
+        self.error_log.reset()
+        if self.error_file_path:
+            self.error_log.open(self.error_file_path)
+        if self.metrics_collector is not None:
+            self.metrics_collector.reset()
+        self._release_key_sets()
+
+        self.input_items = 0
+        self.output_items = 0
+        self.stopped_early = False
 
-        while True:
-            data = self._get_next_chunk()
-            if data is None:
-                break
+        if state is not None:
+            # continue after the last chunk that was written before the run was interrupted
+            self.error_log.resume(state["errorLog"])
+            self.output_file.resume(state["outputLength"])
+            self.input_items = state["rows"]
+            self.output_items = state["outputRows"]
 
-            self.processing_index_start = data.index[0]
-            self.processing_index_end = data.index[-1]
+    def _process_chunk(self, data, write_output=True):
+        """ Transforms one chunk of source data and writes its output, errors and warnings """
+        data = self._transform_chunk(data)
 
-            data = self._apply_field_mapping(data)  # Map inputs to outputs
-            data = self._validate_and_prepare_data(data)  # Validate data by handling any nulls + type-casting
-            data = self._apply_field_transformations(data)  # Process data transformations for all columns
+        if write_output:
             self._flush_data(data)
-
         self._write_errors_and_warnings()
+        return len(data)
 
-        self.stage = self.OUTPUT_DATA
-        self.output_file.generate_output()  # append all data to output file or return processed data for python configs
+    def _transform_chunk(self, data):
+        """ Maps, validates and transforms one chunk of source data into output data """
+        if len(data):
+            self.processing_index_start = data.index[0]
+            self.processing_index_end = data.index[-1]
+        self.input_items += len(data)
+
+        data = self._apply_field_mapping(data)  # Map inputs to outputs
+        data = self._validate_and_prepare_data(data)  # Validate data by handling any nulls + type-casting
+        data = self._apply_field_transformations(data)  # Process data transformations for all columns
+
+        if self.metrics_collector is not None:
+            self.metrics_collector.update(data)  # the values that are output
+        return data
 
     def _validate_and_prepare_data(self, output_data):
         """ Check for nulls and replace with supplied values or remove invalid lines.
@@ -179,12 +542,16 @@ class FileProcessor:
 
         # Replace all empty strings and strings with only whitespace with NaN for null validation
         output_data.replace("", numpy.nan, inplace=True)
+        if self.metrics_collector is not None:
+            self.metrics_collector.count_nulls(output_data)
 
         # find any nulls in all columns and check config for handling
-        for field in self.output_fields:
+        replaced = set()
+        for field_id, field in enumerate(self.output_fields):
             nulls = output_data[field.name].isnull()
             if len(output_data[nulls]):
                 if field.allow_null:
+                    replaced.add(field.name)
                     if field.replace_null_with == "":
                         if field.type in [field.STRING]:
                             replace_with = ""
@@ -195,17 +562,12 @@ class FileProcessor:
                     # TODO: re-implement, ix is slow
                     output_data.ix[nulls, field.name] = replace_with
                 else:
-                    indices = [str(x + 1) for x in output_data[nulls].index]
-                    output_data.drop(output_data[nulls].index, inplace=True)
-
-                    location = "%s(s): %s" % (self._decode_input_field_type(field), ", ".join(indices))
-                    warning = "Missing values found in field '%s' for %s. These rows will be skipped in the output. " \
-                              "If missing values should be allowed (or replaced) for this field, please alter your " \
-                              "file template." % (field.name, location)
-                    self._append_errors_and_warnings(warning=warning)
+                    indices = output_data[nulls].index
+                    output_data.drop(indices, inplace=True)
+                    self.error_log.add_missing_values(field_id, indices)
 
         # ensure column is the expected data type from config, cast to correct type if not (and log casting errors)
-        for field in self.output_fields:
+        for field_id, field in enumerate(self.output_fields):
             type = PANDAS_TYPE_MAP[field.type]
             col = output_data[field.name]
 
@@ -218,22 +580,24 @@ class FileProcessor:
                     truthy_strings = field.truthy_strings
                     output_data[field.name] = output_data[field.name].apply(test_truthy, args=(truthy_strings,))
 
+                elif self.shared_casts is not None and len(field.source_fields) == 1 and field.name not in replaced and \
+                        self._cast_shared(output_data, field):
+                    # cast once for all templates reading this source column, see FanOutProcessor
+                    pass
+
                 elif field.type in [Field.DATE, Field.DATETIME]:
                     try:
-                        output_data[field.name] = pandas.to_datetime(output_data[field.name], errors='raise')
+                        output_data[field.name] = self._cast(output_data[field.name], field.type)
                     except ValueError as err:
                         # catch failed date conversion issues and report.
                         invalid_value = err.args[1]
-                        idx = (col == invalid_value).idxmax() + 1
-                        location = "%s %d" % (self._decode_input_field_type(field), idx)
-                        error = "Could not coerce the value '%s' into a date or datetime for field '%s' (%s)." % \
-                                (invalid_value, field.name, location)
-                        self._append_errors_and_warnings(error)
+                        idx = (col == invalid_value).idxmax()
+                        self.error_log.add(ErrorLog.ERROR, ErrorLog.INVALID_DATE, field_id, [idx], invalid_value)
 
                 else:
                     # attempt a hard cast of the data to desired type
                     try:
-                        output_data[field.name] = col.astype(PYTHON_TYPE_MAP[field.type])
+                        output_data[field.name] = self._cast(col, field.type)
 
                     except ValueError as err:
                         invalid_value = ""
@@ -241,93 +605,103 @@ class FileProcessor:
                         for value in re.findall(r"'(.*?)'", err.args[0]):
                             invalid_value += value
 
-                        idx = (col == invalid_value).idxmax() + 1
-                        location = "%s %d" % (self._decode_input_field_type(field), idx)
-                        error = "Could not coerce the value '%s' into a %s for field '%s' (%s)." % \
-                                (invalid_value, DMK_TYPE_MAP[field.type], field.name, location)
+                        idx = (col == invalid_value).idxmax()
+                        self.error_log.add(ErrorLog.ERROR, ErrorLog.INVALID_TYPE, field_id, [idx], invalid_value)
 
-                        self._append_errors_and_warnings(error)
+            if self.fail_fast and self.error_log.total_errors:
+                self._exit_with_errors()
 
-        if len(self.errors):
+        if self.error_log.total_errors:
             self._exit_with_errors()
 
         return output_data
 
+    @staticmethod
+    def _cast(col, field_type):
+        """ casts a column to a field type, raises a ValueError if a value can't be cast """
+        if field_type in [Field.DATE, Field.DATETIME]:
+            return pandas.to_datetime(col, errors='raise')
+
+        return col.astype(PYTHON_TYPE_MAP[field_type])
+
+    def _cast_shared(self, output_data, field):
+        """ Uses the shared cast of the field's source column, if the whole column could be cast """
+        column = self.shared_casts.cast(self.source_fields[field.source_fields[0]].name, field.type, self._cast)
+        if column is None:
+            return False
+
+        output_data[field.name] = column.loc[output_data.index]
+        return True
+
     def _apply_field_mapping(self, source_data):
         """ create a field mapping of inputs to outputs based on the configuration. """
         self.stage = self.MAP
 
         columns = [field.name for field in self.output_fields]
-        output_data = pandas.DataFrame(columns=columns)
+        mapped = {}
 
         for field in self.output_fields:
-            if len(field.source_fields) == 1:
-                # one-to-one mapping
-                field_index = field.source_fields[0]
-                source_field = self.source_fields[field_index]
-                output_data[field.name] = source_data[source_field.name]
+            names = [self.source_fields[field_index].name for field_index in field.source_fields]
+
+            if len(names) == 1:
+                # one-to-one mapping, reference the source column directly
+                mapped[field.name] = source_data[names[0]]
             else:
                 # merge multiple columns
-                data = {"merge_col": ""}
-
-                for j, delimiter in enumerate(field.merge_delimiters):
-                    data["delimiter%d" % j] = delimiter
-
-                delimiters = pandas.DataFrame(data=data, index=numpy.arange(len(source_data)))
-                col = delimiters["merge_col"]
-
-                field_names = []
-                for field_index in field.source_fields:
-                    source_field = self.source_fields[field_index]
-                    field_names.append(source_field.name)
-
-                for k, name in enumerate(field_names):
-                    # need to hard-cast all merge columns to strings in this version, might want to consider merging integers/floats w/ math operations
-                    if k == 0:
-                        col = source_data[name].astype(str)
-                    else:
-                        col = col + delimiters["delimiter%d" % (k-1)] + source_data[name].astype(str)
+                # need to hard-cast all merge columns to strings in this version, might want to consider merging integers/floats w/ math operations
+                merge_cols = [source_data[name].astype(str) for name in names]
 
-                output_data[field.name] = col
+                if len(set(field.merge_delimiters)) == 1:
+                    # a single shared delimiter can be used as the separator
+                    mapped[field.name] = merge_cols[0].str.cat(merge_cols[1:], sep=field.merge_delimiters[0])
+                else:
+                    # interleave constant delimiter columns aligned to the chunk's index
+                    others = []
+                    for delimiter, col in zip(field.merge_delimiters, merge_cols[1:]):
+                        others.append(pandas.Series(delimiter, index=source_data.index))
+                        others.append(col)
+                    mapped[field.name] = merge_cols[0].str.cat(others, sep="")
 
-        return output_data
+        return pandas.DataFrame(mapped, index=source_data.index, columns=columns)
 
     def _apply_field_transformations(self, output_data):
         self.stage = self.TRANSFORM
 
         """ Apply transformations (modifiers, validators, filters) to fields as configured. """
 
-        def do_transformations(target_value, target_transformations):
-            """ Loop through transformations and apply them to the supplied value """
-            for i, transformation in enumerate(target_transformations):
+        def do_transformations(target_value, target_transformations, start=0):
+            """ Loop through transformations (from position start on) and apply them to the supplied value """
+            for i, transformation in enumerate(target_transformations, start):
                 try:
                     target_value, target_action, target_message = transformation[0](target_value, transformation[1])
                     if target_action:
-                        return target_value, target_action, "transformation #%d: %s" \
-                               % (i + 1, target_message)
+                        return target_value, target_action, i + 1, target_message
                 except Exception as err:
-                    return target_value, "ERROR", "transformation #%d: %s" % \
-                           (i + 1, repr(err))
+                    return target_value, "ERROR", i + 1, repr(err)
 
-            return target_value, None, None
+            return target_value, None, None, None
 
         # TODO: SORT FIELDS BY ORDER OF IMPORTANCE (FILTERS FIRST)
         sorted_fields = self.output_fields
 
-        for field in sorted_fields:
+        for field_id, field in enumerate(sorted_fields):
             if len(field.transformations):
 
                 name = field.name
-                transformations = [(FUNCTION_MAP[transformation.operation], transformation.parameters) for
-                                   transformation in field.transformations]  # turn into list of function handlers
+                transformations = field.operations  # list of function handlers compiled with the template
                 data_indices, data_values, filter_indices = [], [], []
+                issues = {ErrorLog.ERROR: ([], [], []), ErrorLog.WARNING: ([], [], [])}  # rows, transformations, messages
 
-                # run transformations as a lambda for each column
-                results = output_data[name].dropna().apply(do_transformations, args=(transformations,))
+                # run transformations as a lambda for each column, timing each one when profiling
+                apply = do_transformations if self.profiler is None else self.profiler.wrap(field_id, field)
+                if field.column_operations:
+                    results = self._transform_column(field_id, field, output_data[name].dropna(), output_data, apply)
+                else:
+                    results = self._apply_values(output_data[name].dropna(), apply, transformations)
 
                 for row in results.iteritems():
                     index = row[0]
-                    (value, action, message) = row[1]
+                    (value, action, number, message) = row[1]
 
                     if not action:
                         # value was modified without issue
@@ -337,22 +711,28 @@ class FileProcessor:
                     elif action == 'ERROR':
                         # error captured and the line is filtered, but isn't reported until after all columns process
                         filter_indices.append(index)
-                        location = "%s %d" % (self._decode_input_field_type(field), index + 1)
-                        error = "'%s', %s, %s." % (name, location, message)
-                        self._append_errors_and_warnings(error=error)
+                        issue = issues[ErrorLog.ERROR]
+                        issue[0].append(index)
+                        issue[1].append(number)
+                        issue[2].append(message)
 
                     elif action == "WARN":
                         # warning is generated but the line remains in the output
                         data_indices.append(index)
                         data_values.append(value)
-                        location = "%s %d" % (self._decode_input_field_type(field), index + 1)
-                        warning = "'%s', %s, %s." % (name, location, message)
-                        self._append_errors_and_warnings(warning=warning)
+                        issue = issues[ErrorLog.WARNING]
+                        issue[0].append(index)
+                        issue[1].append(number)
+                        issue[2].append(message)
 
                     elif action == "FILTER":
                         # row is filtered from the output
                         filter_indices.append(index)
 
+                for severity, (rows, numbers, messages) in issues.items():
+                    if rows:
+                        self.error_log.add(severity, ErrorLog.TRANSFORMATION, field_id, rows, messages, numbers)
+
                 if len(filter_indices):
                     # remove all filtered data
                     output_data.drop(filter_indices, inplace=True)
@@ -362,62 +742,153 @@ class FileProcessor:
                     col = pandas.DataFrame(index=data_indices, data=data_values, columns=[name])
                     output_data[name] = col
 
-        if len(self.errors):
+                if self.fail_fast and self.error_log.total_errors:
+                    # skip the remaining fields, the error is fatal
+                    self._exit_with_errors()
+
+        if self.error_log.total_errors:
             self._exit_with_errors()
 
-        # after transforming the data, replace any NaN or NaT values with a blank string for output purposes
-        output_data.replace(numpy.nan, "", inplace=True)
+        # NaN / NaT values are left in place so columns keep their native types; each output writer renders nulls
         return output_data
 
+    def _apply_values(self, values, apply, operations, start=0):
+        """
+        Applies value-by-value transformations (from position start on) to a column. Columns that repeat few distinct
+        values, judged on a sample, get the transformations applied once per distinct value and the results, actions
+        and messages included, broadcast back to their rows.
+        """
+        if len(values) >= MEMOIZE_MIN_ROWS:
+            sample = values.iloc[:MEMOIZE_SAMPLE_ROWS]
+            if sample.nunique() <= MEMOIZE_MAX_DISTINCT * len(sample):
+                codes, uniques = pandas.factorize(values)
+                if self.profiler is None:
+                    results = pandas.Series(uniques).apply(apply, args=(operations, start))
+                else:
+                    # profiles count rows, so each distinct value counts for the rows that repeat it
+                    counts = numpy.bincount(codes, minlength=len(uniques))
+                    results = pandas.Series([apply(value, operations, start, int(count))
+                                             for value, count in zip(uniques, counts)], dtype=object)
+                return pandas.Series(results.values[codes], index=values.index)
+
+        return values.apply(apply, args=(operations, start))
+
+    def _transform_column(self, field_id, field, values, output_data, apply):
+        """
+        Applies the transformations of a field with column operations (e.g. VALIDATE_UNIQUE) to its values. The
+        transformations between column operations are applied value by value as usual; each column operation gets the
+        values no earlier transformation acted on, so a value is still stopped by the first one that acts on it.
+        Returns the same (value, action, number, message) per value as applying them value by value.
+        """
+        operations = field.operations
+        results = {}
+        pending = values
+        start = 0
+
+        for position in field.column_operations + [len(operations)]:
+            if start < position and len(pending):
+                indices, kept = [], []
+                segment = self._apply_values(pending, apply, operations[start:position], start)
+                for index, result in segment.iteritems():
+                    if result[1]:
+                        results[index] = result
+                    else:
+                        indices.append(index)
+                        kept.append(result[0])
+                pending = pandas.Series(kept, index=indices)
+
+            if position < len(operations) and len(pending):
+                function, parameters = operations[position]
+                started = time.perf_counter()
+                try:
+                    if field.transformations[position].operation in Transformation.unique_operations:
+                        new_values, actions, messages = self._apply_unique(field_id, position, pending, output_data)
+                    else:
+                        new_values, actions, messages = function(pending, parameters, None, output_data)
+                except Exception as err:
+                    new_values, actions, messages = pending, ["ERROR"] * len(pending), [repr(err)] * len(pending)
+
+                stopped = numpy.array([action is not None for action in actions], dtype=bool)
+                if self.profiler is not None:
+                    acted = [action for action in actions if action is not None]
+                    self.profiler.record(field_id, field, position + 1, len(pending), time.perf_counter() - started,
+                                         modified=int((new_values.values != pending.values).sum()),
+                                         filtered=acted.count("FILTER"), warnings=acted.count("WARN"),
+                                         errors=acted.count("ERROR"))
+
+                for index, value, action, message in zip(new_values.index[stopped], new_values.values[stopped],
+                                                          numpy.asarray(actions, dtype=object)[stopped],
+                                                          numpy.asarray(messages, dtype=object)[stopped]):
+                    results[index] = (value, action, position + 1, message)
+                pending = new_values[~stopped]
+
+            start = position + 1
+
+        for index, value in pending.iteritems():
+            results[index] = (value, None, None, None)
+        return pandas.Series([results[index] for index in values.index], index=values.index, dtype=object)
+
+    def _apply_unique(self, field_id, position, values, output_data):
+        """ Applies a uniqueness operation; rows of coalesced inputs are only compared with rows of the same input. """
+        function, parameters = self.output_fields[field_id].operations[position]
+        if self.key_offsets is None:
+            return function(values, parameters, self._key_set(field_id, position), output_data)
+
+        owners = numpy.searchsorted(self.key_offsets, values.index.values, side="right") - 1
+        parts = [function(values[owners == owner], parameters, self._key_set(field_id, position, owner), output_data)
+                 for owner in numpy.unique(owners)]
+        return pandas.concat([part[0] for part in parts]), numpy.concatenate([part[1] for part in parts]), \
+            numpy.concatenate([part[2] for part in parts])
+
+    def _key_set(self, field_id, position, owner=None):
+        """ the KeySet of a column operation (for one of the coalesced inputs), created when the run first reaches it """
+        key = (field_id, position, owner)
+        if key not in self.key_sets:
+            parameters = self.output_fields[field_id].transformations[position].parameters
+            self.key_sets[key] = KeySet(bloom_filter=parameters.get("bloomFilter", False))
+        return self.key_sets[key]
+
+    def _release_key_sets(self):
+        """ drops the keys seen by the column operations, which only span one run """
+        for key_set in self.key_sets.values():
+            key_set.close()
+        self.key_sets = {}
+
     def _flush_data(self, data):
         self.stage = self.WRITING_DATA
         self.output_items += len(data)
         self.output_file.append_data(data)
         self.output_file.flush_output()
 
+    def _error_budget_used(self):
+        """ True once a fatal error was found or max_errors problems were counted """
+        if self.error_log.total_errors:
+            return True
+
+        return self.max_errors is not None and \
+            (self.error_log.total_errors + self.error_log.total_warnings) >= self.max_errors
+
+    def _close_source_data(self):
+        """ releases the source file handle if reading stopped before the end of the file """
+        if isinstance(self.source_data, (pandas.io.parsers.TextFileReader, ColumnarReader, RecordReader)):
+            self.source_data.close()
+        self.source_data = None
+
     def _exit_with_errors(self):
         self.stage = self.ERROR
         """ Logs any errors/warnings to the job and local file and raises fatal exception.  """
-        self._write_errors_and_warnings()
+        self._close_errors_and_warnings()
         raise ValueError("Encountered errors while processing; please see the errors file for more details.")
 
-    def _append_errors_and_warnings(self, error="", warning=""):
-        # Prevent millions of errors and warnings from generating to preserve memory/space if required
-        if self.max_errors is None or ((len(self.errors) + len(self.warnings)) < self.max_errors):
-            if error:
-                self.errors.append(error)
-
-            if warning:
-                self.warnings.append(warning)
-
-
     def _write_errors_and_warnings(self):
-        """ Pretty prints errors/warnings to a local file """
+        """ Appends errors/warnings found since the last write to the errors file """
         self.stage = self.WRITE_ERRORS
+        self.error_log.write()
 
-        if len(self.errors) or len(self.warnings):
-            try:
-                if check_S3_path(self.error_file_path):
-                    import s3fs
-                    fs = s3fs.S3FileSystem()
-                    file = fs.open(self.error_file_path, "wb")
-
-                else:
-                    file = open(self.error_file_path, "wb")
-
-                file.write(('***** ERRORS *****\n').encode())
-
-                for error in self.errors:
-                    file.write((error + '\n').encode())
-
-                file.write(('\n***** WARNINGS *****\n').encode())
-                for warning in self.warnings:
-                    file.write((warning + '\n').encode())
-                file.close()
-
-            except Exception as err:
-                file.close()
-                raise err
+    def _close_errors_and_warnings(self):
+        """ Writes the remaining errors/warnings and a summary of the totals, then closes the errors file """
+        self.stage = self.WRITE_ERRORS if self.stage != self.ERROR else self.stage
+        self.error_log.close()
 
     def _decode_input_field_type(self, output_field):
         """ Figures out the correct terminology to use when referencing data. Should probably be deprecated/improved. """
@@ -425,6 +896,31 @@ class FileProcessor:
         source_file = self.source_files[source_field.file_index]
         return "Object" if source_file.type == File.JSON else 'Row'
 
+    def _project_source_fields(self):
+        """ Determines the minimal set of source fields the output mapping and transformations depend on.
+        Transformations only operate on the value mapped into their own output field, so the mapping covers them. """
+        indices = set()
+        for field in self.output_fields:
+            indices.update(field.source_fields)
+
+        return [field for i, field in enumerate(self.source_fields) if i in indices]
+
+    def _can_read_records(self):
+        """Determines if the source can be read from a byte offset, which checkpointed runs resume from."""
+        if len(self.source_files) > 1 or self.source_cache is not None:
+            # multiple files are joined in memory, cached sources are read by row
+            return False
+
+        source_file = self.source_files[0]
+        if os.path.splitext(source_file.file_path)[1].lower() in RecordReader.COMPRESSED:
+            return False
+
+        if source_file.type == File.JSON:
+            return source_file.line_delimited_JSON
+        if source_file.type == File.CSV:
+            return len(source_file.delimiter) == 1  # longer delimiters are regular expressions
+        return source_file.type == File.FWF
+
     def _can_chunk_source(self):
         """Determines if data can be chunked to reduce memory usage."""
         if len(self.source_files) > 1:
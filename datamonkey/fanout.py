@@ -0,0 +1,171 @@
+import time
+
+from datamonkey.batch import FileResult, BatchResult
+from datamonkey.helpers import parse_file_path, LazyModule
+
+numpy = LazyModule("numpy")
+
+
+class SharedCasts:
+    """ Type casts of the source columns of the current chunk, shared by the templates of a fan-out. """
+
+    def __init__(self):
+        self.data = None
+        self._casts = {}
+
+    def reset(self, data):
+        self.data = data
+        self._casts = {}
+
+    def cast(self, column, field_type, cast):
+        """ Returns the column cast to the field type, or None if some value of the column can't be cast. """
+        key = (column, field_type)
+        if key not in self._casts:
+            try:
+                self._casts[key] = cast(self.data[column], field_type)
+            except ValueError:
+                # the invalid value may be in a row a template drops; each template casts (and reports) its own rows
+                self._casts[key] = None
+
+        return self._casts[key]
+
+
+class FanOutProcessor:
+    """
+    Runs several templates over the same source files in a single pass: the files are read and chunked once, and each
+    chunk is handed to every template's mapping, validation and transformations. Each template writes its own output
+    and errors file, and a template that hits a fatal error doesn't stop the others.
+    """
+
+    def __init__(self, processors):
+        if not processors:
+            raise ValueError("Please supply at least one file processor.")
+
+        self.processors = processors
+        self._validate()
+
+    def _validate(self):
+        """ the templates must read the source files the same way """
+        def describe(processor):
+            return [[(file.type, file.has_header, file.skip_rows, file.sheet_name, file.line_delimited_JSON,
+                      file.delimiter)
+                     for file in processor.source_files],
+                    [(field.name, field.file_index, field.col_specs) for field in processor.source_fields]]
+
+        expected = describe(self.processors[0])
+        for processor in self.processors[1:]:
+            if describe(processor) != expected:
+                raise ValueError("Template %s describes other source files (or fields) than template %s; only "
+                                 "templates for the same source files can be processed together." %
+                                 (processor.configuration.id, self.processors[0].configuration.id))
+
+    def process(self, source_file_paths, output_file_paths=None, error_file_paths=None):
+        """
+        Processes the source files with every template and returns a BatchResult with one result per template, in the
+        order of the processors. Output and errors paths are listed in the same order; errors files default to
+        '<template id>_errors_and_warnings.txt'.
+        """
+        from datamonkey.core import FileProcessor
+
+        start = time.time()
+        output_file_paths = output_file_paths or [""] * len(self.processors)
+        error_file_paths = error_file_paths or [""] * len(self.processors)
+
+        results = []
+        for index, processor in enumerate(self.processors):
+            if processor.output_file.name is not None:
+                processor.output_file.file_path = parse_file_path(output_file_paths[index], processor.output_file.name)
+                processor.output_file.remove_existing_file()
+
+            processor.error_file_path = parse_file_path(
+                error_file_paths[index],
+                "%s_%s" % (processor.configuration.id, FileProcessor.ERROR_FILE_DEFAULT_NAME))
+
+            results.append(FileResult(index, source_file_paths, processor.output_file.file_path
+                                      if processor.output_file.name is not None else None, processor.error_file_path))
+
+        # the source files are read once, with every column any of the templates uses
+        reader = FileProcessor.from_configuration(self.processors[0].configuration)
+        reader.source_cache = self.processors[0].source_cache
+        used = set()
+        for processor in self.processors:
+            for field in processor.output_fields:
+                used.update(field.source_fields)
+        reader.projected_fields = [field for i, field in enumerate(reader.source_fields) if i in used]
+
+        reader._set_source_files(source_file_paths)
+        reader._get_source_data()
+
+        shared_casts = SharedCasts()
+        active = list(self.processors)
+        for processor in active:
+            processor.shared_casts = shared_casts
+            for source_file, read in zip(processor.source_files, reader.source_files):
+                source_file.file_path = read.file_path  # the bytes each template's run reads, for its listeners
+            if processor.instrumentation is not None:
+                processor.instrumentation.start_run(processor)
+            processor._start_run()
+
+        try:
+            while active:
+                data = reader._get_next_chunk()
+                if data is None:
+                    break
+
+                data.replace("", numpy.nan, inplace=True)  # done once here rather than by every template
+                shared_casts.reset(data)
+
+                for processor in list(active):
+                    instrumentation = processor.instrumentation
+                    if instrumentation is not None:
+                        instrumentation.start_chunk(processor)
+
+                    try:
+                        rows_out = processor._process_chunk(data)
+
+                    except ValueError as err:
+                        if processor.stage != processor.ERROR:
+                            raise
+
+                        results[self.processors.index(processor)].exception = "%s: %s" % (err.__class__.__name__, err)
+                        active.remove(processor)
+                        if instrumentation is not None:
+                            instrumentation.finish_run(processor, succeeded=False)
+                        continue
+
+                    if instrumentation is not None:
+                        instrumentation.finish_chunk(processor, len(data), rows_out)
+
+        except BaseException:
+            for processor in active:
+                if processor.instrumentation is not None:
+                    processor.instrumentation.finish_run(processor, succeeded=False)
+            raise
+
+        finally:
+            reader._close_source_data()
+            for processor in self.processors:
+                processor.shared_casts = None
+                processor._close_errors_and_warnings()
+                processor._release_key_sets()
+
+        for processor in active:
+            processor.stage = processor.OUTPUT_DATA
+            processor.output_file.generate_output()
+            if processor.metrics_collector is not None:
+                processor.metrics_collector.populate(processor.output_fields)
+            if processor.instrumentation is not None:
+                processor.instrumentation.finish_run(processor, succeeded=True)
+
+        seconds = time.time() - start
+        for processor, result in zip(self.processors, results):
+            result.succeeded = processor in active
+            result.seconds = seconds  # the templates are processed together
+            result.input_items = processor.input_items
+            result.output_items = processor.output_items
+            result.total_errors = processor.error_log.total_errors
+            result.total_warnings = processor.error_log.total_warnings
+            if result.succeeded and processor.output_file.type == processor.output_file.PYTHON:
+                result.data = processor.output_file.data
+
+        return BatchResult(results, seconds)
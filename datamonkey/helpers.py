@@ -1,6 +1,26 @@
 import os
 import re
-import numpy
+import importlib
+
+# ************** LAZY IMPORTS **************
+
+class LazyModule:
+    """
+    Stand-in for a heavy module (e.g. pandas) that is only imported the first time one of its attributes is used,
+    so importing datamonkey or reading a template stays fast.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return "<lazy module '%s'%s>" % (self._name, "" if self._module is None else " (loaded)")
 
 # ************** FILE PROCESSOR HELPERS **************
 
@@ -32,14 +52,32 @@ def make_S3_directory_tree(file_path):
         fs.mkdir(dir_path)
 
 
-def check_file_size(file_path, s3=False):
-
+def get_file_size(file_path, s3=False):
     if s3:
         import s3fs
         fs = s3fs.S3FileSystem()
-        size = fs.info(file_path).get('Size', 0)
+        return fs.info(file_path).get('Size', 0)
     else:
-        size = os.path.getsize(file_path)
+        return os.path.getsize(file_path)
+
+
+def get_file_identity(file_path, s3=False):
+    """ identifies a version of a file without reading it: its path, size and modification time (ETag on S3) """
+    if s3:
+        import s3fs
+        fs = s3fs.S3FileSystem()
+        info = fs.info(file_path)
+        return [file_path, info.get('Size', 0), info.get('ETag', "")]
+
+    if not os.path.isfile(file_path):
+        return [file_path]
+
+    stat = os.stat(file_path)
+    return [file_path, stat.st_size, stat.st_mtime_ns]
+
+
+def check_file_size(file_path, s3=False):
+    size = get_file_size(file_path, s3)
 
     if size > 1024 ** 3:
         print("WARNING: We've detected that your file size is greater than 1GB. DataMonkey has not yet been optimized "
@@ -0,0 +1,252 @@
+import io
+import os
+import csv
+import uuid
+import random
+import ujson as json
+
+from collections import OrderedDict
+
+from datamonkey.helpers import check_S3_path, validate_file_exists, LazyModule
+from datamonkey.models import Configuration, File, Field
+from datamonkey.settings import INFERRED_DATA_TYPE_MAP, INFERRED_FILE_TYPE_MAP
+
+pandas = LazyModule("pandas")
+
+HEAD_BYTES = 4 * 1024 ** 2  # the head sample stops at this size, whatever the number of rows
+DELIMITERS = ",;\t|"
+BOOLEANS = frozenset(["true", "false", "yes", "no"])
+OUTPUT_EXTENSIONS = {File.CSV: ".csv", File.EXCEL: ".xlsx", File.JSON: ".json", File.FWF: ".txt"}
+
+
+def infer_configuration(file_path, id=None, head_rows=1000, samples=20, sample_bytes=65536, seed=0,
+                        output_type=File.CSV):
+    """
+    Infers a template from a sample of a source file and returns it as a Configuration. The file type, header,
+    delimiter (CSV), column markers (FWF), field names, types and whether fields contain nulls are inferred from the
+    first head_rows rows plus samples blocks of sample_bytes read at random offsets (seeded), so the time it takes
+    doesn't depend on the size of the file. Excel and JSON array files can't be read from an offset; only their
+    first head_rows rows are sampled. Output fields map the source fields one to one, without transformations.
+    """
+    if check_S3_path(file_path):
+        raise ValueError("Templates can only be inferred from local files: %s" % file_path)
+
+    validate_file_exists(file_path)
+    head, head_size = _read_head(file_path, head_rows, HEAD_BYTES)
+    type, line_delimited_JSON, delimiter = _sniff_type(file_path, head)
+    blocks = [] if type == File.EXCEL or type == File.JSON and not line_delimited_JSON else \
+        _read_blocks(file_path, head_size, samples, sample_bytes, seed)
+
+    source_file = {"type": type, "hasHeader": False, "lineDelimitedJSON": line_delimited_JSON, "sheetName": "",
+                   "skipRows": 0}
+    col_specs = None
+
+    if type == File.EXCEL:
+        data = pandas.ExcelFile(file_path).parse(nrows=head_rows, header=None, dtype=str)
+    elif type == File.JSON:
+        data = _parse_json(head, blocks, line_delimited_JSON)
+        source_file["hasHeader"] = True  # the keys are the field names
+    elif type == File.CSV:
+        source_file["delimiter"] = delimiter
+        text = io.StringIO("".join([head] + blocks))
+        data = pandas.read_csv(text, sep=delimiter, header=None, dtype=str, skip_blank_lines=True,
+                               error_bad_lines=False, warn_bad_lines=False)
+    else:
+        lines = [line for line in "".join([head] + blocks).splitlines() if line.strip()]
+        col_specs = _infer_col_specs(lines)
+        data = pandas.read_fwf(io.StringIO("\n".join(lines)), header=None, dtype=str,
+                               widths=[end - start + 1 for start, end in col_specs])
+
+    if type != File.JSON and len(data):
+        source_file["hasHeader"] = _has_header(data, head if type == File.CSV else None)
+    if source_file["hasHeader"] and type != File.JSON:
+        names = [str(name).strip() for name in data.iloc[0]]
+        data = data.iloc[1:]
+    elif type != File.JSON:
+        names = ["Column %d" % (i + 1) for i in range(len(data.columns))]
+    else:
+        names = [str(name) for name in data.columns]
+
+    if not names:
+        raise ValueError("No fields were found in %s to infer a template from." % file_path)
+
+    source_fields, output_fields = [], []
+    for i, name in enumerate(names):
+        values = data[data.columns[i]].dropna()
+        values = values[values.astype(str).str.strip() != ""]
+        specs = list(col_specs[i]) if col_specs else []
+        source_fields.append({"name": name, "used": True, "fileIndex": 0, "colSpecs": specs})
+        output_fields.append({"name": name,
+                              "type": _infer_type(values.astype(str).str.strip()),
+                              "sourceFields": [i],
+                              "allowNull": len(values) < len(data),
+                              "replaceNullWith": "",
+                              "colSpecs": specs,
+                              "transformations": []})
+
+    if output_type == File.FWF and not col_specs:
+        # output markers are sized to the longest value in the sample
+        start = 1
+        for field, name, column in zip(output_fields, names, data.columns):
+            width = max([len(name)] + [len(str(value)) for value in data[column].dropna()])
+            field["colSpecs"] = [start, start + width - 1]
+            start += width
+
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    template = {"version": "VERSION_1",
+                "label": "Inferred from %s" % os.path.basename(file_path),
+                "sourceFiles": [source_file],
+                "outputFile": {"type": output_type, "hasHeader": True, "sheetName": "Sheet1",
+                               "name": "%s_output%s" % (base_name, OUTPUT_EXTENSIONS[output_type])},
+                "sourceFields": source_fields,
+                "outputFields": output_fields}
+
+    return Configuration(id or str(uuid.uuid4()), "", template=template)
+
+
+def _read_head(file_path, rows, max_bytes):
+    """ the first rows lines of a file, read up to max_bytes without a partial last line, and their size in bytes """
+    with open(file_path, "rb") as file:
+        lines = []
+        size = 0
+        while len(lines) < rows and size < max_bytes:
+            line = file.readline(max_bytes - size)
+            if not line:
+                break
+            lines.append(line)
+            size += len(line)
+
+    if len(lines) > 1 and size >= max_bytes and not lines[-1].endswith(b"\n"):
+        size -= len(lines.pop())
+    return b"".join(lines).decode("utf-8", errors="replace"), size
+
+
+def _read_blocks(file_path, start, samples, sample_bytes, seed):
+    """ complete lines of blocks read at random offsets after the first start bytes, in the order of the file """
+    size = os.path.getsize(file_path)
+    if size - start <= sample_bytes:
+        return []
+
+    generator = random.Random(seed)
+    offsets = sorted(generator.randint(start, size - sample_bytes) for _ in range(samples))
+    blocks = []
+    with open(file_path, "rb") as file:
+        for offset in offsets:
+            file.seek(offset)
+            block = file.read(sample_bytes)
+            # the first line may be partial, and so may the last
+            block = block[block.find(b"\n") + 1:block.rfind(b"\n") + 1]
+            blocks.append(block.decode("utf-8", errors="replace"))
+    return blocks
+
+
+def _sniff_type(file_path, head):
+    """ the file type, whether JSON is line delimited and the delimiter of CSV files """
+    text = head.lstrip()
+    if text.startswith("{"):
+        return File.JSON, True, None
+    if text.startswith("["):
+        return File.JSON, False, None
+
+    type = INFERRED_FILE_TYPE_MAP.get(os.path.splitext(file_path)[1].lower())
+    if type == File.EXCEL:
+        return type, False, None
+
+    lines = [line for line in head.splitlines() if line.strip()]
+    try:
+        delimiter = csv.Sniffer().sniff("\n".join(lines[:100]), delimiters=DELIMITERS).delimiter
+    except csv.Error:
+        # e.g. a header without rows; the delimiter found most often, as often on every line
+        counts = [(min(line.count(delimiter) for line in lines), delimiter) for delimiter in DELIMITERS if lines]
+        delimiter = max(counts)[1] if counts and max(counts)[0] else None
+
+    if delimiter is None or type == File.FWF and len(set(line.count(delimiter) for line in lines)) > 1:
+        # text files are fixed width unless every line has the same number of delimiters
+        return File.FWF, False, None
+    return File.CSV, False, delimiter
+
+
+def _parse_json(head, blocks, line_delimited_JSON):
+    if line_delimited_JSON:
+        records = []
+        for line in "".join([head] + blocks).splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass  # a line cut off by the end of the head
+        return _records_frame(records)
+
+    text = head.strip()
+    try:
+        records = json.loads(text)
+    except ValueError:
+        # the head ends inside the array, the records before the last complete one are kept
+        records = json.loads(text[:text.rfind("}") + 1] + "]")
+    return _records_frame(records)
+
+
+def _records_frame(records):
+    """ the records as a data frame of objects (so integers with nulls aren't turned into floats), in key order """
+    columns = list(OrderedDict((key, None) for record in records for key in record))
+    return pandas.DataFrame(records, columns=columns, dtype=object)
+
+
+def _infer_col_specs(lines):
+    """
+    column markers of fixed width lines, 1-based and inclusive as in templates: a column starts wherever text follows a
+    position that's blank on every line
+    """
+    width = max(len(line) for line in lines)
+    blank = [all(position >= len(line) or line[position] == " " for line in lines) for position in range(width)]
+    starts = [0] + [position for position in range(1, width) if blank[position - 1] and not blank[position]]
+    return [(start + 1, end) for start, end in zip(starts, starts[1:] + [width])]
+
+
+def _infer_type(values):
+    """ the narrowest field type that fits all the (non-empty, stripped) string values """
+    if not len(values):
+        return Field.STRING
+
+    if values.str.lower().isin(BOOLEANS).all():
+        return Field.BOOLEAN
+
+    # leading zeros mark codes, e.g. zip codes, which would lose them as numbers
+    if not values.str.match(r"^[+-]?0\d").any():
+        try:
+            return INFERRED_DATA_TYPE_MAP[pandas.to_numeric(values).dtype.name]
+        except (ValueError, KeyError):
+            pass
+
+    if values.str.contains(r"\d").all():
+        try:
+            return INFERRED_DATA_TYPE_MAP[pandas.to_datetime(values).dtype.name]
+        except (ValueError, OverflowError, KeyError):
+            pass
+
+    return Field.STRING
+
+
+def _has_header(data, text=None):
+    """
+    whether the first row of data (read as strings) names the columns: a column whose other values have a type the
+    first value doesn't fit says so; if no column has a type, the csv sniffer decides for delimited text
+    """
+    first, rest = data.iloc[0], data.iloc[1:]
+    typed = False
+    for column in data.columns:
+        values = rest[column].dropna().astype(str).str.strip()
+        values = values[values != ""]
+        type = _infer_type(values)
+        if type != Field.STRING and len(values):
+            typed = True
+            if not pandas.isnull(first[column]) and \
+                    _infer_type(pandas.Series([str(first[column]).strip()])) != type:
+                return True
+
+    if typed or text is None:
+        return not typed
+
+    try:
+        return csv.Sniffer().has_header(text[:65536])
+    except csv.Error:
+        return True
@@ -0,0 +1,408 @@
+import os
+import sys
+import time
+import tempfile
+import ujson as json
+
+from collections import OrderedDict
+
+from datamonkey.helpers import get_file_size, check_S3_path
+
+
+class ProcessingStats:
+    """ Counts and timings of one chunk, or of a whole run (the sum of its chunks). """
+
+    def __init__(self, index=None):
+        self.index = index  # position of the chunk in the run, None for the run itself
+        self.chunks = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.warnings = 0
+        self.errors = 0
+        self.bytes_read = 0  # size of the source files, only known for the whole run
+        self.bytes_written = 0  # growth of the output file (local files only)
+        self.peak_memory = None  # bytes: peak RSS of the process, or peak traced allocations if memory is traced
+        self.stage_seconds = {}  # wall time spent in each stage (RETRIEVE_DATA, MAP, VALIDATE, TRANSFORM, ...)
+        self.seconds = 0.0  # wall time of the chunk or run
+        self.succeeded = None  # runs only: whether the run completed
+
+    @property
+    def filtered(self):
+        """ rows dropped because of missing values or by filters """
+        return self.rows_in - self.rows_out
+
+    @property
+    def rows_per_second(self):
+        return self.rows_in / self.seconds if self.seconds else 0.0
+
+    def add(self, chunk):
+        self.chunks += 1
+        self.rows_in += chunk.rows_in
+        self.rows_out += chunk.rows_out
+        self.warnings += chunk.warnings
+        self.errors += chunk.errors
+        self.bytes_written += chunk.bytes_written
+        self.peak_memory = chunk.peak_memory
+        for stage, seconds in chunk.stage_seconds.items():
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def to_dict(self):
+        return {"index": self.index,
+                "chunks": self.chunks,
+                "rows_in": self.rows_in,
+                "rows_out": self.rows_out,
+                "filtered": self.filtered,
+                "warnings": self.warnings,
+                "errors": self.errors,
+                "bytes_read": self.bytes_read,
+                "bytes_written": self.bytes_written,
+                "peak_memory": self.peak_memory,
+                "stage_seconds": dict(self.stage_seconds),
+                "seconds": self.seconds,
+                "rows_per_second": self.rows_per_second,
+                "succeeded": self.succeeded}
+
+
+class Listener:
+    """ Receives the statistics of a FileProcessor as it runs; override the methods you need. """
+
+    def on_chunk(self, processor, chunk):
+        """ called after each chunk is written, with the chunk's ProcessingStats """
+        pass
+
+    def on_run(self, processor, run):
+        """ called when a run completes or fails, with the ProcessingStats of the whole run """
+        pass
+
+
+class Instrumentation:
+    """
+    Collects the statistics of a processor's runs for its listeners. It's only created once a listener is added, so
+    processors without listeners don't pay for timing; with listeners the cost is a few clock reads per chunk.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.listeners = []
+        self.trace_memory = trace_memory  # use tracemalloc for peak memory, slows down allocations noticeably
+
+        self.run = None
+        self.chunk = None
+        self._stage = None
+        self._stage_started = None
+        self._run_started = None
+        self._chunk_started = None
+        self._baseline = None
+
+    def enter_stage(self, stage):
+        """ attributes the time since the last stage change to the stage that's being left """
+        now = time.perf_counter()
+        if self._stage is not None and self.run is not None:
+            stats = self.chunk if self.chunk is not None else self.run
+            stats.stage_seconds[self._stage] = stats.stage_seconds.get(self._stage, 0.0) + now - self._stage_started
+
+        self._stage = stage
+        self._stage_started = now
+
+    def start_run(self, processor):
+        if self.trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+        self.run = ProcessingStats()
+        self.run.bytes_read = self._source_size(processor)
+        self.chunk = None
+        self._run_started = time.perf_counter()
+        self._stage_started = self._run_started
+
+    def start_chunk(self, processor):
+        self.chunk = ProcessingStats(self.run.chunks)
+        self._chunk_started = time.perf_counter()
+        self._baseline = (processor.error_log.total_warnings, processor.error_log.total_errors,
+                          self._output_size(processor))
+
+    def finish_chunk(self, processor, rows_in, rows_out):
+        self.enter_stage(self._stage)  # closes the time of the current stage
+        chunk = self.chunk
+
+        chunk.rows_in = rows_in
+        chunk.rows_out = rows_out
+        chunk.warnings = processor.error_log.total_warnings - self._baseline[0]
+        chunk.errors = processor.error_log.total_errors - self._baseline[1]
+        chunk.bytes_written = self._output_size(processor) - self._baseline[2]
+        chunk.peak_memory = self._peak_memory()
+        chunk.seconds = time.perf_counter() - self._chunk_started
+
+        self.run.add(chunk)
+        self.run.seconds = time.perf_counter() - self._run_started  # so far
+        self.chunk = None
+        for listener in self.listeners:
+            listener.on_chunk(processor, chunk)
+
+    def cancel_chunk(self):
+        """ the source ran out of data, the chunk's time (reading) counts towards the run """
+        if self.chunk is not None:
+            for stage, seconds in self.chunk.stage_seconds.items():
+                self.run.stage_seconds[stage] = self.run.stage_seconds.get(stage, 0.0) + seconds
+        self.chunk = None
+
+    def finish_run(self, processor, succeeded):
+        if self.run is None:
+            return
+
+        self.chunk = None
+        self.enter_stage(self._stage)
+        run = self.run
+        run.succeeded = succeeded
+        run.peak_memory = self._peak_memory()
+        run.seconds = time.perf_counter() - self._run_started
+
+        self.run = None
+        for listener in self.listeners:
+            listener.on_run(processor, run)
+
+    def _peak_memory(self):
+        if self.trace_memory:
+            import tracemalloc
+            return tracemalloc.get_traced_memory()[1]
+
+        try:
+            import resource
+        except ImportError:
+            return None  # not available on Windows
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # kilobytes on Linux, bytes on macOS
+
+    @staticmethod
+    def _source_size(processor):
+        size = 0
+        for source_file in processor.source_files:
+            path = getattr(source_file, "_file_path", None)
+            if path:
+                size += get_file_size(path, source_file.s3_path)
+        return size
+
+    @staticmethod
+    def _output_size(processor):
+        path = getattr(processor.output_file, "_file_path", None)
+        if not path or check_S3_path(path) or not os.path.isfile(path):
+            return 0
+        return os.path.getsize(path)
+
+
+class PrometheusExporter(Listener):
+    """
+    Writes the statistics of the current (or last) run to a file in the Prometheus text format, for the node
+    exporter's textfile collector. The file is updated after every chunk and replaced atomically.
+    """
+
+    # statistic, metric name and description
+    METRICS = (("rows_in", "rows_in", "Rows read from the source files."),
+               ("rows_out", "rows_out", "Rows written to the output."),
+               ("filtered", "rows_filtered", "Rows dropped because of missing values or by filters."),
+               ("warnings", "warnings", "Warnings found."),
+               ("errors", "errors", "Errors found."),
+               ("bytes_read", "read_bytes", "Size of the source files in bytes."),
+               ("bytes_written", "written_bytes", "Bytes written to the output file."),
+               ("peak_memory", "peak_memory_bytes", "Peak memory use in bytes."),
+               ("seconds", "run_duration_seconds", "Wall time of the run in seconds."),
+               ("rows_per_second", "rows_per_second", "Rows read per second."))
+
+    def __init__(self, file_path, prefix="datamonkey"):
+        self.file_path = os.path.expanduser(file_path)
+        self.prefix = prefix
+
+    def on_chunk(self, processor, chunk):
+        self._write(processor, processor.instrumentation.run, running=True)
+
+    def on_run(self, processor, run):
+        self._write(processor, run, running=False)
+
+    def _write(self, processor, run, running):
+        labels = 'template="%s"' % processor.configuration.id
+        lines = []
+
+        def metric(name, help, value, extra_labels=""):
+            name = "%s_%s" % (self.prefix, name)
+            if not lines or not lines[-1].startswith(name + "{"):
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s gauge" % name)
+            lines.append("%s{%s%s} %s" % (name, labels, extra_labels, repr(float(value))))
+
+        for statistic, name, help in PrometheusExporter.METRICS:
+            value = getattr(run, statistic)
+            if value is not None:
+                metric(name, help, value)
+
+        for stage, seconds in sorted(run.stage_seconds.items()):
+            metric("stage_seconds", "Wall time spent in each stage in seconds.", seconds, ',stage="%s"' % stage)
+
+        metric("running", "1 while a run is in progress.", 1 if running else 0)
+        if not running:
+            metric("last_run_success", "1 if the last run completed.", 1 if run.succeeded else 0)
+            metric("last_run_timestamp_seconds", "Time the last run finished.", time.time())
+
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.file_path)
+
+
+class TransformationProfile:
+    """ Cumulative cost and outcome counts of one transformation of an output field. """
+
+    def __init__(self, field, position, operation):
+        self.field = field
+        self.position = position  # 1-based, the numbering used in the errors file
+        self.operation = operation
+        self.seconds = 0.0
+        self.rows = 0  # values the transformation was evaluated on
+        self.modified = 0
+        self.filtered = 0
+        self.warnings = 0
+        self.errors = 0
+        self.patterns = None  # substring and regex sets: the patterns, and the rows each matched first
+        self.pattern_rows = None
+
+    @property
+    def microseconds_per_row(self):
+        return self.seconds * 1e6 / self.rows if self.rows else 0.0
+
+    def to_dict(self):
+        return {"field": self.field,
+                "position": self.position,
+                "operation": self.operation,
+                "seconds": self.seconds,
+                "rows": self.rows,
+                "microsecondsPerRow": self.microseconds_per_row,
+                "modified": self.modified,
+                "filtered": self.filtered,
+                "warnings": self.warnings,
+                "errors": self.errors,
+                "patterns": OrderedDict(zip(self.patterns, self.pattern_rows)) if self.patterns is not None else None}
+
+
+class TransformationProfiler:
+    """
+    Times every transformation of a template separately and counts the values each one modified, filtered, warned
+    about or failed on, over all the runs of the processor it's attached to. A transformation is only evaluated up to
+    the first one that filters, warns or errors on a value, so later transformations of a field may see fewer rows.
+    Substring and regex sets also count the rows each of their patterns matched, looking the pattern up again.
+    Timing adds two clock reads per transformation and value, so profiled runs are somewhat slower than normal runs.
+    """
+
+    def __init__(self):
+        self.profiles = OrderedDict()  # (output field index, position) -> TransformationProfile
+
+    def wrap(self, field_id, field):
+        """
+        returns a profiled replacement for applying the transformations of an output field to a value, from the
+        (0-based) position start on; rows is the number of rows the value stands for
+        """
+        profiles = [self._profile(field_id, field, position)
+                    for position in range(1, len(field.transformations) + 1)]
+        matchers = [(parameters or {}).get('matcher') for _, parameters in field.operations]
+
+        clock = time.perf_counter
+
+        def do_transformations(target_value, target_transformations, start=0, rows=1):
+            for i, transformation in enumerate(target_transformations, start):
+                profile = profiles[i]
+                profile.rows += rows
+                started = clock()
+                try:
+                    new_value, target_action, target_message = transformation[0](target_value, transformation[1])
+                except Exception as err:
+                    profile.seconds += clock() - started
+                    profile.errors += rows
+                    return target_value, "ERROR", i + 1, repr(err)
+
+                profile.seconds += clock() - started
+                if matchers[i] is not None:
+                    matched = matchers[i].find(target_value)
+                    if matched is not None:
+                        profile.pattern_rows[matched] += rows
+                if _changed(target_value, new_value):
+                    profile.modified += rows
+                target_value = new_value
+
+                if target_action:
+                    if target_action == "FILTER":
+                        profile.filtered += rows
+                    elif target_action == "WARN":
+                        profile.warnings += rows
+                    else:
+                        profile.errors += rows
+                    return target_value, target_action, i + 1, target_message
+
+            return target_value, None, None, None
+
+        return do_transformations
+
+    def record(self, field_id, field, position, rows, seconds, modified=0, filtered=0, warnings=0, errors=0):
+        """ adds the timing and counts of a transformation applied to a whole column at once """
+        profile = self._profile(field_id, field, position)
+        profile.rows += rows
+        profile.seconds += seconds
+        profile.modified += modified
+        profile.filtered += filtered
+        profile.warnings += warnings
+        profile.errors += errors
+
+    def _profile(self, field_id, field, position):
+        key = (field_id, position)
+        if key not in self.profiles:
+            profile = TransformationProfile(field.name, position, field.transformations[position - 1].operation)
+            parameters = field.operations[position - 1][1] or {}
+            if parameters.get('matcher') is not None:
+                profile.patterns = list(parameters['patterns'].keys)
+                profile.pattern_rows = [0] * len(profile.patterns)
+            self.profiles[key] = profile
+        return self.profiles[key]
+
+    def report(self, limit=None):
+        """ Returns the profiles as dictionaries, most expensive first, with their share of the total time. """
+        total = sum(profile.seconds for profile in self.profiles.values())
+        ranked = sorted(self.profiles.values(), key=lambda profile: profile.seconds, reverse=True)[:limit]
+
+        report = []
+        for rank, profile in enumerate(ranked, 1):
+            entry = profile.to_dict()
+            entry["rank"] = rank
+            entry["share"] = profile.seconds / total if total else 0.0
+            report.append(entry)
+        return report
+
+    def print_report(self, limit=20):
+        print("\n*****  Transformation Profile *****")
+        print("%4s  %-20s %3s  %-26s %10s %7s %9s %8s %8s %8s %8s" %
+              ("Rank", "Field", "#", "Operation", "Seconds", "Share", "Rows", "us/Row", "Modified", "Filtered",
+               "Warn/Err"))
+        for entry in self.report(limit):
+            print("%4d  %-20s %3d  %-26s %10.6f %6.1f%% %9d %8.2f %8d %8d %8s" %
+                  (entry["rank"], entry["field"][:20], entry["position"], entry["operation"], entry["seconds"],
+                   entry["share"] * 100, entry["rows"], entry["microsecondsPerRow"], entry["modified"],
+                   entry["filtered"], "%d/%d" % (entry["warnings"], entry["errors"])))
+
+    def to_json(self, file_path=None):
+        """ Returns the ranked report as JSON, and writes it to file_path if one is given. """
+        report = json.dumps(self.report(), indent=2)
+        if file_path:
+            with open(os.path.expanduser(file_path), "w") as file:
+                file.write(report)
+        return report
+
+    def reset(self):
+        self.profiles.clear()
+
+
+def _changed(old_value, new_value):
+    """ whether a transformation modified a value; values that can't be compared count as modified """
+    if old_value is new_value:
+        return False
+    try:
+        return bool(old_value != new_value)
+    except (TypeError, ValueError):
+        return True
@@ -0,0 +1,354 @@
+import os
+import sys
+import io
+import csv
+import array
+import bisect
+import ujson as json
+
+from datamonkey.helpers import check_S3_path, LazyModule
+from datamonkey.settings import DMK_TYPE_MAP
+
+numpy = LazyModule("numpy")
+
+
+class ErrorLog:
+    """
+    Compact store for the errors and warnings generated while processing a file. Each problem is kept as one entry
+    in a set of parallel arrays (severity, code, row index, field id, transformation number and detail id); messages
+    are only formatted when they're read or written to the errors file.
+    """
+
+    ERROR, WARNING = (1, 2)
+    SEVERITY_NAMES = {ERROR: "ERROR", WARNING: "WARNING"}
+
+    # Error codes
+    MISSING_VALUE, INVALID_DATE, INVALID_TYPE, TRANSFORMATION, ANOMALY = (1, 2, 3, 4, 5)
+    CODE_NAMES = {MISSING_VALUE: "MISSING_VALUE", INVALID_DATE: "INVALID_DATE", INVALID_TYPE: "INVALID_TYPE",
+                  TRANSFORMATION: "TRANSFORMATION", ANOMALY: "ANOMALY"}
+
+    # Errors file formats, chosen by the extension of the errors file
+    TEXT, CSV, JSONL = ("TEXT", "CSV", "JSONL")
+    file_formats = {".csv": CSV, ".json": JSONL, ".jsonl": JSONL, ".ldjson": JSONL}
+    csv_columns = ["severity", "code", "field", "location", "transformation", "message"]
+
+    def __init__(self, fields, location_terms, max_errors=None):
+        self.fields = fields  # output fields, referenced by position
+        self.location_terms = location_terms  # 'Row' or 'Object' for each output field
+        self.max_errors = max_errors  # maximum number of errors and warnings kept in detail
+
+        self.file_path = None
+        self.file_format = ErrorLog.TEXT
+        self._file = None
+
+        # rows of coalesced inputs: the first row index and the name of each input, locations are reported per input
+        self.origin_offsets = None
+        self.origin_names = None
+
+        self.reset()
+
+    def __len__(self):
+        return len(self._codes)
+
+    @property
+    def total_errors(self):
+        return self._totals[ErrorLog.ERROR]
+
+    @property
+    def total_warnings(self):
+        return self._totals[ErrorLog.WARNING]
+
+    @property
+    def truncated(self):
+        """ the number of errors and warnings that were counted but not kept in detail """
+        return self.total_errors + self.total_warnings - len(self) - self._resumed
+
+    @property
+    def errors(self):
+        return [self.format(i) for i in range(len(self)) if self._severities[i] == ErrorLog.ERROR]
+
+    @property
+    def warnings(self):
+        return [self.format(i) for i in range(len(self)) if self._severities[i] == ErrorLog.WARNING]
+
+    def reset(self):
+        self._severities = array.array('b')
+        self._codes = array.array('b')
+        self._rows = array.array('q')
+        self._field_ids = array.array('i')
+        self._transformations = array.array('h')
+        self._detail_ids = array.array('i')
+
+        self._details = []  # interned message details (or row index arrays for missing values)
+        self._detail_lookup = {}
+        self._totals = {ErrorLog.ERROR: 0, ErrorLog.WARNING: 0}
+        self._written = 0
+        self._resumed = 0  # entries kept before resuming from a checkpoint, they're only in the errors file
+
+    def add(self, severity, code, field_id, rows, details=None, transformations=None):
+        """
+        Records one problem per row. details and transformations can be a single value shared by all rows or a
+        sequence with one value per row.
+        """
+        count = len(rows)
+        self._totals[severity] += count
+
+        count = min(count, self._room())
+        if count <= 0:
+            return
+
+        self._severities.extend([severity] * count)
+        self._codes.extend([code] * count)
+        self._field_ids.extend([field_id] * count)
+        self._rows.frombytes(numpy.asarray(rows[:count], dtype=numpy.int64).tobytes())
+
+        if transformations is None or isinstance(transformations, int):
+            self._transformations.extend([transformations or 0] * count)
+        else:
+            self._transformations.extend(transformations[:count])
+
+        if details is None or isinstance(details, str):
+            self._detail_ids.extend([self._intern(details)] * count)
+        else:
+            self._detail_ids.extend(self._intern(detail) for detail in details[:count])
+
+    def add_missing_values(self, field_id, rows):
+        """ Records a single warning for all rows of a field that were skipped because of missing values. """
+        self._totals[ErrorLog.WARNING] += 1
+
+        if self._room() <= 0:
+            return
+
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        self._severities.append(ErrorLog.WARNING)
+        self._codes.append(ErrorLog.MISSING_VALUE)
+        self._field_ids.append(field_id)
+        self._rows.append(int(rows[0]) if len(rows) else -1)
+        self._transformations.append(0)
+        self._detail_ids.append(len(self._details))
+        self._details.append(rows)
+
+    def partition(self, offsets, max_errors=None):
+        """
+        Splits the entries between consecutive row ranges, each starting at one of the (ascending) offsets, and
+        returns one log per range with its rows renumbered from the start of the range, keeping at most max_errors
+        entries in detail in each. Only entries kept in detail can be split.
+        """
+        logs = [ErrorLog(self.fields, self.location_terms, max_errors) for _ in offsets]
+
+        for i in range(len(self)):
+            field_id = self._field_ids[i]
+            detail = self._details[self._detail_ids[i]] if self._detail_ids[i] >= 0 else None
+
+            if self._codes[i] == ErrorLog.MISSING_VALUE:
+                owners = numpy.searchsorted(offsets, detail, side="right") - 1
+                for owner in numpy.unique(owners):
+                    logs[owner].add_missing_values(field_id, detail[owners == owner] - offsets[owner])
+            else:
+                owner = bisect.bisect_right(offsets, self._rows[i]) - 1
+                logs[owner].add(self._severities[i], self._codes[i], field_id, [self._rows[i] - offsets[owner]],
+                                detail, self._transformations[i])
+
+        return logs
+
+    def _room(self):
+        if self.max_errors is None:
+            return sys.maxsize
+
+        return self.max_errors - len(self._codes) - self._resumed
+
+    def _intern(self, detail):
+        if detail is None:
+            return -1
+
+        detail = str(detail)
+        detail_id = self._detail_lookup.get(detail)
+        if detail_id is None:
+            detail_id = len(self._details)
+            self._detail_lookup[detail] = detail_id
+            self._details.append(detail)
+
+        return detail_id
+
+    def record(self, i):
+        """ Returns entry i as a dictionary of its structured values and formatted message. """
+        transformation = self._transformations[i]
+        return {"severity": ErrorLog.SEVERITY_NAMES[self._severities[i]],
+                "code": ErrorLog.CODE_NAMES[self._codes[i]],
+                "field": self.fields[self._field_ids[i]].name,
+                "location": self._location(i),
+                "transformation": transformation if transformation else None,
+                "message": self.format(i)}
+
+    def format(self, i):
+        """ Formats entry i into a readable message. """
+        code = self._codes[i]
+        field = self.fields[self._field_ids[i]]
+        detail = self._details[self._detail_ids[i]] if self._detail_ids[i] >= 0 else None
+
+        if code == ErrorLog.MISSING_VALUE:
+            return "Missing values found in field '%s' for %s. These rows will be skipped in the output. " \
+                   "If missing values should be allowed (or replaced) for this field, please alter your " \
+                   "file template." % (field.name, self._location(i))
+
+        elif code == ErrorLog.INVALID_DATE:
+            return "Could not coerce the value '%s' into a date or datetime for field '%s' (%s)." % \
+                   (detail, field.name, self._location(i))
+
+        elif code == ErrorLog.INVALID_TYPE:
+            return "Could not coerce the value '%s' into a %s for field '%s' (%s)." % \
+                   (detail, DMK_TYPE_MAP[field.type], field.name, self._location(i))
+
+        elif code == ErrorLog.TRANSFORMATION:
+            return "'%s', %s, transformation #%d: %s." % \
+                   (field.name, self._location(i), self._transformations[i], detail)
+
+        elif code == ErrorLog.ANOMALY:
+            return "'%s', %s: %s." % (field.name, self._location(i), detail)
+
+    def _location(self, i):
+        term = self.location_terms[self._field_ids[i]]
+
+        if self._codes[i] == ErrorLog.MISSING_VALUE:
+            rows = self._details[self._detail_ids[i]]
+            if self.origin_offsets is None:
+                return "%s(s): %s" % (term, ", ".join(str(row + 1) for row in rows))
+
+            owners = numpy.searchsorted(self.origin_offsets, rows, side="right") - 1
+            return "%s(s): %s" % (term, "; ".join(
+                "%s of %s" % (", ".join(str(row - self.origin_offsets[owner] + 1) for row in rows[owners == owner]),
+                              self.origin_names[owner])
+                for owner in numpy.unique(owners)))
+
+        if self.origin_offsets is None:
+            return "%s %d" % (term, self._rows[i] + 1)
+
+        owner = bisect.bisect_right(self.origin_offsets, self._rows[i]) - 1
+        return "%s %d of %s" % (term, self._rows[i] - self.origin_offsets[owner] + 1, self.origin_names[owner])
+
+    # *** Errors File ***
+
+    def open(self, file_path):
+        """ Sets the errors file that entries are streamed to; the file is only created once there's something to write. """
+        self.close()
+        self.file_path = file_path
+        self.file_format = ErrorLog.file_formats.get(os.path.splitext(file_path)[1].lower(), ErrorLog.TEXT)
+
+    def write(self):
+        """ Appends all entries that haven't been written yet to the errors file. """
+        if self.file_path is None or self._written == len(self):
+            return
+
+        if self._file is None:
+            self._open_file()
+
+        output = io.StringIO()
+        if self.file_format == ErrorLog.CSV:
+            writer = csv.DictWriter(output, fieldnames=ErrorLog.csv_columns, lineterminator="\n")
+            for i in range(self._written, len(self)):
+                writer.writerow(self.record(i))
+
+        elif self.file_format == ErrorLog.JSONL:
+            for i in range(self._written, len(self)):
+                output.write(json.dumps(self.record(i)) + "\n")
+
+        else:
+            for i in range(self._written, len(self)):
+                output.write("[%s] %s\n" % (ErrorLog.SEVERITY_NAMES[self._severities[i]], self.format(i)))
+
+        self._file.write(output.getvalue().encode())
+        self._file.flush()
+        self._written = len(self)
+
+    def close(self):
+        """ Writes any remaining entries plus a summary of the totals and closes the errors file. """
+        if self.file_path is None:
+            return
+
+        self.write()
+
+        if self._file is None and self.truncated:
+            # every entry was truncated, the summary is still worth writing
+            self._open_file()
+
+        if self._file is not None:
+            if self.file_format == ErrorLog.TEXT:
+                summary = "\n***** %d ERRORS, %d WARNINGS *****\n" % (self.total_errors, self.total_warnings)
+                if self.truncated:
+                    summary += "%d additional errors and warnings were not recorded (max errors: %d).\n" % \
+                               (self.truncated, self.max_errors)
+                self._file.write(summary.encode())
+
+            elif self.file_format == ErrorLog.JSONL:
+                summary = {"severity": "SUMMARY", "errors": self.total_errors, "warnings": self.total_warnings,
+                           "truncated": self.truncated}
+                self._file.write((json.dumps(summary) + "\n").encode())
+
+            self._file.close()
+
+        self._file = None
+        self.file_path = None
+
+    def checkpoint(self):
+        """ Returns the state needed to continue the log (and its errors file) after a restart. """
+        self.write()
+        return {"errors": self.total_errors,
+                "warnings": self.total_warnings,
+                "kept": len(self) + self._resumed,
+                "length": self._file.tell() if self._file is not None else 0}
+
+    def resume(self, state):
+        """ Continues from a checkpoint: restores the totals and truncates the errors file to its checkpointed length. """
+        self._totals = {ErrorLog.ERROR: state["errors"], ErrorLog.WARNING: state["warnings"]}
+        self._resumed = state["kept"]
+
+        if self.file_path is None or not os.path.isfile(self.file_path):
+            return
+
+        if check_S3_path(self.file_path):
+            raise ValueError("Errors files on S3 can't be resumed; please process the file again.")
+
+        if state["length"]:
+            with open(self.file_path, "r+b") as file:
+                file.truncate(state["length"])
+            self._file = open(self.file_path, "ab")
+        else:
+            os.remove(self.file_path)
+
+    def _open_file(self):
+        if check_S3_path(self.file_path):
+            import s3fs
+            fs = s3fs.S3FileSystem()
+            self._file = fs.open(self.file_path, "wb")
+        else:
+            self._file = open(self.file_path, "wb")
+
+        if self.file_format == ErrorLog.CSV:
+            self._file.write((",".join(ErrorLog.csv_columns) + "\n").encode())
+
+
+class ValidationSummary:
+    """ Outcome of FileProcessor.validate(): whether the data passed and the errors and warnings that were found. """
+
+    def __init__(self, error_log, rows_read, stopped_early):
+        self.valid = error_log.total_errors == 0
+        self.rows_read = rows_read  # rows read before validation finished or stopped
+        self.stopped_early = stopped_early  # True if reading stopped before the end of the data
+        self.total_errors = error_log.total_errors
+        self.total_warnings = error_log.total_warnings
+        self.truncated = error_log.truncated
+        self.errors = error_log.errors
+        self.warnings = error_log.warnings
+
+    def __bool__(self):
+        return self.valid
+
+    def to_dict(self):
+        return {"valid": self.valid,
+                "rows_read": self.rows_read,
+                "stopped_early": self.stopped_early,
+                "total_errors": self.total_errors,
+                "total_warnings": self.total_warnings,
+                "truncated": self.truncated,
+                "errors": self.errors,
+                "warnings": self.warnings}
@@ -1,12 +1,16 @@
-import pandas
-import numpy
 import ujson as json
-import requests
 import os
 import io
+import pickle
+import struct
+import hashlib
+import tempfile
 
-from datamonkey.settings import BASE_API_URL
-from datamonkey.helpers import validate_file_exists, check_S3_path
+from datamonkey.helpers import validate_file_exists, check_S3_path, LazyModule
+from datamonkey.templates import TemplateCache
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
 
 
 class File:
@@ -57,36 +61,79 @@ class File:
 
 class SourceFile(File):
 
-    def __init__(self, type, file_index, hasHeader=False, lineDelimitedJSON=False, sheetName="", skipRows=0, **kwargs):
+    def __init__(self, type, file_index, hasHeader=False, lineDelimitedJSON=False, sheetName="", skipRows=0, delimiter=",", **kwargs):
         super(SourceFile, self).__init__(type, hasHeader, lineDelimitedJSON, sheetName, skipRows)
         self.file_index = file_index
+        self.delimiter = delimiter  # CSV: delimiter used in the file
         self.generator = None
         self.start_index = 1 + skipRows + (1 if hasHeader else 0)
 
     def _validate(self):
         super(SourceFile, self)._validate()
 
-    def process_file(self, source_fields, chunk_data=False):
+    def process_file(self, source_fields, chunk_data=False, used_fields=None, start_row=0, nrows=None, skip_row=None):
+        """
+        used_fields optionally overrides each field's 'used' flag with the exact set of fields that must be read.
+        start_row skips that many data rows of chunked (CSV & FWF) files while parsing, e.g. when resuming.
+        nrows stops reading after that many data rows (after the skipped ones). skip_row(row) is called with the
+        0-based number of each data row of CSV & FWF files, which is left out while parsing if it returns True.
+        """
         if self.type == File.CSV:
-            return self._process_csv_file(source_fields, chunk_data)
+            return self._process_csv_file(source_fields, chunk_data, used_fields, start_row, nrows, skip_row)
         elif self.type == File.JSON:
-            return self._process_json_file(source_fields)
+            return self._process_json_file(source_fields, used_fields, nrows)
         elif self.type == File.EXCEL:
-            return self._process_excel_file(source_fields)
+            return self._process_excel_file(source_fields, used_fields, nrows)
         elif self.type == File.FWF:
-            return self._process_fixed_width_file(source_fields, chunk_data)
+            return self._process_fixed_width_file(source_fields, chunk_data, used_fields, start_row, nrows, skip_row)
 
-    def _process_csv_file(self, source_fields, chunk_data=False):
+    @staticmethod
+    def _is_used(field, used_fields):
+        return field.used if used_fields is None else field in used_fields
+
+    def _skip_rows(self, start_row, skip_row=None):
         """
-        Processes a CSV file using supplied configuration. Parses the file into a pandas dataframe for additional
-        processing.
+        the skiprows argument for the readers: leading rows, plus the first start_row data rows if set and the data
+        rows skip_row leaves out
         """
-        columns = pandas.read_csv(self.file_path,
-                                  nrows=1,
-                                  skiprows=self.skip_rows).columns
+        if not start_row and skip_row is None:
+            return self.skip_rows
 
+        first = self.skip_rows + (1 if self.has_header else 0)
+
+        def skip(line):
+            if line < first:
+                return line < self.skip_rows
+            return line < first + start_row or skip_row is not None and skip_row(line - first)
+        return skip
+
+    def _read_columns(self, widths=None):
+        """ the columns of the first row of a CSV or FWF file (its header if it has one) """
+        if self.type == File.FWF:
+            return pandas.read_fwf(self.file_path,
+                                   widths=widths,
+                                   nrows=1,
+                                   skiprows=self.skip_rows).columns
+
+        return pandas.read_csv(self.file_path,
+                               nrows=1,
+                               sep=self.delimiter,
+                               skiprows=self.skip_rows).columns
+
+    @staticmethod
+    def _widths(source_fields):
+        if source_fields:
+            # pandas has some weird issues with the colspecs list based on testing... use field widths instead
+            return [(field.col_specs[1] - field.col_specs[0] + 1) for field in source_fields]
+        return None
+
+    def _select_columns(self, columns, source_fields, used_fields=None):
+        """
+        Checks the columns of a CSV or FWF file against the source fields (generated from them if there are none) and
+        returns the fields and the header, names and usecols arguments that read the used ones.
+        """
         if source_fields is None:
-            # Generate fields from data in first row.
+            # Generate fields from data in first row, used when running reports.
             if self.has_header:
                 source_fields = [SourceField(column, True, self.file_index) for column in columns]
             else:
@@ -105,29 +152,94 @@ class SourceFile(File):
                     raise ValueError("Expected header field '%s' was not found in the file. "
                                      "If this field is no longer required, please update the file template." % field.name)
 
-            use_cols = [field.name for field in source_fields if field.used]
+            use_cols = [field.name for field in source_fields if self._is_used(field, used_fields)]
 
         else:
             header = None
-            use_cols = [i for i, field in enumerate(source_fields) if field.used]
+            use_cols = [i for i, field in enumerate(source_fields) if self._is_used(field, used_fields)]
             names = ["Column %d" % (i + 1) for i in use_cols]
 
+        return source_fields, header, names, use_cols
+
+    def read_records(self, source_fields, used_fields=None, offset=0):
+        """
+        Reads a CSV, FWF or line delimited JSON file with a RecordReader, which parses each chunk of records on its own
+        and knows the byte offset it got to: a reader started at an offset recorded earlier doesn't parse the rows
+        before it. offset 0 starts at the first data row.
+        """
+        from datamonkey.sources import RecordReader
+
+        if self.type == File.JSON:
+            used_field_names = [field.name for field in source_fields if self._is_used(field, used_fields)]
+
+            def parse(data):
+                chunk = pandas.read_json(io.StringIO(data.decode("utf-8")), lines=True)
+                for name in used_field_names:
+                    if name not in chunk.columns:
+                        # treat missing keys as a column of nulls
+                        chunk[name] = ""
+                return chunk[used_field_names]
+
+            return RecordReader(self.file_path, parse, offset)
+
+        widths = self._widths(source_fields) if self.type == File.FWF else None
+        columns = self._read_columns(widths)
+        source_fields, header, names, use_cols = self._select_columns(columns, source_fields, used_fields)
+        if header == 0:
+            # the header isn't part of the chunks, its columns name every column
+            names = list(columns)
+
+        if self.type == File.FWF:
+            def parse(data):
+                return pandas.read_fwf(io.BytesIO(data), widths=widths, header=None, names=names, usecols=use_cols)
+            delimiter = None
+        else:
+            def parse(data):
+                return pandas.read_csv(io.BytesIO(data), sep=self.delimiter, header=None, names=names,
+                                       usecols=use_cols)
+            delimiter = self.delimiter
+
+        preamble = self.skip_rows + (1 if self.has_header else 0)
+        return RecordReader(self.file_path, parse, offset, preamble, delimiter)
+
+    def _process_csv_file(self, source_fields, chunk_data=False, used_fields=None, start_row=0, nrows=None,
+                          skip_row=None):
+        """
+        Processes a CSV file using supplied configuration. Parses the file into a pandas dataframe for additional
+        processing.
+        """
+        columns = self._read_columns()
+        source_fields, header, names, use_cols = self._select_columns(columns, source_fields, used_fields)
+
         return pandas.read_csv(self.file_path,
+                               sep=self.delimiter,
                                header=header,
                                usecols=use_cols,
                                names=names,
-                               skiprows=self.skip_rows,
+                               skiprows=self._skip_rows(start_row, skip_row),
+                               nrows=nrows,
                                chunksize=100000 if chunk_data else None), source_fields
 
-    def _process_json_file(self, source_fields):
+    def _process_json_file(self, source_fields, used_fields=None, nrows=None):
         """
         Processes a JSON file using supplied configuration. Parses the file into a pandas dataframe for additional
         processing.
         """
 
         try:
-            data = pandas.read_json(self.file_path,
-                                    self.line_delimited_JSON)
+            if nrows is not None and self.line_delimited_JSON:
+                # only the lines up to nrows are parsed
+                data = []
+                for chunk in pandas.read_json(self.file_path, lines=True, chunksize=min(nrows, 100000) or 1):
+                    data.append(chunk)
+                    if sum(len(chunk) for chunk in data) >= nrows:
+                        break
+                data = pandas.concat(data).iloc[:nrows] if data else pandas.DataFrame()
+            else:
+                data = pandas.read_json(self.file_path,
+                                        lines=self.line_delimited_JSON)
+                if nrows is not None:
+                    data = data.iloc[:nrows]
 
             if source_fields is None:
                 # generate fields from column keys
@@ -140,78 +252,47 @@ class SourceFile(File):
                 json.load(file)
             raise ValueError("Invalid JSON encountered in file: %s" % self.file_path)  # fallback error if json loads correctly in SimpleJson but not Pandas
 
-        used_fields = [field for field in source_fields if field.used]
+        used_field_names = [field.name for field in source_fields if self._is_used(field, used_fields)]
 
-        for field in used_fields:
-            if field.name not in list(data.columns):
+        for name in used_field_names:
+            if name not in list(data.columns):
                 # treat missing keys as a column of nulls
-                data[field.name] = ""
+                data[name] = ""
 
-        unused_field_names = [field.name for field in source_fields if not field.used]
-        data.drop(columns=unused_field_names)
+        # JSON can't be projected while parsing, so keys that aren't needed are released right after reading
+        data = data[used_field_names]
 
         return data, source_fields
 
-    def _process_fixed_width_file(self, source_fields, chunk_data=False):
+    def _process_fixed_width_file(self, source_fields, chunk_data=False, used_fields=None, start_row=0, nrows=None,
+                                  skip_row=None):
         """
         Processes a flat file using supplied configuration. Parses the file into a pandas dataframe for additional
         processing.
         """
-        if source_fields:
-            # pandas has some weird issues with the colspecs list based on testing... use field widths instead
-            widths = [(field.col_specs[1] - field.col_specs[0] + 1) for field in source_fields]
-        else:
-            widths = None
-
-        columns = pandas.read_fwf(self.file_path,
-                                  widths=widths,
-                                  nrows=1,
-                                  skiprows=self.skip_rows).columns
-
-        if source_fields is None:
-            # Generate fields from data in first row, used when running reports.
-            if self.has_header:
-                source_fields = [SourceField(column, True, self.file_index) for column in columns]
-            else:
-                source_fields = [SourceField("Column %d" % (i + 1), True, self.file_index) for i, column in enumerate(columns)]
-
-        if len(columns) != len(source_fields):
-            raise ValueError(("%d fields were expected in the file, but only %d were found. \n"
-                              "If the input file format has changed, please update your file template.") %
-                             (len(source_fields), len(columns)))
-
-        if self.has_header:
-            header = 0
-            names = None
-            for field in source_fields:
-                if field.name not in columns:
-                    raise ValueError("Expected header field '%s' was not found in the file. "
-                                     "If this field is no longer required, please update the file template." % field.name)
-
-            use_cols = [field.name for field in source_fields if field.used]
-
-        else:
-            header = None
-            use_cols = [i for i, field in enumerate(source_fields) if field.used]
-            names = ["Column %d" % (i + 1) for i in use_cols]
+        widths = self._widths(source_fields)
+        columns = self._read_columns(widths)
+        source_fields, header, names, use_cols = self._select_columns(columns, source_fields, used_fields)
 
         return pandas.read_fwf(self.file_path,
                                widths=widths,
                                header=header,
                                names=names,
-                               use_cols=use_cols,
+                               usecols=use_cols,
                                chunksize=100000 if chunk_data else None,
-                               skiprows=self.skip_rows), source_fields
+                               nrows=nrows,
+                               skiprows=self._skip_rows(start_row, skip_row)), source_fields
 
-    def _process_excel_file(self, source_fields):
+    def _process_excel_file(self, source_fields, used_fields=None, nrows=None):
         """
         Processes an excel using supplied configuration. Parses the file into a pandas dataframe for additional
         processing.
         """
-        columns = pandas.read_excel(self.file_path,
-                                    nrows=1,
-                                    sheet_name=self.sheet_name,
-                                    skiprows=self.skip_rows).columns
+        # the workbook is loaded once, for reading the header and the data
+        workbook = pandas.ExcelFile(self.file_path)
+        columns = workbook.parse(nrows=1,
+                                 sheet_name=self.sheet_name,
+                                 skiprows=self.skip_rows).columns
 
         if source_fields is None:
             # Generate fields from data in first row.
@@ -234,25 +315,25 @@ class SourceFile(File):
                     raise ValueError("A column with header '%s' is expected but not found in the file. "
                                      "If this field is no longer required, please update the file template." % field.name)
 
-            use_cols = [columns.tolist().index(field.name) for field in source_fields if field.used]
-            data = pandas.read_excel(self.file_path,
-                                     header=header,
-                                     usecols=use_cols,
-                                     sheet_name=self.sheet_name,
-                                     skiprows=self.skip_rows)
+            use_cols = [columns.tolist().index(field.name) for field in source_fields if self._is_used(field, used_fields)]
+            data = workbook.parse(header=header,
+                                  usecols=use_cols,
+                                  sheet_name=self.sheet_name,
+                                  nrows=nrows,
+                                  skiprows=self.skip_rows)
 
         else:
             header = None
-            use_cols = [i for i, field in enumerate(source_fields) if field.used]
+            use_cols = [i for i, field in enumerate(source_fields) if self._is_used(field, used_fields)]
             names = ["Column %d" % (i + 1) for i in use_cols]
 
-            data = pandas.read_excel(self.file_path,
-                                     header=header,
-                                     names=names,
-                                     usecols=use_cols,
-                                     sheet_name=self.sheet_name,
-                                     parse_dates=False,
-                                     skiprows=self.skip_rows)
+            data = workbook.parse(header=header,
+                                  names=names,
+                                  usecols=use_cols,
+                                  sheet_name=self.sheet_name,
+                                  parse_dates=False,
+                                  nrows=nrows,
+                                  skiprows=self.skip_rows)
 
         return data, source_fields
 
@@ -263,7 +344,10 @@ class OutputFile(File):
     def data(self):
         if self._data is None:
             return ValueError("You must successfully process a file before accessing the output data.")
-        return self._data.to_dict("records")
+
+        # columns keep their native dtypes until now, so nulls are rendered with the requested python value
+        data = self._data.astype(object).where(self._data.notnull(), self.python_null)
+        return data.to_dict("records")
 
     NONE, GZIP, BZ2, ZIP, XZ = ('none', 'gzip', 'bz2', 'zip', 'xz')
 
@@ -275,7 +359,11 @@ class OutputFile(File):
         self.index_rows = indexRows  # EXCEL/CSV: whether or not to show the row index in the output
         self.indent = indent  # JSON: how many spaces will be used to indent the file. Defaults to 2, which is human-readable.
         self.fwf_format = None
+        self.fwf_formats = []  # FWF: format of each individual column, used when a column contains nulls
+        self.fwf_widths = []  # FWF: width of each individual column, nulls are padded with blanks to this width
         self.fwf_header_format = None
+        self.na_rep = ""  # CSV: how null values are rendered in the output
+        self.python_null = None  # PYTHON: value nulls are returned as, either None or numpy.nan
 
         self._data = None
         self._first_write = True
@@ -288,14 +376,27 @@ class OutputFile(File):
             else:
                 self.name = None
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None  # processed data is never part of a compiled template
+        state["_first_write"] = True
+        return state
+
     def _validate(self):
         super(OutputFile, self)._validate()
         self._validate_compression()
+        self.set_python_null(self.python_null)
 
     def _validate_compression(self):
         if self.compression and self.compression not in [OutputFile.GZIP, OutputFile.BZ2, OutputFile.ZIP, OutputFile.XZ]:
             raise ValueError("%s is not a valid compression type." % self.type)
 
+    def set_python_null(self, python_null):
+        """ Sets the value nulls are returned as by PYTHON outputs, either None or numpy.nan. """
+        if python_null is not None and not (isinstance(python_null, float) and numpy.isnan(python_null)):
+            raise ValueError("Null values in PYTHON outputs can only be returned as None or numpy.nan.")
+        self.python_null = python_null
+
     def append_data(self, data):
         """ If a file type can be flushed, e.g. CSVs, data will be None.
             If a file must be written in one go, e.g. Excel, data must be appended.
@@ -331,9 +432,11 @@ class OutputFile(File):
             self._first_write = False
 
         elif self.type == File.JSON:
-            self._flush_json_file()
+            if self._data is not None and len(self._data):
+                # a chunk without rows would leave a dangling comma
+                self._flush_json_file()
+                self._first_write = False
             self.reset_data()
-            self._first_write = False
 
         elif self.type == File.FWF:
             self._flush_fwf_file()
@@ -343,6 +446,22 @@ class OutputFile(File):
     def reset_data(self):
         self._data = None
 
+    def resume(self, length):
+        """ Truncates a partially written output file to the length it had at a checkpoint, so writing can continue. """
+        if self.s3_path:
+            raise ValueError("Output files on S3 can't be resumed; please process the file again.")
+
+        size = os.path.getsize(self.file_path) if os.path.isfile(self.file_path) else 0
+        if size < length:
+            raise ValueError("The output file %s is shorter than it was at the checkpoint; please process the file "
+                             "again." % self.file_path)
+
+        if os.path.isfile(self.file_path):
+            with open(self.file_path, "r+b") as file:
+                file.truncate(length)
+
+        self._first_write = length == 0
+
     def _write_data(self, data, mode="ab", format=None):
         if self.s3_path:
             import s3fs
@@ -368,11 +487,15 @@ class OutputFile(File):
         self._write_data(data.encode())
 
     def _close_json_file(self):
-        data = "\n]" if self.indent else "]"
+        if self._first_write:
+            data = "[]"  # no rows were written
+        else:
+            data = "\n]" if self.indent else "]"
         self._write_data(data.encode())
 
     def _flush_csv_file(self):
         data = self._data.to_csv(sep=self.delimiter,
+                                 na_rep=self.na_rep,
                                  header=(self.has_header and self._first_write),
                                  index=self.index_rows).encode()
         self._write_data(data)
@@ -381,7 +504,25 @@ class OutputFile(File):
         if self._first_write and self.has_header:
             self._write_data([[column for column in self._data.columns]], format=self.fwf_header_format)
 
-        self._write_data(self._data.values, format=self.fwf_format)
+        nulls = self._data.isnull()
+        if not nulls.values.any():
+            self._write_data(self._data.values, format=self.fwf_format)
+            return
+
+        # only columns that contain nulls are rendered as strings; nulls are padded with blanks to the column width
+        formats = list(self.fwf_formats)
+        columns = {}
+        for i, column in enumerate(self._data.columns):
+            col = self._data[column]
+            if nulls[column].any():
+                rendered = col[~nulls[column]].map(lambda value, format=formats[i]: format % value)
+                columns[column] = rendered.reindex(col.index).fillna(" " * self.fwf_widths[i])
+                formats[i] = "%s"
+            else:
+                columns[column] = col
+
+        data = pandas.DataFrame(columns, index=self._data.index, columns=self._data.columns)
+        self._write_data(data.values, format="".join(formats))
 
     def _generate_excel_file(self):
         """
@@ -399,7 +540,8 @@ class OutputFile(File):
         workbook = xlsxwriter.Workbook(output_stream, {'constant_memory': True, 'in_memory': True})  # in_memory option is used to prevent 1GB+ files from being written to disk. Writing to disk has constant memory, but is SLOW. We can specify the tmp directory if needed.
         worksheet = workbook.add_worksheet(self.sheet_name)
 
-        output = self._data.to_dict('split')
+        # nulls are written as blank cells
+        output = self._data.astype(object).where(self._data.notnull(), None).to_dict('split')
         if self.has_header:
             for col in range(0, len(output['columns'])):
                 worksheet.write(0, col + 1 if self.index_rows else col, output['columns'][col])
@@ -425,6 +567,7 @@ class Metrics:
         # Universal
         self.number_values = 0
         self.number_null = 0
+        self.number_distinct = None
         self.common_values = []
         self.top_values = []
         self.num_duplicate_values = 0
@@ -472,12 +615,19 @@ class Field:
     # Field Types
     STRING, INT, FLOAT, DATE, DATETIME, BOOLEAN = ("STRING", "INT", "FLOAT", "DATE", "DATETIME", "BOOLEAN")
 
+    @property
+    def metrics(self):
+        # created on first use, most runs never collect metrics
+        if self._metrics is None:
+            self._metrics = Metrics()
+        return self._metrics
+
     def __init__(self, name, type="", colSpecs=[]):
         self.name = name
         self.type = type
         self.col_specs = colSpecs
 
-        self.metrics = Metrics()
+        self._metrics = None
 
     def _validate(self):
         if not self.name:
@@ -508,6 +658,23 @@ class SourceField(Field):
 class OutputField(Field):
     STRING, INT, FLOAT, DATE, BOOLEAN = ("STRING", "INT", "FLOAT", "DATE", "BOOLEAN")
 
+    @property
+    def operations(self):
+        """ function handlers for the transformations, in the order they are applied """
+        if self._operations is None:
+            # transformation functions are only loaded once data is processed
+            from datamonkey.transformations import FUNCTION_MAP, prepare_parameters
+            self._operations = [(FUNCTION_MAP[transformation.operation],
+                                 prepare_parameters(transformation.operation, transformation.parameters, self.type))
+                                for transformation in self.transformations]
+        return self._operations
+
+    @property
+    def column_operations(self):
+        """ positions of the transformations applied to the whole column of a chunk, rather than value by value """
+        return [i for i, transformation in enumerate(self.transformations)
+                if transformation.operation in Transformation.column_operations]
+
     def __init__(self, name, type, sourceFields, transformations=[], allowNull=False, replaceNullWith=None, mergeDelimiters=[], truthyStrings=None, colSpecs=[], **kwargs):
         super(OutputField, self).__init__(name, type, colSpecs)
 
@@ -523,6 +690,8 @@ class OutputField(Field):
         for transformation in transformations:
             self.transformations.append(Transformation(**transformation))
 
+        self._operations = None
+
     def _validate(self):
         super(OutputField, self)._validate()
 
@@ -568,6 +737,11 @@ class Transformation:
             "VALIDATE_BY_SUBSTRING",
         )
 
+    # applied to whole columns; the uniqueness operations keep the keys they've seen across chunks
+    VALIDATE_UNIQUE, FILTER_DUPLICATE, MODIFY_LOOKUP = ("VALIDATE_UNIQUE", "FILTER_DUPLICATE", "MODIFY_LOOKUP")
+    unique_operations = frozenset([VALIDATE_UNIQUE, FILTER_DUPLICATE])
+    column_operations = frozenset([VALIDATE_UNIQUE, FILTER_DUPLICATE, MODIFY_LOOKUP])
+
     FILTER_BY_RANGE, FILTER_BY_VALUE, FILTER_BY_DATE_RANGE, FILTER_BY_DATE_VALUE, FILTER_BY_LIST, FILTER_BY_REGEX, FILTER_BY_LENGTH, FILTER_BY_SUBSTRING = \
         (
             "FILTER_BY_RANGE",
@@ -580,6 +754,16 @@ class Transformation:
             "FILTER_BY_SUBSTRING",
         )
 
+    valid_operations = frozenset([MODIFY_DO_MATH, MODIFY_TRIM_STRING, MODIFY_REMOVE_WHITESPACE, MODIFY_CHANGE_CASE,
+                                  MODIFY_REMOVE_SUBSTRING, MODIFY_APPEND_STRING, MODIFY_REPLACE_VALUE,
+                                  MODIFY_ROUND_NUMBER, MODIFY_CHANGE_DATE_FORMAT,
+                                  MODIFY_MASK_FIELD, MODIFY_CAST_TYPE, VALIDATE_BY_RANGE, VALIDATE_BY_VALUE,
+                                  VALIDATE_BY_LIST, VALIDATE_BY_REGEX, VALIDATE_BY_LENGTH, VALIDATE_BY_SUBSTRING,
+                                  VALIDATE_BY_DATE_RANGE, VALIDATE_BY_DATE_VALUE, FILTER_BY_DATE_RANGE,
+                                  FILTER_BY_DATE_VALUE, FILTER_BY_RANGE, FILTER_BY_VALUE, FILTER_BY_LIST,
+                                  FILTER_BY_REGEX, FILTER_BY_LENGTH, FILTER_BY_SUBSTRING, VALIDATE_UNIQUE,
+                                  FILTER_DUPLICATE, MODIFY_LOOKUP])
+
     def __init__(self, operation, parameters, type="", **kwargs):
         self.operation = operation
         self.parameters = parameters
@@ -587,29 +771,47 @@ class Transformation:
         self._validate()
 
     def _validate(self):
-        if self.operation not in [self.MODIFY_DO_MATH, self.MODIFY_TRIM_STRING, self.MODIFY_REMOVE_WHITESPACE, self.MODIFY_CHANGE_CASE,
-                                  self.MODIFY_REMOVE_SUBSTRING, self.MODIFY_APPEND_STRING, self.MODIFY_REPLACE_VALUE,
-                                  self.MODIFY_ROUND_NUMBER, self.MODIFY_CHANGE_DATE_FORMAT,
-                                  self.MODIFY_MASK_FIELD, self.MODIFY_CAST_TYPE, self.VALIDATE_BY_RANGE, self.VALIDATE_BY_VALUE,
-                                  self.VALIDATE_BY_LIST, self.VALIDATE_BY_REGEX, self.VALIDATE_BY_LENGTH, self.VALIDATE_BY_SUBSTRING,
-                                  self.VALIDATE_BY_DATE_RANGE, self.VALIDATE_BY_DATE_VALUE, self.FILTER_BY_DATE_RANGE,
-                                  self.FILTER_BY_DATE_VALUE, self.FILTER_BY_RANGE, self.FILTER_BY_VALUE, self.FILTER_BY_LIST,
-                                  self.FILTER_BY_REGEX, self.FILTER_BY_LENGTH, self.FILTER_BY_SUBSTRING]:
+        if self.operation not in self.valid_operations:
             raise ValueError("Operation is not valid.")
 
 
 class Configuration:
 
-    def __init__(self, id, file_path):
+    # Compiled template artifacts
+    ARTIFACT_EXTENSION = ".dmkt"
+    ARTIFACT_MAGIC = b"DMKT"
+    ARTIFACT_FORMAT = 1
+
+    def __init__(self, id, file_path, template_cache=None, template=None):
+        """ template optionally supplies the template itself, e.g. an inferred one, instead of a file or the API """
         self.id = id
         self.file_path = os.path.expanduser(file_path)
+        self.template_cache = template_cache if template_cache is not None else TemplateCache()
 
         self._validate_id()
 
-        config_data = self._load_configuration()
-        self._populate(**config_data)
+        self.template = template if template is not None else self._load_configuration()
+        self._populate(**self.template)
         self._validate()
 
+    @classmethod
+    def infer(cls, file_path, id=None, **kwargs):
+        """
+        Infers a configuration from a sample of a source file; see datamonkey.inference.infer_configuration for the
+        options. The template can be edited and saved with save().
+        """
+        from datamonkey.inference import infer_configuration
+        return infer_configuration(file_path, id, **kwargs)
+
+    def save(self, file_path):
+        """ Saves the template as JSON, e.g. to process files with it later through template_file_path. """
+        file_path = os.path.expanduser(file_path)
+        directory = os.path.dirname(os.path.abspath(file_path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as file:
+            json.dump(self.template, file, indent=4)
+        os.replace(temp_path, file_path)
+
     def _load_configuration(self):
         """ Retrieve configuration using either the API, a local cache file, or a supplied file path. """
         if self.file_path:
@@ -631,27 +833,30 @@ class Configuration:
         self.source_files = []
 
         for file_index, source_file in enumerate(sourceFiles):
-            source_file["file_index"] = file_index
-            self.source_files.append(SourceFile(**source_file))
+            self.source_files.append(SourceFile(file_index=file_index, **source_file))
 
         self.output_file = OutputFile(**outputFile)
 
         if self.output_file.type == File.FWF:
             # intialize fwf output format based on output fields
-            format = ""
+            formats, widths = [], []
             for field in self.output_fields:
                 if field.col_specs is None:
                     raise ValueError("Field '%s' does not have column markers set." % field.name)
 
                 width = (field.col_specs[1] - field.col_specs[0]) + 1
                 if field.type in [Field.STRING, Field.DATETIME, Field.DATE, Field.BOOLEAN]:
-                    format += "%-" + str(width) + '.' + str(width) + 's'
+                    formats.append("%-" + str(width) + '.' + str(width) + 's')
                 elif field.type == Field.INT:
-                    format += "%-" + str(width) + 'i'
+                    formats.append("%-" + str(width) + 'i')
                 elif field.type == Field.FLOAT:
-                    format += "%-" + str(width) + '.' + str(width) + 'f'
+                    formats.append("%-" + str(width) + '.' + str(width) + 'f')
+                widths.append(width)
 
+            format = "".join(formats)
             self.output_file.fwf_format = format
+            self.output_file.fwf_formats = formats
+            self.output_file.fwf_widths = widths
 
             if self.output_file.has_header:
                 format = ""
@@ -665,23 +870,88 @@ class Configuration:
             self.output_file.fwf_header_format = format
 
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["template_cache"] = None  # the cache is local to the machine that compiled the template
+        return state
+
+    def compile(self):
+        """
+        Prepares the transformation handlers of every output field, which are otherwise prepared when data is first
+        processed, so that copies (pickled for workers or saved as an artifact) don't prepare them again.
+        """
+        for field in self.output_fields:
+            field.operations  # prepared and kept the first time the property is read
+        return self
+
+    def save_artifact(self, file_path):
+        """
+        Saves the validated and compiled configuration as a binary artifact, which can be loaded again without
+        re-parsing or re-validating the template. The header records the template id and version along with a
+        checksum of the payload.
+        """
+        from datamonkey import __version__
+
+        self.compile()  # the transformation handlers are part of the artifact
+        payload = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        header = json.dumps({"format": Configuration.ARTIFACT_FORMAT,
+                             "library": __version__,
+                             "id": self.id,
+                             "version": self.version,
+                             "checksum": hashlib.sha256(payload).hexdigest()}).encode()
+
+        with open(os.path.expanduser(file_path), "wb") as file:
+            file.write(Configuration.ARTIFACT_MAGIC)
+            file.write(struct.pack(">I", len(header)))
+            file.write(header)
+            file.write(payload)
+
+    @classmethod
+    def load_artifact(cls, file_path, id=None, version=None):
+        """
+        Loads a configuration saved with save_artifact(). The artifact must match the library version, the checksum
+        of its payload and, if supplied, the expected template id and version. Only load artifacts you created, they
+        are unpickled.
+        """
+        from datamonkey import __version__
+
+        file_path = os.path.expanduser(file_path)
+        validate_file_exists(file_path)
+
+        with open(file_path, "rb") as file:
+            if file.read(len(cls.ARTIFACT_MAGIC)) != cls.ARTIFACT_MAGIC:
+                raise ValueError("%s is not a compiled template artifact." % file_path)
+
+            length = struct.unpack(">I", file.read(4))[0]
+            header = json.loads(file.read(length).decode())
+            payload = file.read()
+
+        if header["format"] != cls.ARTIFACT_FORMAT or header["library"] != __version__:
+            raise ValueError("The template artifact %s was compiled with another version of DataMonkey (%s); please "
+                             "compile it again." % (file_path, header["library"]))
+
+        if id is not None and header["id"] != id:
+            raise ValueError("The template artifact %s was compiled for Configuration Id %s, not %s." %
+                             (file_path, header["id"], id))
+
+        if version is not None and header["version"] != version:
+            raise ValueError("The template artifact %s contains version %s of the template, but version %s was "
+                             "expected." % (file_path, header["version"], version))
+
+        if hashlib.sha256(payload).hexdigest() != header["checksum"]:
+            raise ValueError("The template artifact %s is corrupt; its checksum doesn't match." % file_path)
+
+        configuration = pickle.loads(payload)
+        configuration.template_cache = TemplateCache()
+        return configuration
+
     def _retrieve_from_file(self):
         with open(self.file_path) as file:
             # should probably use simplejson for better error handling
             return json.load(file)
 
     def _retrieve_from_api(self):
-        url = BASE_API_URL + 'configurations/{id}'.format(id=self.id)
-        response = requests.get(url)
-        if response.status_code == requests.codes.OK:
-            return response.json()
-
-        elif response.status_code == requests.codes.NOT_FOUND:
-            raise ValueError("Unable to retrieve configuration for Configuration Id: %s. Please verify the configuration "
-                             "Id on your profile at https://datamonkey.io." % self.id)
-
-        else:
-            response.raise_for_status()
+        return self.template_cache.retrieve(self.id)
 
     def _validate(self):
         if self.source_fields is None or len(self.source_fields) == 0:
@@ -696,6 +966,16 @@ class Configuration:
         if self.output_file is None:
             raise ValueError("There was no output file defined for this configuration.")
 
+        names = set(field.name for field in self.output_fields)
+        for field in self.output_fields:
+            for transformation in field.transformations:
+                if transformation.operation not in Transformation.unique_operations:
+                    continue
+                for name in transformation.parameters.get("fields", []):
+                    if name not in names or name == field.name:
+                        raise ValueError("The %s transformation of output field '%s' refers to '%s', which is not "
+                                         "another output field." % (transformation.operation, field.name, name))
+
     def _validate_id(self):
         if self.id == "":
             raise ValueError("Configuration Id must be set.")
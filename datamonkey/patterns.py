@@ -0,0 +1,106 @@
+import re
+import warnings
+
+
+class SubstringMatcher:
+    """
+    Finds which of a set of substrings a value contains, in one pass over the value: an Aho-Corasick automaton of the
+    substrings follows the value character by character and stops at the first substring that ends. Sets of a few
+    substrings are searched one by one instead, which is faster for them.
+    """
+
+    MAX_SCANNED = 8  # substrings searched one by one rather than with the automaton
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto, self._fail, self._output = None, None, None
+        if len(self.patterns) > SubstringMatcher.MAX_SCANNED and "" not in self.patterns:
+            self._build()
+
+    def _build(self):
+        # a trie of the substrings; output is the substring found on reaching a state, directly or by a suffix
+        goto, output = [{}], [None]
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto[state][char] = len(goto)
+                    goto.append({})
+                    output.append(None)
+                state = goto[state][char]
+            if output[state] is None:
+                output[state] = i
+
+        # failure links, breadth first: the state of the longest proper suffix that's also in the trie
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, target in goto[state].items():
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[target] = goto[link].get(char, 0) if state else 0
+                if output[target] is None:
+                    output[target] = output[fail[target]]
+                queue.append(target)
+
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def find(self, value):
+        """ the index of the first substring found in the value (the one that ends first), None if it contains none """
+        if self._goto is None:
+            for i, pattern in enumerate(self.patterns):
+                if pattern in value:
+                    return i
+            return None
+
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in value:
+            target = goto[state].get(char)
+            while target is None and state:
+                state = fail[state]
+                target = goto[state].get(char)
+            state = target or 0
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class RegexMatcher:
+    """
+    Tests values against a set of regular expressions with a single expression, the alternation of the patterns, and
+    only looks for the pattern that matched when it's asked for. Patterns with backreferences can't be combined, since
+    their group numbers would change, nor can patterns that repeat group names or set flags; sets that have any are
+    matched one pattern at a time.
+    """
+
+    BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._combined = None
+        self._compiled = [re.compile(pattern) for pattern in self.patterns]
+        if len(self.patterns) > 1 and not any(RegexMatcher.BACKREFERENCE.search(p) for p in self.patterns):
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("error")  # flags that aren't at the start of the expression
+                    self._combined = re.compile("|".join("(?:%s)" % pattern for pattern in self.patterns))
+            except (re.error, DeprecationWarning, FutureWarning):
+                self._combined = None
+
+    def matches(self, value):
+        """ whether any of the patterns matches (the start of) the value """
+        if self._combined is not None:
+            return self._combined.match(value) is not None
+        return self.find(value) is not None
+
+    def find(self, value):
+        """ the index of the first pattern that matches the value, None if none does """
+        if self._combined is not None and self._combined.match(value) is None:
+            return None
+
+        for i, compiled in enumerate(self._compiled):
+            if compiled.match(value):
+                return i
+        return None
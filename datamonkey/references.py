@@ -0,0 +1,127 @@
+import os
+
+from datamonkey.helpers import check_S3_path, validate_file_exists, LazyModule
+
+pandas = LazyModule("pandas")
+numpy = LazyModule("numpy")
+
+_TABLES = {}  # the latest version of each reference file indexed by this process, shared by every template and chunk
+
+
+class ReferenceTable:
+    """
+    The values of a list operation (VALIDATE_BY_LIST, FILTER_BY_LIST) or the keys and values of MODIFY_LOOKUP, given in
+    the template or read from a reference file. Membership is tested in a hash set and lookups are vectorized through a
+    hash index, each built the first time it's needed. Tables read from files are indexed once per process and shared;
+    pickling one (e.g. for a worker process or a compiled template artifact) only keeps where to read it from.
+    """
+
+    MAX_LISTED = 10  # values quoted in messages, longer lists are summarized
+
+    def __init__(self, keys, values=None, source=None):
+        self.source = source  # the arguments of from_file, for tables read from a file
+        self._keys = keys
+        self._values = values
+        self._set = None
+        self._table = None
+        self._description = None
+
+    @classmethod
+    def from_file(cls, file_path, column=None, value_column=None, delimiter=",", type=None):
+        """
+        A table read from a local file: one value per line if no column is named, else the column (and value_column
+        for lookups) of a delimited file with a header. Keys and values are converted to the field type.
+        """
+        if check_S3_path(file_path):
+            raise ValueError("Reference files must be local files: %s" % file_path)
+
+        file_path = os.path.abspath(os.path.expanduser(file_path))
+        validate_file_exists(file_path)
+        stat = os.stat(file_path)
+        key = (file_path, column, value_column, delimiter, type, stat.st_mtime, stat.st_size)
+        if key not in _TABLES:
+            table = cls._read(file_path, column, value_column, delimiter, type)
+            for stale in [other for other in _TABLES if other[:5] == key[:5]]:
+                del _TABLES[stale]  # earlier versions of an edited file are released
+            _TABLES[key] = table
+        return _TABLES[key]
+
+    @classmethod
+    def _read(cls, file_path, column, value_column, delimiter, type):
+        if column is None:
+            with open(file_path) as file:
+                keys = pandas.Series([line.rstrip("\r\n") for line in file])
+            keys = keys[keys != ""]
+            values = None
+        else:
+            data = pandas.read_csv(file_path, sep=delimiter, dtype=str, keep_default_na=False)
+            for name in [column, value_column]:
+                if name is not None and name not in data.columns:
+                    raise ValueError("The reference file %s has no column '%s'." % (file_path, name))
+            keys = data[column]
+            values = _convert(data[value_column], type, file_path) if value_column is not None else None
+
+        return cls(_convert(keys, type, file_path), values,
+                   source=(file_path, column, value_column, delimiter, type))
+
+    def __getstate__(self):
+        if self.source is not None:
+            return {"source": self.source}
+        return {"source": None, "_keys": self._keys, "_values": self._values}
+
+    def __setstate__(self, state):
+        if state["source"] is not None:
+            # read again (or found indexed already) by the process that unpickles it
+            self.__dict__.update(ReferenceTable.from_file(*state["source"]).__dict__)
+        else:
+            self.__init__(state["_keys"], state["_values"])
+
+    @property
+    def keys(self):
+        return self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, value):
+        if self._set is None:
+            self._set = frozenset(self._keys)
+        return value in self._set
+
+    def lookup(self, values):
+        """ the values of the table for a series of keys, and whether each key was found; keys not found are kept """
+        if self._table is None:
+            table = pandas.Series(list(self._values), index=list(self._keys))
+            self._table = table[~table.index.duplicated()]  # the first row of a key wins
+
+        if not len(self._table):
+            return values, numpy.zeros(len(values), dtype=bool)
+
+        positions = self._table.index.get_indexer(values.values)
+        found = positions >= 0
+        mapped = numpy.where(found, self._table.values[positions], values.values)
+        return pandas.Series(mapped, index=values.index), found
+
+    def describe(self):
+        """ the values for messages, without quoting every value of long lists """
+        if self._description is None:
+            listed = [str(key) for key in self._keys[:ReferenceTable.MAX_LISTED]]
+            if self.source is not None:
+                self._description = "%d values in %s" % (len(self), os.path.basename(self.source[0]))
+            elif len(self) <= ReferenceTable.MAX_LISTED:
+                self._description = ", ".join(listed)
+            else:
+                self._description = "%s, ... %d values" % (", ".join(listed), len(self))
+        return self._description
+
+
+def _convert(column, type, file_path):
+    """ converts the strings of a reference file to the type of the field they're compared with """
+    try:
+        if type in ["INT", "FLOAT"]:
+            return list(pandas.to_numeric(column))
+        if type in ["DATE", "DATETIME"]:
+            return list(pandas.to_datetime(column))
+    except (ValueError, TypeError):
+        raise ValueError("The reference file %s has values that aren't of type %s." % (file_path, type))
+    return list(column)
@@ -0,0 +1,178 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import ujson as json
+
+from datamonkey.helpers import check_S3_path
+from datamonkey.references import ReferenceTable
+from datamonkey.settings import RESULT_CACHE_DIR, RESULT_CACHE_MAX_SIZE
+
+
+class ResultCache:
+    """
+    Keeps the output and errors file of previous runs, keyed by the content of the source files, the template (its id,
+    version and content), the content of the reference files its operations read and the library version. When the
+    same inputs are processed again with the same template, the previous results are copied into place instead of
+    being computed again. The least recently used results are evicted once the cache grows beyond max_size bytes.
+    """
+
+    BLOCK_SIZE = 1024 ** 2  # bytes read at a time when hashing local files
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_size=RESULT_CACHE_MAX_SIZE, link=False):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        self.link = link  # hard link local results instead of copying them; the outputs must then never be modified
+
+    def key(self, processor, source_file_paths):
+        """ Identifies a run by everything its output and errors file depend on. """
+        from datamonkey import __version__
+
+        if isinstance(source_file_paths, str):
+            source_file_paths = [source_file_paths]
+
+        run = {"id": processor.configuration.id,
+               "version": processor.configuration.version,
+               "template": hashlib.sha256(json.dumps(processor.configuration.template, sort_keys=True).encode())
+               .hexdigest(),  # templates are edited without a new version, or have none
+               "library": __version__,
+               "sources": [self._fingerprint(os.path.expanduser(path)) for path in source_file_paths],
+               "references": [self._fingerprint(path) for path in self._reference_files(processor)],
+               "errorsFormat": processor.error_log.file_formats.get(
+                   os.path.splitext(processor.error_file_path)[1].lower(), processor.error_log.TEXT),
+               "maxErrors": processor.max_errors}
+
+        return hashlib.sha256(json.dumps(run, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _reference_files(processor):
+        """ the reference files read by the template's operations, which the template only names """
+        paths = []
+        for field in processor.output_fields:
+            for _, params in field.operations:
+                for value in params.values():
+                    if isinstance(value, ReferenceTable) and value.source is not None and value.source[0] not in paths:
+                        paths.append(value.source[0])
+        return paths
+
+    def _fingerprint(self, path):
+        if check_S3_path(path):
+            # S3 already keeps a hash of the object's content
+            import s3fs
+            info = s3fs.S3FileSystem().info(path)
+            return "%s:%s" % (info.get("ETag", ""), info.get("Size", 0))
+
+        digest = hashlib.sha1()  # identifies content, it isn't relied on for security
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(ResultCache.BLOCK_SIZE), b""):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def restore(self, key, output_file_path, error_file_path):
+        """ Puts the cached output and errors file in place and returns the cached entry, or None if there's none. """
+        entry_dir = os.path.join(self.cache_dir, key)
+        entry = self._read_entry(entry_dir)
+        if entry is None:
+            return None
+
+        self._place(os.path.join(entry_dir, "output"), output_file_path)
+        if entry["hasErrorsFile"]:
+            self._place(os.path.join(entry_dir, "errors"), error_file_path)
+
+        os.utime(os.path.join(entry_dir, "entry.json"))  # marks the entry as recently used
+        return entry
+
+    def store(self, key, output_file_path, error_file_path, state):
+        """
+        Keeps a copy of a run's output and errors file (None if the run didn't write one) plus its state (counts and
+        totals), then evicts old entries.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # entries are assembled in a temporary directory, so a half written entry is never used
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            _copy(output_file_path, os.path.join(temp_dir, "output"))
+
+            has_errors_file = error_file_path is not None
+            if has_errors_file:
+                _copy(error_file_path, os.path.join(temp_dir, "errors"))
+
+            entry = dict(state, hasErrorsFile=has_errors_file, createdAt=time.time())
+            entry["size"] = sum(os.path.getsize(os.path.join(temp_dir, name)) for name in os.listdir(temp_dir))
+            with open(os.path.join(temp_dir, "entry.json"), "w") as file:
+                json.dump(entry, file)
+
+            os.replace(temp_dir, entry_dir)
+
+        except OSError:
+            # another run stored the same entry first, or it couldn't be written; caching is best effort
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits within max_size bytes. """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            entry = self._read_entry(entry_dir)
+            if entry is not None:
+                entries.append((os.path.getmtime(os.path.join(entry_dir, "entry.json")), entry["size"], entry_dir))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_dir in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            size -= entry_size
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    @staticmethod
+    def _read_entry(entry_dir):
+        path = os.path.join(entry_dir, "entry.json")
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except ValueError:
+            # a corrupt entry is treated as a miss
+            return None
+
+    def _place(self, cached_path, file_path):
+        if self.link and not check_S3_path(file_path):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+            try:
+                os.link(cached_path, file_path)
+                return
+            except OSError:
+                pass  # e.g. on another file system, copy it instead
+
+        _copy(cached_path, file_path)
+
+
+def _copy(source, target):
+    """ copies a file between local paths and S3 """
+    if check_S3_path(source) or check_S3_path(target):
+        import s3fs
+        fs = s3fs.S3FileSystem()
+        if check_S3_path(source):
+            fs.get(source, target)
+        else:
+            fs.put(source, target)
+    else:
+        shutil.copyfile(source, target)
@@ -0,0 +1,137 @@
+from array import array
+
+from datamonkey.helpers import LazyModule
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+
+class Sample:
+    """
+    Restricts a run to part of the source rows, e.g. to preview a template change on a large file:
+
+        Sample.head(1000)                 the first 1000 rows
+        Sample.rows(5000, 6000)           rows 5000 up to 6000 (0-based, the stop is excluded)
+        Sample.bernoulli(0.01, seed=1)    every row with a probability of 1%
+        Sample.reservoir(1000, seed=1)    1000 rows drawn uniformly from the whole file
+
+    Heads and row ranges are pushed into the readers, which stop parsing at the last row. Bernoulli samples of CSV and
+    FWF files skip the other rows while parsing; those of other sources drop them from each chunk. Reservoir samples
+    read every row but only keep size of them, which are processed once the file has been read. Sampled rows keep
+    their row numbers in the errors file, and the same seed draws the same rows.
+    """
+
+    RANGE, BERNOULLI, RESERVOIR = ("RANGE", "BERNOULLI", "RESERVOIR")
+
+    def __init__(self, mode, start=0, stop=None, fraction=None, size=None, seed=0):
+        self.mode = mode
+        self.start = start
+        self.stop = stop
+        self.fraction = fraction
+        self.size = size
+        self.seed = seed
+
+        self._validate()
+        self.reset()
+
+    @classmethod
+    def head(cls, rows):
+        return cls(Sample.RANGE, 0, rows)
+
+    @classmethod
+    def rows(cls, start, stop=None):
+        return cls(Sample.RANGE, start, stop)
+
+    @classmethod
+    def bernoulli(cls, fraction, seed=0):
+        return cls(Sample.BERNOULLI, fraction=fraction, seed=seed)
+
+    @classmethod
+    def reservoir(cls, size, seed=0):
+        return cls(Sample.RESERVOIR, size=size, seed=seed)
+
+    def _validate(self):
+        if self.mode not in [Sample.RANGE, Sample.BERNOULLI, Sample.RESERVOIR]:
+            raise ValueError("%s is not a valid sampling mode." % self.mode)
+
+        if self.mode == Sample.RANGE and (self.start < 0 or self.stop is not None and self.stop < self.start):
+            raise ValueError("The row range %s to %s is not valid." % (self.start, self.stop))
+
+        if self.mode == Sample.BERNOULLI and not 0 < self.fraction <= 1:
+            raise ValueError("The sampled fraction of rows must be above 0 and at most 1, not %s." % self.fraction)
+
+        if self.mode == Sample.RESERVOIR and self.size < 1:
+            raise ValueError("A reservoir sample needs at least one row, not %s." % self.size)
+
+    @property
+    def nrows(self):
+        """ the number of rows of a row range, None if it reaches the end of the file """
+        return None if self.stop is None else self.stop - self.start
+
+    def reset(self):
+        """ starts drawing the same rows again, before each run """
+        self._random = numpy.random.RandomState(self.seed) if self.mode != Sample.RANGE else None
+        self._parsing = False  # whether the reader skips rows while parsing
+        self._kept = array("q")  # rows a reader kept while parsing, which it numbers from 0
+        self._rows = 0  # rows drawn from
+        self._reservoir = None
+        self._drained = False
+
+    def skip_row(self, row):
+        """ for readers that skip rows while parsing: whether (0-based) data row row is left out of the sample """
+        self._parsing = True
+        if self._random.random_sample() < self.fraction:
+            self._kept.append(row)
+            return False
+        return True
+
+    def select(self, data):
+        """
+        the sampled rows of a chunk of a Bernoulli sample: rows parsed with skip_row get their row numbers in the file
+        back, other sources are filtered here (drawing the same rows)
+        """
+        if self._parsing:
+            data.index = numpy.frombuffer(self._kept, dtype=numpy.int64)[data.index.values]
+            return data
+        return data[self._random.random_sample(len(data)) < self.fraction]
+
+    def next_chunk(self, read_chunk):
+        """ reads every chunk with read_chunk into the reservoir, then returns the sample (in file order) once """
+        if self._drained:
+            return None
+
+        while True:
+            data = read_chunk()
+            if data is None:
+                break
+            self._add(data)
+
+        self._drained = True
+        return None if self._reservoir is None else self._reservoir.sort_index()
+
+    def _add(self, data):
+        """ Algorithm R: row i replaces a random row of the reservoir with a probability of size / (i + 1) """
+        if self._reservoir is None or len(self._reservoir) < self.size:
+            room = self.size if self._reservoir is None else self.size - len(self._reservoir)
+            head = data.iloc[:room]
+            self._reservoir = head.copy() if self._reservoir is None else pandas.concat([self._reservoir, head])
+            self._rows += len(head)
+            data = data.iloc[room:]
+            if not len(data):
+                return
+
+        positions = self._rows + numpy.arange(len(data))
+        slots = (self._random.random_sample(len(data)) * (positions + 1)).astype(numpy.int64)
+        self._rows += len(data)
+
+        replaced = slots < self.size
+        if replaced.any():
+            # a later row replacing the same slot wins, as if the rows had been drawn one by one
+            replacements = pandas.Series(numpy.flatnonzero(replaced), index=slots[replaced])
+            replacements = replacements[~replacements.index.duplicated(keep="last")]
+            kept = numpy.ones(len(self._reservoir), dtype=bool)
+            kept[replacements.index.values] = False
+            reservoir = pandas.concat([self._reservoir[kept], data.iloc[replacements.values]])
+            # rows stay in their slots, so the sample doesn't depend on the size of the chunks
+            slots = numpy.concatenate([numpy.flatnonzero(kept), replacements.index.values])
+            self._reservoir = reservoir.iloc[numpy.argsort(slots)]
@@ -1,7 +1,28 @@
 # PROCESSING
 BASE_API_URL = "https://api.data-monkey.com/v1/public/"
+API_TIMEOUT = 10  # seconds
+API_POOL_SIZE = 10
 CHUNKSIZE = 1000000
 
+# TEMPLATE CACHE
+TEMPLATE_CACHE_DIR = "~/.datamonkey/templates"
+TEMPLATE_CACHE_TTL = 300  # seconds
+
+# SOURCE CACHE
+SOURCE_CACHE_DIR = "~/.datamonkey/sources"
+
+# RESULT CACHE
+RESULT_CACHE_DIR = "~/.datamonkey/results"
+RESULT_CACHE_MAX_SIZE = 10 * 1024 ** 3  # bytes
+
+# UNIQUENESS
+UNIQUE_KEYS_MAX_MEMORY = 256 * 1024 ** 2  # bytes of key hashes kept in memory per operation, the rest spill to disk
+
+# TRANSFORMATIONS
+MEMOIZE_MIN_ROWS = 1000  # values of a chunk below which transformations are always applied value by value
+MEMOIZE_SAMPLE_ROWS = 10000  # values sampled to judge whether a column repeats its values
+MEMOIZE_MAX_DISTINCT = 0.5  # share of distinct values in the sample up to which transformations are memoized
+
 # PANDAS/PYTHON/FILE TYPE MAPPINGS
 PANDAS_TYPE_MAP = {"STRING": 'O', "INT": "int64", "FLOAT": "float64", "BOOLEAN": "bool", "DATE": "datetime64[ns]", "DATETIME": "datetime64[ns]"}
 PYTHON_TYPE_MAP = {"STRING": str, "INT": int, "FLOAT": float, "BOOLEAN": bool, "DATE": "O", "DATETIME": "o"}
@@ -0,0 +1,682 @@
+import math
+import time
+import string
+
+from collections import OrderedDict
+
+from datamonkey.helpers import LazyModule
+from datamonkey.logs import ErrorLog
+from datamonkey.models import Field, Metrics
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+MAX_EXAMPLES = 100  # anomalies kept per field and detector for the metrics
+_NONE = ((), None)  # no anomalies
+
+
+class HyperLogLog:
+    """ Estimates the number of distinct values in 2 ** precision bytes, within about 1.04 / sqrt(2 ** precision). """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    def update(self, values):
+        """ adds the values of a series """
+        if not len(values):
+            return
+
+        bits = 64 - self.precision
+        hashes = pandas.util.hash_pandas_object(values, index=False).values
+        registers = (hashes >> numpy.uint64(bits)).astype(numpy.int64)
+        remainder = hashes & numpy.uint64((1 << bits) - 1)
+
+        # the rank is the position of the first 1 bit in the remainder; frexp gives its bit length (0 for 0)
+        ranks = bits + 1 - numpy.frexp(remainder.astype(numpy.float64))[1]
+        ranks = pandas.Series(ranks, dtype=numpy.uint8).groupby(registers).max()
+        self.registers[ranks.index.values] = numpy.maximum(self.registers[ranks.index.values], ranks.values)
+
+    def merge(self, other):
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    @property
+    def count(self):
+        size = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / numpy.sum(2.0 ** -self.registers.astype(numpy.float64))
+
+        empty = int(numpy.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and empty:
+            estimate = size * math.log(size / empty)  # linear counting is more accurate for small counts
+        return int(round(estimate))
+
+
+class QuantileSketch:
+    """
+    KLL sketch of numeric values: items are kept in levels, and a level that's full is sorted and every other item
+    is promoted to the next level with twice the weight. Its size is about 3 * k items whatever the number of values.
+    """
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.count = 0
+        self.levels = []  # numpy arrays, an item at level h stands for 2 ** h values
+        self._random = numpy.random.RandomState(seed)
+
+    def update(self, values):
+        """ adds a numpy array of floats """
+        if not len(values):
+            return
+
+        self.count += len(values)
+        if not self.levels:
+            self.levels.append(numpy.empty(0))
+        self.levels[0] = numpy.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        self.count += other.count
+        for level, items in enumerate(other.levels):
+            if level < len(self.levels):
+                self.levels[level] = numpy.concatenate([self.levels[level], items])
+            else:
+                self.levels.append(items.copy())
+        self._compress()
+
+    def _capacity(self, level):
+        return max(int(math.ceil(self.k * (2.0 / 3) ** (len(self.levels) - level - 1))), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(numpy.empty(0))
+
+                items = numpy.sort(items)
+                kept = items[len(items) - len(items) % 2:]  # an odd item out stays at its level
+                promoted = items[self._random.randint(2):len(items) - len(kept):2]
+                self.levels[level + 1] = numpy.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = kept
+            level += 1
+
+    def _weighted(self):
+        items = numpy.concatenate(self.levels) if self.levels else numpy.empty(0)
+        weights = numpy.concatenate([numpy.full(len(items), 2 ** level) for level, items in enumerate(self.levels)]) \
+            if self.levels else numpy.empty(0)
+        order = numpy.argsort(items, kind="mergesort")
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        """ the estimated q-quantile (0 <= q <= 1), None if no values were added """
+        items, weights = self._weighted()
+        if not len(items):
+            return None
+
+        cumulative = numpy.cumsum(weights)
+        return float(items[min(numpy.searchsorted(cumulative, q * cumulative[-1]), len(items) - 1)])
+
+    def items_between(self, low, high):
+        """ the smallest and largest kept items within [low, high] """
+        items, _ = self._weighted()
+        items = items[(items >= low) & (items <= high)]
+        return (float(items[0]), float(items[-1])) if len(items) else (None, None)
+
+
+class FrequentItems:
+    """
+    Misra-Gries summary of the most frequent values: with k counters, every value that makes up more than 1 / (k + 1)
+    of the values is kept, and counts are underestimated by at most that fraction. Summaries of parts of the data
+    merge into a summary of the whole.
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+
+    def update(self, values):
+        """ adds the values of a series """
+        self.update_counts(values.value_counts())
+
+    def update_counts(self, counts):
+        """ adds a series of values and their counts, sorted by count like value_counts() """
+        if len(counts) > self.k:
+            # the summary of the chunk itself is reduced first, keeping the merge below small
+            threshold = counts.iloc[self.k]
+            counts = counts[counts > threshold] - threshold
+        self._add(counts.items())
+
+    def merge(self, other):
+        self._add(other.counts.items())
+
+    def _add(self, items):
+        counts = self.counts
+        for value, count in items:
+            counts[value] = counts.get(value, 0) + int(count)
+
+        if len(counts) > self.k:
+            threshold = sorted(counts.values(), reverse=True)[self.k]
+            self.counts = {value: count - threshold for value, count in counts.items() if count > threshold}
+
+    def top(self, number=None):
+        """ (value, count) pairs, most frequent first """
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:number]
+
+
+class RunningMoments:
+    """ Count, mean, variance, minimum and maximum of numeric values, updated per chunk and merged exactly. """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+
+    def update(self, values):
+        """ adds a numpy array of floats """
+        if not len(values):
+            return
+
+        other = RunningMoments()
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        self.merge(other)
+
+    def merge(self, other):
+        """ combines the moments of two parts of the data (Chan et al.) """
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2, self.min, self.max = other.count, other.mean, other.m2, other.min, other.max
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+
+# *** Detectors ***
+# each value is judged against the values before it (and the rest of its chunk), so columns are never kept whole;
+# update() returns the positions of the anomalies in the chunk and a function describing the i-th of them
+
+class SequenceDetector:
+    """
+    Follows the differences between consecutive integers, e.g. keys. Once one difference makes up most of them, a
+    value that follows its predecessor by another difference (a gap, a repeat or a step back) breaks the sequence.
+    """
+
+    DOMINANCE = 0.5  # share of the differences the common one must make up before breaks are reported
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.pairs = 0
+        self.steps = FrequentItems(10)  # differences between consecutive values
+        self.breaks = []  # (value, difference from the previous value) of values breaking the sequence
+
+    @property
+    def step(self):
+        """ the common difference and how often it occurred """
+        top = self.steps.top(1)
+        return top[0] if top else (None, 0)
+
+    def update(self, numbers):
+        previous = numbers if self.last is None else numpy.concatenate([[self.last], numbers])
+        offset = len(numbers) - len(previous) + 1  # position in numbers of the value after each difference
+        steps = numpy.diff(previous)
+        self.first = numbers[0] if self.first is None else self.first
+        self.last = numbers[-1]
+        if not len(steps):
+            return _NONE
+
+        self.pairs += len(steps)
+        self.steps.update(pandas.Series(steps))
+        step, count = self.step
+        if count <= SequenceDetector.DOMINANCE * self.pairs:
+            return _NONE
+
+        breaks = numpy.flatnonzero(steps != step)
+        _keep(self.breaks, list(zip(numbers[breaks + offset], steps[breaks])))
+
+        def describe(i):
+            return "%s follows %s; consecutive values usually differ by %s" % \
+                   (numbers[breaks[i] + offset], previous[breaks[i]], step)
+        return breaks + offset, describe
+
+    def merge(self, other):
+        if self.last is not None and other.first is not None:
+            self.pairs += 1
+            self.steps.update(pandas.Series([other.first - self.last]))
+            _keep(self.breaks, [(other.first, other.first - self.last)])
+
+        self.pairs += other.pairs
+        self.steps.merge(other.steps)
+        _keep(self.breaks, other.breaks)
+        self.first = other.first if self.first is None else self.first
+        self.last = other.last if other.last is not None else self.last
+
+    def populate(self, metrics):
+        step, count = self.step
+        if step is None:
+            return
+
+        metrics.common_sequence_value = _python(step)
+        metrics.is_sequential = count == self.pairs and step != 0
+        # the common difference may have changed since a value was judged
+        metrics.non_sequential_values = [_python(value) for value, difference in self.breaks if difference != step]
+
+
+class IntervalDetector:
+    """
+    Classifies the time between consecutive dates (SECOND to WEEK by length, MONTH and YEAR by calendar). Once one
+    interval makes up most of them, a date that isn't one interval after its predecessor breaks the series.
+    """
+
+    DOMINANCE = 0.5
+    DAY = 86400 * 10 ** 9
+    LENGTHS = [(Metrics.SECOND, 10 ** 9), (Metrics.MINUTE, 60 * 10 ** 9), (Metrics.HOUR, 3600 * 10 ** 9),
+               (Metrics.DAY, DAY), (Metrics.WEEK, 7 * DAY)]
+
+    def __init__(self):
+        self.first = None
+        self.last = None  # nanoseconds since the epoch
+        self.pairs = 0
+        self.intervals = {}  # interval: number of consecutive dates that far apart
+        self.breaks = []  # (date, interval from the previous date)
+
+    @property
+    def interval(self):
+        """ the interval between most consecutive dates, IRREGULAR if there's none """
+        if not self.intervals:
+            return Metrics.IRREGULAR
+
+        interval, count = max(self.intervals.items(), key=lambda item: item[1])
+        return interval if count > IntervalDetector.DOMINANCE * self.pairs else Metrics.IRREGULAR
+
+    @staticmethod
+    def classify(previous, current):
+        """ the interval between each pair of dates, as nanoseconds """
+        differences = current - previous
+        intervals = numpy.full(len(differences), Metrics.IRREGULAR, dtype=object)
+        for interval, length in IntervalDetector.LENGTHS:
+            intervals[differences == length] = interval
+
+        before, after = pandas.DatetimeIndex(previous), pandas.DatetimeIndex(current)
+        months = (after.year - before.year) * 12 + (after.month - before.month)
+        same_time = current % IntervalDetector.DAY == previous % IntervalDetector.DAY
+        same_day = same_time & ((after.day == before.day) | (before.is_month_end & after.is_month_end))
+        intervals[same_day & (months == 1)] = Metrics.MONTH
+        intervals[same_day & (months == 12)] = Metrics.YEAR
+        return intervals
+
+    def update(self, nanoseconds):
+        previous = nanoseconds if self.last is None else numpy.concatenate([[self.last], nanoseconds])
+        offset = len(nanoseconds) - len(previous) + 1
+        self.first = nanoseconds[0] if self.first is None else self.first
+        self.last = nanoseconds[-1]
+        if len(previous) < 2:
+            return _NONE
+
+        intervals = self.classify(previous[:-1], previous[1:])
+        self.pairs += len(intervals)
+        for interval, count in pandas.Series(intervals).value_counts().items():
+            self.intervals[interval] = self.intervals.get(interval, 0) + int(count)
+
+        expected = self.interval
+        if expected == Metrics.IRREGULAR:
+            return _NONE
+
+        breaks = numpy.flatnonzero(intervals != expected)
+        _keep(self.breaks, [(nanoseconds[i + offset], intervals[i]) for i in breaks[:MAX_EXAMPLES]])
+
+        def describe(i):
+            return "%s follows %s; the dates are usually one %s apart" % \
+                   (_date(previous[breaks[i] + 1]), _date(previous[breaks[i]]), expected.lower())
+        return breaks + offset, describe
+
+    def merge(self, other):
+        if self.last is not None and other.first is not None:
+            interval = self.classify(numpy.array([self.last]), numpy.array([other.first]))[0]
+            self.pairs += 1
+            self.intervals[interval] = self.intervals.get(interval, 0) + 1
+            _keep(self.breaks, [(other.first, interval)])
+
+        self.pairs += other.pairs
+        for interval, count in other.intervals.items():
+            self.intervals[interval] = self.intervals.get(interval, 0) + count
+        _keep(self.breaks, other.breaks)
+        self.first = other.first if self.first is None else self.first
+        self.last = other.last if other.last is not None else self.last
+
+
+class OutlierDetector:
+    """ Flags values more than Z_SCORE standard deviations from the running mean, once there are enough values. """
+
+    MIN_VALUES = 30
+    Z_SCORE = 3
+
+    def __init__(self):
+        self.moments = RunningMoments()
+        self.outliers = []
+
+    def update(self, numbers, values):
+        """ numbers are the values as floats """
+        self.moments.update(numbers)
+        if self.moments.count < OutlierDetector.MIN_VALUES or not self.moments.std:
+            return _NONE
+
+        mean, std = self.moments.mean, self.moments.std
+        scores = numpy.abs(numbers - mean) / std
+        positions = numpy.flatnonzero(scores > OutlierDetector.Z_SCORE)
+        _keep(self.outliers, values[positions])
+
+        def describe(i):
+            return "%s is %.1f standard deviations from the mean (%.6g)" % \
+                   (values[positions[i]], scores[positions[i]], mean)
+        return positions, describe
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        _keep(self.outliers, other.outliers)
+
+
+class NullDetector:
+    """ Flags missing values of a field that allows them, when at most NULL_RATE of its values are missing. """
+
+    MIN_VALUES = 30
+    NULL_RATE = 0.01
+
+    def __init__(self):
+        self.rows = 0
+        self.nulls = 0
+        self.outliers = []  # row numbers
+
+    def update(self, rows, null_rows):
+        """ rows is the number of rows of the chunk, null_rows the row indices of its missing values """
+        self.rows += rows
+        self.nulls += len(null_rows)
+        if not len(null_rows) or self.rows < NullDetector.MIN_VALUES or \
+                self.nulls > NullDetector.NULL_RATE * self.rows:
+            return _NONE
+
+        _keep(self.outliers, [int(row) + 1 for row in null_rows])
+        rate = 100.0 * self.nulls / self.rows
+
+        def describe(i):
+            return "missing value, while only %.2f%% of the values are missing" % rate
+        return numpy.arange(len(null_rows)), describe
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.nulls += other.nulls
+        _keep(self.outliers, other.outliers)
+
+
+class FieldSketch:
+    """ The sketches and detectors of one output field, chosen by its type. """
+
+    TOP_VALUES = 10
+    MAX_DECIMALS = 15  # digits a float64 holds after the decimal point
+    MASK = str.maketrans(string.ascii_letters + string.digits, "A" * len(string.ascii_letters) + "9" * 10)
+
+    NUMERIC = (Field.INT, Field.FLOAT)
+    DATES = (Field.DATE, Field.DATETIME)
+
+    def __init__(self, type, allow_null=True):
+        self.type = type
+        self.number_values = 0
+        self.number_null = 0
+        self.distinct = HyperLogLog()
+        self.frequent = FrequentItems()
+        self.null_detector = NullDetector() if allow_null else None  # missing values are reported otherwise
+
+        if type in FieldSketch.NUMERIC:
+            self.outliers = OutlierDetector()
+            self.quantiles = QuantileSketch()
+        if type == Field.INT:
+            self.sequence = SequenceDetector()
+        if type == Field.FLOAT:
+            self.precision = RunningMoments()
+        if type == Field.STRING:
+            self.lengths = RunningMoments()
+            self.masks = FrequentItems(20)  # shapes of the values, e.g. AA9999
+        if type in FieldSketch.DATES:
+            self.dates = RunningMoments()  # nanoseconds since the epoch
+            self.intervals = IntervalDetector()
+
+    def count_nulls(self, rows, null_rows):
+        """ counts the missing values of a chunk of rows rows; returns the out of place ones """
+        self.number_null += len(null_rows)
+        anomalies = []
+        if self.null_detector is not None:
+            positions, describe = self.null_detector.update(rows, null_rows)
+            if len(positions):
+                anomalies.append(("nulls", positions, describe))
+        return anomalies
+
+    def update(self, values):
+        """ adds a series of non-null values of the field's type; returns the anomalies of the detectors """
+        self.number_values += len(values)
+        if not len(values):
+            return []
+
+        self.distinct.update(values)
+        counts = values.value_counts()
+        self.frequent.update_counts(counts)
+
+        detected = []
+        if self.type in FieldSketch.NUMERIC:
+            numbers = values.values.astype(numpy.float64)
+            detected.append(("outliers",) + self.outliers.update(numbers, values.values))
+            self.quantiles.update(numbers)
+
+        if self.type == Field.INT:
+            detected.append(("sequence",) + self.sequence.update(values.values))
+
+        elif self.type == Field.FLOAT:
+            self.precision.update(self._decimals(values.values))
+
+        elif self.type == Field.STRING:
+            self.lengths.update(values.str.len().values.astype(numpy.float64))
+            # each distinct value is only masked once
+            masks = counts.groupby([value.translate(FieldSketch.MASK) for value in counts.index]).sum()
+            self.masks.update_counts(masks.sort_values(ascending=False))
+
+        elif self.type in FieldSketch.DATES:
+            nanoseconds = values.values.astype("datetime64[ns]").astype(numpy.int64)
+            self.dates.update(nanoseconds.astype(numpy.float64))
+            detected.append(("intervals",) + self.intervals.update(nanoseconds))
+
+        return [anomaly for anomaly in detected if len(anomaly[1])]
+
+    def merge(self, other):
+        """ adds the sketch of a later part of the data """
+        self.number_values += other.number_values
+        self.number_null += other.number_null
+        self.distinct.merge(other.distinct)
+        self.frequent.merge(other.frequent)
+        if self.null_detector is not None:
+            self.null_detector.merge(other.null_detector)
+
+        if self.type in FieldSketch.NUMERIC:
+            self.outliers.merge(other.outliers)
+            self.quantiles.merge(other.quantiles)
+
+        if self.type == Field.INT:
+            self.sequence.merge(other.sequence)
+
+        elif self.type == Field.FLOAT:
+            self.precision.merge(other.precision)
+
+        elif self.type == Field.STRING:
+            self.lengths.merge(other.lengths)
+            self.masks.merge(other.masks)
+
+        elif self.type in FieldSketch.DATES:
+            self.dates.merge(other.dates)
+            self.intervals.merge(other.intervals)
+
+    def populate(self, metrics):
+        """ fills a Metrics object with the estimates """
+        metrics.number_values = self.number_values
+        metrics.number_null = self.number_null
+        metrics.number_distinct = min(self.distinct.count, self.number_values)
+        metrics.num_duplicate_values = self.number_values - metrics.number_distinct
+        metrics.top_values = [[_python(value), count] for value, count in self.frequent.top(FieldSketch.TOP_VALUES)]
+        metrics.common_values = [_python(value) for value, count in self.frequent.top()
+                                 if count * (self.frequent.k + 1) > self.number_values]
+        if self.null_detector is not None:
+            metrics.null_outliers = list(self.null_detector.outliers)
+
+        moments = self.outliers.moments if self.type in FieldSketch.NUMERIC else None
+        if moments is not None and moments.count:
+            metrics.min_value = _python(moments.min, self.type)
+            metrics.max_value = _python(moments.max, self.type)
+            metrics.mean = moments.mean
+            metrics.lower_quartile = self.quantiles.quantile(0.25)
+            metrics.median = self.quantiles.quantile(0.5)
+            metrics.upper_quartile = self.quantiles.quantile(0.75)
+
+            # Tukey's fences
+            spread = 1.5 * (metrics.upper_quartile - metrics.lower_quartile)
+            low, high = self.quantiles.items_between(metrics.lower_quartile - spread, metrics.upper_quartile + spread)
+            metrics.min_excluding_outliers = _python(low, self.type)
+            metrics.max_excluding_outliers = _python(high, self.type)
+            metrics.statistical_outliers = [_python(value) for value in self.outliers.outliers]
+
+        if self.type == Field.INT:
+            self.sequence.populate(metrics)
+
+        elif self.type == Field.FLOAT and self.precision.count:
+            metrics.min_precision_length = int(self.precision.min)
+            metrics.max_precision_length = int(self.precision.max)
+            metrics.mean_precision_length = self.precision.mean
+
+        elif self.type == Field.STRING and self.lengths.count:
+            metrics.min_length = int(self.lengths.min)
+            metrics.max_length = int(self.lengths.max)
+            metrics.mean_length = self.lengths.mean
+            metrics.mask_matches = [[mask, count] for mask, count in self.masks.top(FieldSketch.TOP_VALUES)]
+
+        elif self.type in FieldSketch.DATES and self.dates.count:
+            metrics.min_date = pandas.Timestamp(int(self.dates.min))
+            metrics.max_date = pandas.Timestamp(int(self.dates.max))
+            metrics.contains_future_dates = metrics.max_date > pandas.Timestamp(time.time(), unit="s")
+            metrics.date_interval = self.intervals.interval
+
+    @staticmethod
+    def _decimals(numbers):
+        """ the number of digits after the decimal point of each float, found without formatting the numbers """
+        decimals = numpy.full(len(numbers), FieldSketch.MAX_DECIMALS, dtype=numpy.float64)
+        pending = numpy.isfinite(numbers)
+        for digits in range(FieldSketch.MAX_DECIMALS):
+            positions = numpy.flatnonzero(pending)
+            if not len(positions):
+                break
+            scaled = numbers[positions] * 10.0 ** digits
+            done = numpy.abs(scaled - numpy.round(scaled)) <= 1e-9 * numpy.maximum(1, numpy.abs(scaled))
+            decimals[positions[done]] = digits
+            pending[positions[done]] = False
+        return decimals
+
+
+class MetricsCollector:
+    """
+    Profiles the output fields of a processor while it streams: every chunk updates a few mergeable sketches per
+    field (HyperLogLog distinct counts, KLL quantiles, Misra-Gries frequent values and running moments), so memory
+    stays bounded whatever the size of the files. Nulls are counted before they're replaced or reported, values once
+    they're transformed, for the rows that are output. Collectors of several workers (or of consecutive parts of a
+    file) merge into one for the whole job; populate() fills each field's Metrics with the estimates.
+
+    With an error log, the anomalies the detectors find (breaks in sequences and date series, outliers and out of
+    place nulls) are added to it as warnings, at most max_warnings per field and detector.
+    """
+
+    def __init__(self, fields, error_log=None, max_warnings=100):
+        self.sketches = OrderedDict((field.name, FieldSketch(field.type, field.allow_null)) for field in fields)
+        self.error_log = error_log
+        self.max_warnings = max_warnings
+        self._reported = {}  # (field id, detector): number of warnings added
+        self._nulls = {}  # row labels of the nulls in the current chunk, per field
+
+    def reset(self):
+        self.sketches = OrderedDict((name, FieldSketch(sketch.type, sketch.null_detector is not None))
+                                    for name, sketch in self.sketches.items())
+        self._reported = {}
+        self._nulls = {}
+
+    def count_nulls(self, data):
+        """ counts the nulls of a chunk of mapped data, before they're replaced """
+        nulls = data.isnull()
+        self._nulls = {}
+        for field_id, (name, sketch) in enumerate(self.sketches.items()):
+            column = nulls[name].values
+            rows = data.index[column]
+            if column.any():
+                self._nulls[name] = rows
+            self._report(field_id, rows.values, sketch.count_nulls(len(data), rows.values))
+
+    def update(self, data):
+        """ adds the values of a transformed chunk, leaving out the nulls counted before """
+        for field_id, (name, sketch) in enumerate(self.sketches.items()):
+            values = data[name]
+            if name in self._nulls:
+                values = values.drop(self._nulls[name], errors="ignore")
+            values = values.dropna()
+            self._report(field_id, values.index.values, sketch.update(values))
+        self._nulls = {}
+
+    def _report(self, field_id, rows, anomalies):
+        """ adds the anomalies found in a chunk as warnings, rows being the row labels the detectors saw """
+        if self.error_log is None:
+            return
+
+        for detector, positions, describe in anomalies:
+            reported = self._reported.get((field_id, detector), 0)
+            count = min(len(positions), self.max_warnings - reported)
+            if count > 0:
+                self.error_log.add(ErrorLog.WARNING, ErrorLog.ANOMALY, field_id, rows[positions[:count]],
+                                   [describe(i) for i in range(count)])
+                self._reported[(field_id, detector)] = reported + count
+
+    def merge(self, other):
+        for name, sketch in self.sketches.items():
+            sketch.merge(other.sketches[name])
+
+    def populate(self, fields):
+        """ fills field.metrics of the fields with the estimates """
+        for field in fields:
+            field._metrics = Metrics()
+            self.sketches[field.name].populate(field.metrics)
+
+
+def _keep(examples, values):
+    examples.extend(values[:MAX_EXAMPLES - len(examples)])
+
+
+def _date(nanoseconds):
+    """ a date read from nanoseconds since the epoch, without a time at midnight """
+    date = pandas.Timestamp(nanoseconds)
+    return str(date.date()) if date == date.normalize() else str(date)
+
+
+def _python(value, type=None):
+    """ converts numpy scalars to python values, e.g. so metrics can be serialized """
+    if value is None:
+        return None
+    if type == Field.INT:
+        return int(value)
+    return value.item() if isinstance(value, numpy.generic) else value
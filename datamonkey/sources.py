@@ -0,0 +1,447 @@
+import os
+import re
+import shutil
+import hashlib
+import datetime
+import tempfile
+import ujson as json
+
+from collections import OrderedDict
+
+from datamonkey.helpers import check_S3_path, get_file_identity, LazyModule
+from datamonkey.models import File
+from datamonkey.settings import SOURCE_CACHE_DIR
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+
+class SourceCache:
+    """
+    Keeps parsed source files on disk in a columnar layout, so runs on an unchanged file skip parsing it and only load
+    the columns they use. Files are parsed chunk by chunk and every column is memory-mapped: numeric, boolean and date
+    columns as raw arrays, text columns as a TextColumn. Columns are added as templates need them, so templates
+    describing the same file share its cache. Entries are keyed by the file's path, size and modification time (ETag on
+    S3) and the settings it's read with.
+    """
+
+    FORMAT = 2  # layout of the entries, entries of other layouts are parsed again
+    CHUNK_ROWS = 100000  # rows parsed at a time when columns are added to an entry
+
+    def __init__(self, cache_dir=SOURCE_CACHE_DIR):
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def read(self, source_file, source_fields, used_fields=None, chunk_data=False, start_row=0):
+        """
+        Returns the used fields of a source file, as a ColumnarReader when chunk_data is set (skipping the first
+        start_row rows) or else as a data frame. Columns that aren't cached yet are parsed from the file first.
+        """
+        used = [(i, field) for i, field in enumerate(source_fields) if source_file._is_used(field, used_fields)]
+        names = [self._column_name(source_file, i, field) for i, field in used]
+
+        identity = get_file_identity(source_file.file_path, source_file.s3_path)
+        entry_dir = os.path.join(self.cache_dir, self._key(source_file, source_fields, identity))
+        manifest = self._read_manifest(entry_dir)
+
+        missing = [(name, field) for (i, field), name in zip(used, names) if name not in manifest["columns"]]
+        if missing:
+            self._add_columns(entry_dir, manifest, identity, source_file, source_fields, missing)
+
+        columns = [self._load_column(entry_dir, manifest["columns"][name], manifest["rows"]) for name in names]
+        reader = ColumnarReader(names, columns, manifest["rows"], start_row)
+        return reader if chunk_data else reader.read()
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    @staticmethod
+    def _column_name(source_file, index, field):
+        """ the name the readers give a column """
+        if source_file.has_header or source_file.type == File.JSON:
+            return field.name
+        return "Column %d" % (index + 1)
+
+    @staticmethod
+    def _key(source_file, source_fields, identity):
+        settings = [identity, source_file.type, source_file.has_header, source_file.skip_rows, source_file.sheet_name,
+                    source_file.line_delimited_JSON, source_file.delimiter,
+                    [[field.name, field.col_specs] for field in source_fields]]
+        return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+    @staticmethod
+    def _read_manifest(entry_dir):
+        path = os.path.join(entry_dir, "manifest.json")
+        if os.path.isfile(path):
+            try:
+                with open(path) as file:
+                    manifest = json.load(file)
+                if manifest.get("format") == SourceCache.FORMAT:
+                    return manifest
+            except ValueError:
+                pass  # a corrupt manifest is treated as an empty entry
+
+        return {"format": SourceCache.FORMAT, "rows": None, "columns": {}}
+
+    def _add_columns(self, entry_dir, manifest, identity, source_file, source_fields, columns):
+        """
+        Parses the (name, field) columns of the file a chunk at a time into the entry. A column pandas types
+        differently from one chunk to the next, other than integers that turn out to have nulls, is parsed again in
+        one piece, so it's typed as it would be for the whole file.
+        """
+        if not os.path.isdir(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+            self._remove_stale_entries(identity)
+
+        writers = OrderedDict((name, ColumnWriter(entry_dir)) for name, _ in columns)
+        try:
+            rows = 0
+            for data in self._chunks(source_file, source_fields, [field for _, field in columns]):
+                for name, writer in writers.items():
+                    writer.append(data[name].values)
+                rows += len(data)
+
+            mixed = [(name, field) for name, field in columns if writers[name].mixed]
+            if mixed:
+                data, _ = source_file.process_file(source_fields, used_fields=[field for _, field in mixed])
+                for name, _ in mixed:
+                    writers[name].discard()
+                    writers[name] = ColumnWriter(entry_dir)
+                    writers[name].append(data[name].values)
+
+            if manifest["rows"] != rows:
+                manifest["columns"] = {}  # shouldn't happen for an unchanged file, start over rather than mix columns
+            manifest["rows"] = rows
+            manifest["path"] = identity[0]
+            manifest["identity"] = identity
+
+            for name, writer in writers.items():
+                manifest["columns"][name] = writer.close(hashlib.sha1(str(name).encode()).hexdigest())
+
+        except BaseException:
+            for writer in writers.values():
+                writer.discard()
+            raise
+
+        handle, temp_path = tempfile.mkstemp(dir=entry_dir, suffix=".tmp")
+        with os.fdopen(handle, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, os.path.join(entry_dir, "manifest.json"))
+
+    @staticmethod
+    def _chunks(source_file, source_fields, fields):
+        """ the fields of the file, a chunk at a time for the file types that are read in chunks """
+        data, _ = source_file.process_file(source_fields, chunk_data=True, used_fields=fields)
+        if isinstance(data, pandas.DataFrame):
+            yield data
+            return
+
+        try:
+            while True:
+                try:
+                    yield data.get_chunk(SourceCache.CHUNK_ROWS)
+                except StopIteration:
+                    return
+        finally:
+            data.close()
+
+    @staticmethod
+    def _load_column(entry_dir, column, rows):
+        path = os.path.join(entry_dir, column["file"])
+        if column["dtype"] == ColumnWriter.TEXT:
+            return TextColumn(path, rows)
+        return _map(path + ".values", column["dtype"], rows)
+
+    def _remove_stale_entries(self, identity):
+        """ removes the entries of earlier versions of a file """
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            manifest = self._read_manifest(entry_dir)
+            if manifest.get("path") == identity[0] and manifest.get("identity") != identity:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+
+class ColumnWriter:
+    """
+    Appends the chunks of one column to temporary files of a cache entry, which close() moves in place. Arrays are
+    written raw in the type of the first chunk; integers become floats once a chunk has nulls, as pandas types such a
+    column when it reads the whole file. Object arrays are written as a TextColumn. A column whose chunks have any
+    other mix of types is flagged as mixed and no longer written.
+    """
+
+    TEXT = "text"  # the type of text columns in the manifest
+
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+        self.dtype = None  # of the values written so far
+        self.mixed = False
+        self._files = OrderedDict()  # part -> (temporary path, file)
+        self._text_bytes = 0
+
+    def append(self, values):
+        if self.mixed or not len(values):
+            return
+
+        if self.dtype is None:
+            self.dtype = values.dtype
+        elif values.dtype != self.dtype:
+            if values.dtype.kind not in "iuf" or self.dtype.kind not in "iuf":
+                self.mixed = True
+                self.discard()
+                return
+
+            dtype = numpy.result_type(self.dtype, values.dtype)
+            if dtype != self.dtype:
+                self._convert(dtype)
+            values = values.astype(dtype)
+
+        if self.dtype == object:
+            self._append_text(values)
+        else:
+            self._write("values", numpy.ascontiguousarray(values).tobytes())
+
+    def _append_text(self, values):
+        kinds = numpy.full(len(values), TextColumn.STRING, dtype=numpy.int8)
+        texts = []
+        for i, value in enumerate(values):
+            if type(value) is not str:
+                kinds[i], value = TextColumn.encode(value)
+            texts.append(value.encode("utf-8", "surrogatepass"))
+
+        ends = numpy.cumsum([len(text) for text in texts], dtype=numpy.int64) + self._text_bytes
+        self._write("text", b"".join(texts))
+        self._write("ends", ends.tobytes())
+        self._write("kinds", kinds.tobytes())
+        self._text_bytes = int(ends[-1])
+
+    def _convert(self, dtype):
+        """ rewrites the values written so far in a wider numeric type """
+        temp_path, file = self._files["values"]
+        file.flush()
+        values = numpy.fromfile(temp_path, dtype=self.dtype).astype(dtype)
+        file.seek(0)
+        file.truncate()
+        file.write(values.tobytes())
+        self.dtype = dtype
+
+    def _write(self, part, data):
+        if part not in self._files:
+            handle, temp_path = tempfile.mkstemp(dir=self.entry_dir, suffix=".tmp")
+            self._files[part] = (temp_path, os.fdopen(handle, "wb"))
+        self._files[part][1].write(data)
+
+    def close(self, file_name):
+        """ moves the files in place as file_name.<part> and returns the column's manifest entry """
+        if self.dtype is None:
+            self.dtype = numpy.dtype(object)  # no rows, read as text like empty files are
+
+        text = self.dtype == object
+        for part in ["text", "ends", "kinds"] if text else ["values"]:
+            self._write(part, b"")  # parts of columns without rows are empty files
+            temp_path, file = self._files.pop(part)
+            file.close()
+            os.replace(temp_path, os.path.join(self.entry_dir, "%s.%s" % (file_name, part)))
+
+        return {"file": file_name, "dtype": ColumnWriter.TEXT if text else self.dtype.str}
+
+    def discard(self):
+        """ removes the temporary files """
+        for temp_path, file in self._files.values():
+            file.close()
+            os.remove(temp_path)
+        self._files.clear()
+
+
+class TextColumn:
+    """
+    A memory-mapped text column of the source cache: the UTF-8 text of its values end to end, the offset each value
+    ends at and its kind, so values that aren't strings (nulls, and the numbers and dates of Excel and JSON files) are
+    returned as they were parsed. Values are only decoded when a range of rows is sliced.
+    """
+
+    NULL, STRING, INT, FLOAT, BOOLEAN, TIMESTAMP, JSON = range(7)
+
+    def __init__(self, path, rows):
+        self.ends = _map(path + ".ends", numpy.int64, rows)
+        self.kinds = _map(path + ".kinds", numpy.int8, rows)
+        self.text = _map(path + ".text", numpy.uint8, int(self.ends[-1]) if rows else 0)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, rows):
+        start, stop, _ = rows.indices(len(self))
+        values = numpy.empty(max(stop - start, 0), dtype=object)
+        if not len(values):
+            return values
+
+        first = int(self.ends[start - 1]) if start else 0
+        ends = numpy.asarray(self.ends[start:stop]) - first
+        starts = numpy.concatenate([[0], ends[:-1]])
+        data = self.text[first:first + int(ends[-1])].tobytes()
+
+        text = data.decode("utf-8", "surrogatepass")
+        if len(text) == len(data):
+            values[:] = [text[begin:end] for begin, end in zip(starts, ends)]  # ASCII, offsets are characters too
+        else:
+            values[:] = [data[begin:end].decode("utf-8", "surrogatepass") for begin, end in zip(starts, ends)]
+
+        kinds = numpy.asarray(self.kinds[start:stop])
+        for i in numpy.flatnonzero(kinds != TextColumn.STRING):
+            values[i] = TextColumn.decode(kinds[i], values[i])
+        return values
+
+    @staticmethod
+    def encode(value):
+        """ the kind and text a value that isn't a string is kept as """
+        if value is None:
+            return TextColumn.NULL, ""
+        if isinstance(value, (bool, numpy.bool_)):
+            return TextColumn.BOOLEAN, "1" if value else ""
+        if isinstance(value, (int, numpy.integer)):
+            return TextColumn.INT, str(value)
+        if isinstance(value, (float, numpy.floating)):
+            return TextColumn.FLOAT, repr(float(value))
+        if isinstance(value, datetime.datetime):
+            return TextColumn.TIMESTAMP, value.isoformat()
+        try:
+            return TextColumn.JSON, json.dumps(value)
+        except (TypeError, ValueError, OverflowError):
+            return TextColumn.STRING, str(value)
+
+    @staticmethod
+    def decode(kind, text):
+        if kind == TextColumn.NULL:
+            return None
+        if kind == TextColumn.BOOLEAN:
+            return text == "1"
+        if kind == TextColumn.INT:
+            return int(text)
+        if kind == TextColumn.FLOAT:
+            return float(text)
+        if kind == TextColumn.TIMESTAMP:
+            return pandas.Timestamp(text)
+        return json.loads(text)
+
+
+def _map(path, dtype, count):
+    """ memory-maps an array of count values written raw; empty files can't be mapped """
+    if not count:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class ColumnarReader:
+    """
+    Reads cached columns in chunks, like the readers pandas returns for chunked files: after skipping start_row
+    rows, chunks are numbered from 0 and StopIteration is raised at the end of the data.
+    """
+
+    def __init__(self, names, columns, rows, start_row=0):
+        self.names = names
+        self.columns = columns
+        self.rows = rows
+        self.start_row = start_row
+        self.position = min(start_row, rows)
+
+    def get_chunk(self, size):
+        if self.position >= self.rows:
+            raise StopIteration()
+
+        end = min(self.rows, self.position + size)
+        data = self._frame(self.position, end)
+        self.position = end
+        return data
+
+    def read(self):
+        """ returns all remaining rows """
+        data = self._frame(self.position, self.rows)
+        self.position = self.rows
+        return data
+
+    def close(self):
+        self.columns = []  # releases the memory-mapped files
+
+    def _frame(self, start, end):
+        # only the rows of the chunk are copied out of the memory-mapped columns
+        return pandas.DataFrame(OrderedDict((name, column[start:end]) for name, column in zip(self.names, self.columns)),
+                                index=pandas.RangeIndex(start - self.start_row, end - self.start_row),
+                                columns=self.names)
+
+
+class RecordReader:
+    """
+    Reads a CSV, FWF or line delimited JSON file a chunk of records at a time, like the readers pandas returns for
+    chunked files, and keeps the byte offset the last chunk ended at. A reader opened at that offset continues with the
+    next record without parsing the ones before it; offset 0 starts after the preamble (skipped rows and header). Records
+    end at line breaks, except in quoted fields of files with a delimiter; parse(data) turns the bytes of a chunk's
+    records into a frame. Chunks are numbered from 0 and StopIteration is raised at the end of the file.
+    """
+
+    COMPRESSED = (".gz", ".bz2", ".zip", ".xz")  # extensions pandas decompresses, which can't be read from an offset
+
+    def __init__(self, file_path, parse, offset=0, preamble=0, delimiter=None):
+        self.parse = parse
+        self.rows = 0
+        self.record = None if delimiter is None else _complete_record(delimiter)
+        if check_S3_path(file_path):
+            import s3fs
+            self.file = s3fs.S3FileSystem().open(file_path, "rb")
+        else:
+            self.file = open(file_path, "rb")
+
+        if offset:
+            self.file.seek(offset)
+        else:
+            for _ in range(preamble):
+                self._next_record()
+        self.offset = self.file.tell()
+
+    def get_chunk(self, size):
+        if self.file is None:
+            raise StopIteration()
+
+        records = []
+        while len(records) < size:
+            record = self._next_record()
+            if not record:
+                break
+            if record.rstrip(b"\r\n"):  # blank lines aren't rows
+                records.append(record)
+
+        if not records:
+            self.close()
+            raise StopIteration()
+
+        data = self.parse(b"".join(records))
+        data.index = pandas.RangeIndex(self.rows, self.rows + len(data))
+        self.rows += len(data)
+        self.offset = self.file.tell()
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _next_record(self):
+        """ the bytes of the next record with its line break, empty at the end of the file """
+        record = self.file.readline()
+        if self.record is not None and b'"' in record:
+            # a line break in a quoted field continues the record on the next line
+            while not self.record.fullmatch(record.rstrip(b"\r\n")):
+                line = self.file.readline()
+                if not line:
+                    break
+                record += line
+        return record
+
+
+def _complete_record(delimiter):
+    """
+    an expression matching the fields of a record whose quoted fields are all closed: like pandas, a quote only opens a
+    field at its start, and a doubled quote inside a quoted field is a quote
+    """
+    delimiter = re.escape(delimiter.encode("utf-8"))
+    field = b'(?:"(?:[^"]|"")*"(?:[^"%s][^%s]*)?|[^"%s][^%s]*|)' % (delimiter, delimiter, delimiter, delimiter)
+    return re.compile(b"%s(?:%s%s)*" % (field, delimiter, field))
@@ -0,0 +1,128 @@
+import os
+import time
+import tempfile
+import ujson as json
+
+from datamonkey.settings import BASE_API_URL, API_TIMEOUT, API_POOL_SIZE, TEMPLATE_CACHE_DIR, TEMPLATE_CACHE_TTL
+
+_session = None
+
+
+def get_session():
+    """ A single HTTP session is shared by all processors so connections to the API are pooled and reused. """
+    global _session
+
+    if _session is None:
+        import requests
+        import requests.adapters
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=API_POOL_SIZE, pool_maxsize=API_POOL_SIZE)
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+
+    return _session
+
+
+class TemplateCache:
+    """
+    Retrieves file templates from the API and keeps a copy on disk. Cached templates are used without contacting the
+    API until their time-to-live expires; after that they're revalidated with a conditional request (ETag) and the
+    cached copy is used as a fallback whenever the API can't be reached.
+    """
+
+    def __init__(self, cache_dir=TEMPLATE_CACHE_DIR, ttl=TEMPLATE_CACHE_TTL, api_url=BASE_API_URL, timeout=API_TIMEOUT):
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None  # no disk cache if not set
+        self.ttl = ttl  # seconds a cached template is used before it's revalidated
+        self.api_url = api_url
+        self.timeout = timeout  # seconds to wait for the API before falling back to the cache
+
+    def retrieve(self, template_id):
+        """ Returns the template for the id, from the cache when it's fresh or still valid, otherwise from the API. """
+        entry = self._read_entry(template_id)
+
+        if entry is not None and time.time() - entry["fetchedAt"] < self.ttl:
+            return entry["template"]
+
+        import requests
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        url = self.api_url + 'configurations/{id}'.format(id=template_id)
+        try:
+            response = get_session().get(url, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            if entry is None:
+                raise err
+
+            print("WARNING: Unable to reach the Data Monkey API (%s); using the cached copy of template %s (version: %s)."
+                  % (err.__class__.__name__, template_id, entry["version"]))
+            return entry["template"]
+
+        if response.status_code == requests.codes.NOT_MODIFIED and entry is not None:
+            self._write_entry(template_id, entry["template"], entry.get("etag"))
+            return entry["template"]
+
+        elif response.status_code == requests.codes.OK:
+            template = response.json()
+            self._write_entry(template_id, template, response.headers.get("ETag"))
+            return template
+
+        elif response.status_code == requests.codes.NOT_FOUND:
+            self.remove(template_id)
+            raise ValueError("Unable to retrieve configuration for Configuration Id: %s. Please verify the configuration "
+                             "Id on your profile at https://datamonkey.io." % template_id)
+
+        elif response.status_code >= 500 and entry is not None:
+            print("WARNING: The Data Monkey API returned an error (%d); using the cached copy of template %s (version: %s)."
+                  % (response.status_code, template_id, entry["version"]))
+            return entry["template"]
+
+        else:
+            response.raise_for_status()
+
+    def remove(self, template_id):
+        path = self._entry_path(template_id)
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    def _entry_path(self, template_id):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, "%s.json" % template_id)
+
+    def _read_entry(self, template_id):
+        path = self._entry_path(template_id)
+        if not path or not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path) as file:
+                entry = json.load(file)
+        except ValueError:
+            # a corrupt cache entry is treated as a miss
+            return None
+
+        return entry if entry.get("id") == template_id else None
+
+    def _write_entry(self, template_id, template, etag=None):
+        path = self._entry_path(template_id)
+        if not path:
+            return
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry = {"id": template_id,
+                 "version": template.get("version", ""),
+                 "etag": etag,
+                 "fetchedAt": time.time(),
+                 "template": template}
+
+        # write to a temporary file first so concurrent workers never read a partially written entry
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(handle, "w") as file:
+            json.dump(entry, file)
+        os.replace(temp_path, path)
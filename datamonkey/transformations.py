@@ -1,8 +1,13 @@
 import re
+import numpy
 import operator
 import pandas
 
-from pandas._libs.tslibs.timestamps import Timestamp
+from pandas import Timestamp
+
+from datamonkey.patterns import SubstringMatcher, RegexMatcher
+from datamonkey.references import ReferenceTable
+from datamonkey.uniqueness import hash_keys
 
 equality_operators = {
     'LE': (operator.le, 'less than or equals'),
@@ -136,22 +141,25 @@ def validate_by_date_range(value, params):
 def validate_by_list(value, params):
     if params['operator'] == "EXCLUDE":
         if value in params['values']:
-            message = "'%s' is in the list of prohibited values (%s)" % (value, ', '.join(params["values"]))
+            message = "'%s' is in the list of prohibited values (%s)" % (value, params['values'].describe())
             return value, 'ERROR' if params['stopOnInvalid'] else 'WARN', message
         else:
             return value, None, None
 
     elif params['operator'] == "INCLUDE":
         if value not in params['values']:
-            message = "'%s' is not in the list of accepted values (%s)" % (value, ', '.join(params["values"]))
+            message = "'%s' is not in the list of accepted values (%s)" % (value, params['values'].describe())
             return value, 'ERROR' if params['stopOnInvalid'] else 'WARN', message
         else:
             return value, None, None
 
 
 def validate_by_regex(value, params):
-    if not re.match(params['value'], value):
-        message = "'%s 'did not match the specified regex (%s)" % (value, params['value'])
+    if not params['matcher'].matches(value):
+        if len(params['patterns']) == 1:
+            message = "'%s 'did not match the specified regex (%s)" % (value, params['patterns'].describe())
+        else:
+            message = "'%s 'did not match any of the specified regexes (%s)" % (value, params['patterns'].describe())
         return value, 'ERROR' if params['stopOnInvalid'] else 'WARN', message
     else:
         return value, None, None
@@ -188,15 +196,20 @@ def validate_by_date_value(value, params):
 
 def validate_by_substring(value, params):
     if params['operator'] == "INCLUDE":
-        if value.find(params['value']) == -1:
-            message = "'%s 'did not contain the expected value '%s'" % (value, params['value'])
+        if params['matcher'].find(value) is None:
+            if len(params['patterns']) == 1:
+                message = "'%s 'did not contain the expected value '%s'" % (value, params['patterns'].describe())
+            else:
+                message = "'%s 'did not contain any of the expected values (%s)" % (value,
+                                                                                   params['patterns'].describe())
             return value, 'ERROR' if params['stopOnInvalid'] else 'WARN', message
         else:
             return value, None, None
 
     if params['operator'] == "EXCLUDE":
-        if value.find(params['value']) != -1:
-            message = "'%s ' contained the invalid value '%s'" % (value, params['value'])
+        found = params['matcher'].find(value)
+        if found is not None:
+            message = "'%s ' contained the invalid value '%s'" % (value, params['patterns'].keys[found])
             return value, 'ERROR' if params['stopOnInvalid'] else 'WARN', message
         else:
             return value, None, None
@@ -222,7 +235,7 @@ def filter_by_list(value, params):
 
 
 def filter_by_regex(value, params):
-    return value, "FILTER" if not re.match(params['value'], value) else None, None
+    return value, "FILTER" if not params['matcher'].matches(value) else None, None
 
 
 def filter_by_length(value, params):
@@ -243,9 +256,127 @@ def filter_by_date_value(value, params):
 
 def filter_by_substring(value, params):
     if params['operator'] == "INCLUDE":
-        return value, "FILTER" if value.find(params['value']) == -1 else None, None
+        return value, "FILTER" if params['matcher'].find(value) is None else None, None
     if params['operator'] == "EXCLUDE":
-        return value, "FILTER" if value.find(params['value']) != -1 else None, None
+        return value, "FILTER" if params['matcher'].find(value) is not None else None, None
+
+
+# *** Column Operations ***
+# applied to the values of a field in a chunk at once, with the KeySet of the operation (kept across chunks, for
+# uniqueness) and the chunk's output data; they return the values, an action per value and a message per action
+
+def modify_lookup(values, params, keys, data):
+    mapped, found = params['table'].lookup(values)
+    actions = numpy.full(len(values), None, dtype=object)
+    messages = numpy.full(len(values), None, dtype=object)
+
+    missing = params.get('onMissing', 'KEEP')
+    if missing != 'KEEP' and not found.all():
+        actions[~found] = missing
+        messages[~found] = ["'%s' was not found in the lookup table" % value for value in values.values[~found]]
+    return mapped, actions, messages
+
+
+def validate_unique(values, params, keys, data):
+    seen = keys.add(_hash_unique_keys(values, params, data))
+    messages = numpy.full(len(values), None, dtype=object)
+    messages[seen] = [_duplicate_message(value, params) for value in values.values[seen]]
+    return values, numpy.where(seen, 'ERROR' if params['stopOnInvalid'] else 'WARN', None), messages
+
+
+def filter_duplicate(values, params, keys, data):
+    seen = keys.add(_hash_unique_keys(values, params, data))
+    return values, numpy.where(seen, "FILTER", None), numpy.full(len(values), None, dtype=object)
+
+
+def _hash_unique_keys(values, params, data):
+    """ the key of each row: the value, plus the values of the other output fields in params['fields'] if set """
+    return hash_keys([values] + [data[name].loc[values.index] for name in params.get('fields', [])])
+
+
+def _duplicate_message(value, params):
+    if params.get('fields'):
+        return "'%s' was already found in an earlier row with the same %s" % (value, ', '.join(params['fields']))
+    return "'%s' was already found in an earlier row" % value
+
+
+# *** Parameters ***
+# parameters are prepared once per template, e.g. reference lists are indexed, when the transformations are compiled
+
+LOOKUP_MISSING_ACTIONS = frozenset(['KEEP', 'WARN', 'ERROR', 'FILTER'])
+
+
+def prepare_list(params, field_type):
+    """ the values of a list operation, inline or from a reference file ('file', 'column', 'delimiter') """
+    if params.get('file'):
+        table = ReferenceTable.from_file(params['file'], params.get('column'), None, params.get('delimiter', ','),
+                                         field_type)
+    else:
+        table = ReferenceTable(list(params.get('values', [])))
+    return dict(params, values=table)
+
+
+def prepare_lookup(params, field_type):
+    """ the table of MODIFY_LOOKUP, inline ('values' mapping keys to values) or from a reference file """
+    if params.get('onMissing', 'KEEP') not in LOOKUP_MISSING_ACTIONS:
+        raise ValueError("%s is not a valid action for values missing from a lookup table." % params['onMissing'])
+
+    if params.get('file'):
+        if not params.get('keyColumn') or not params.get('valueColumn'):
+            raise ValueError("Lookup tables read from a file need a keyColumn and a valueColumn.")
+        table = ReferenceTable.from_file(params['file'], params['keyColumn'], params['valueColumn'],
+                                         params.get('delimiter', ','), field_type)
+    else:
+        mapping = params.get('values', {})
+        table = ReferenceTable(list(mapping.keys()), list(mapping.values()))
+    return dict(params, table=table)
+
+
+def prepare_patterns(params, field_type):
+    """
+    the patterns of a substring or regex operation: one ('value'), a list ('values') or a file with one per line
+    ('file', or a 'column' of a delimited file); values contain a substring, or match a regex, if any of them does
+    """
+    if params.get('file'):
+        patterns = ReferenceTable.from_file(params['file'], params.get('column'), None, params.get('delimiter', ','))
+    elif 'values' in params:
+        patterns = ReferenceTable(list(params['values']))
+    else:
+        patterns = ReferenceTable([params['value']])
+
+    if not len(patterns):
+        raise ValueError("Substring and regex transformations need at least one pattern.")
+    return dict(params, patterns=patterns)
+
+
+def prepare_substrings(params, field_type):
+    params = prepare_patterns(params, field_type)
+    params['matcher'] = SubstringMatcher(params['patterns'].keys)
+    return params
+
+
+def prepare_regexes(params, field_type):
+    params = prepare_patterns(params, field_type)
+    try:
+        params['matcher'] = RegexMatcher(params['patterns'].keys)
+    except re.error as err:
+        raise ValueError("The regex transformation has an invalid pattern: %s" % err)
+    return params
+
+
+PREPARE_MAP = {"VALIDATE_BY_LIST": prepare_list,
+               "FILTER_BY_LIST": prepare_list,
+               "VALIDATE_BY_SUBSTRING": prepare_substrings,
+               "FILTER_BY_SUBSTRING": prepare_substrings,
+               "VALIDATE_BY_REGEX": prepare_regexes,
+               "FILTER_BY_REGEX": prepare_regexes,
+               "MODIFY_LOOKUP": prepare_lookup}
+
+
+def prepare_parameters(operation, params, field_type):
+    """ the parameters a transformation function is called with """
+    prepare = PREPARE_MAP.get(operation)
+    return prepare(params, field_type) if prepare is not None else params
 
 
 # *** Function Mapping ***
@@ -253,6 +384,7 @@ def filter_by_substring(value, params):
 FUNCTION_MAP = {"MODIFY_DO_MATH": modify_do_math,
                 "MODIFY_CHANGE_DATE_FORMAT": modify_change_date_format,
                 "MODIFY_ROUND_NUMBER": modify_round_number,
+                "MODIFY_LOOKUP": modify_lookup,
                 "MODIFY_TRIM_STRING": modify_trim_string,
                 "MODIFY_REMOVE_WHITESPACE": modify_remove_whitespace,
                 "MODIFY_CHANGE_CASE": modify_change_case,
@@ -269,6 +401,7 @@ FUNCTION_MAP = {"MODIFY_DO_MATH": modify_do_math,
                 "VALIDATE_BY_REGEX": validate_by_regex,
                 "VALIDATE_BY_LENGTH": validate_by_length,
                 "VALIDATE_BY_SUBSTRING": validate_by_substring,
+                "VALIDATE_UNIQUE": validate_unique,
                 "FILTER_BY_RANGE": filter_by_range,
                 "FILTER_BY_VALUE": filter_by_value,
                 "FILTER_BY_DATE_RANGE": filter_by_date_range,
@@ -276,4 +409,5 @@ FUNCTION_MAP = {"MODIFY_DO_MATH": modify_do_math,
                 "FILTER_BY_LIST": filter_by_list,
                 "FILTER_BY_REGEX": filter_by_regex,
                 "FILTER_BY_SUBSTRING": filter_by_substring,
-                "FILTER_BY_LENGTH": filter_by_length}
+                "FILTER_BY_LENGTH": filter_by_length,
+                "FILTER_DUPLICATE": filter_duplicate}
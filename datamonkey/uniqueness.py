@@ -0,0 +1,170 @@
+import os
+import shutil
+import tempfile
+
+from datamonkey.helpers import LazyModule
+from datamonkey.settings import UNIQUE_KEYS_MAX_MEMORY
+
+numpy = LazyModule("numpy")
+pandas = LazyModule("pandas")
+
+
+class KeySet:
+    """
+    The 64-bit hashes of the keys seen so far, e.g. by VALIDATE_UNIQUE across the chunks of a file. Hashes are kept in
+    an open addressing table (a numpy array probed linearly, a batch at a time); once it would outgrow max_memory,
+    its hashes are written to disk as a sorted run and the table starts over. Runs are searched with binary searches
+    on memory-mapped files. An optional Bloom filter over every key answers most lookups of new keys without
+    searching the runs. Two keys are only mistaken for each other if their hashes collide, which is unlikely below
+    billions of keys.
+    """
+
+    EMPTY = 0  # marks free slots; a hash of 0 is stored as 1
+    MAX_LOAD = 0.5
+    BLOOM_HASHES = 7
+
+    def __init__(self, max_memory=UNIQUE_KEYS_MAX_MEMORY, bloom_filter=False, spill_dir=None):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.count = 0  # keys in the table
+        self.runs = []  # sorted arrays of spilled hashes, memory-mapped
+        self._directory = None
+        self._table = numpy.zeros(1024, dtype=numpy.uint64)
+
+        # a quarter of the memory goes to the Bloom filter, if there is one; a byte per bit, so bits are set in bulk
+        self.bloom = numpy.zeros(max(max_memory // 4, 64), dtype=bool) if bloom_filter else None
+        self.max_slots = max((max_memory - (0 if self.bloom is None else len(self.bloom))) // 8, 1024)
+
+    def __len__(self):
+        return self.count + sum(len(run) for run in self.runs)
+
+    def add(self, hashes):
+        """ adds an array of uint64 hashes and returns whether each was seen before, including earlier in the array """
+        hashes = numpy.where(hashes == KeySet.EMPTY, numpy.uint64(1), hashes).astype(numpy.uint64)
+        seen = pandas.Series(hashes).duplicated().values  # repeats within the batch
+        first = numpy.flatnonzero(~seen)
+        candidates = hashes[first]
+
+        if self.bloom is not None:
+            # keys the filter hasn't seen are new for sure, only the others have to be looked up
+            maybe = self._bloom_test(candidates)
+            self._bloom_add(candidates)
+        else:
+            maybe = numpy.ones(len(candidates), dtype=bool)
+
+        known = numpy.zeros(len(candidates), dtype=bool)
+        lookup = numpy.flatnonzero(maybe)
+        if len(lookup):
+            known[lookup] = self._contains(candidates[lookup])
+
+        seen[first[known]] = True
+        self._insert(candidates[~known])
+        return seen
+
+    def close(self):
+        """ removes the spilled runs """
+        self.runs = []
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def _contains(self, hashes):
+        found = self._probe(hashes)[1]
+        for run in self.runs:
+            rest = numpy.flatnonzero(~found)
+            if not len(rest):
+                break
+            positions = numpy.searchsorted(run, hashes[rest])
+            positions[positions == len(run)] = len(run) - 1
+            found[rest[run[positions] == hashes[rest]]] = True
+        return found
+
+    def _probe(self, hashes):
+        """ the slot of each hash in the table: where it's stored, or else the free slot that ends its probe """
+        table = self._table
+        mask = numpy.uint64(len(table) - 1)
+        slots = (hashes & mask).astype(numpy.int64)
+        found = numpy.zeros(len(hashes), dtype=bool)
+        pending = numpy.arange(len(hashes))
+        while len(pending):
+            values = table[slots[pending]]
+            found[pending[values == hashes[pending]]] = True
+            pending = pending[(values != hashes[pending]) & (values != KeySet.EMPTY)]
+            slots[pending] = (slots[pending] + 1) & int(mask)
+        return slots, found
+
+    def _insert(self, hashes):
+        """ inserts hashes that aren't in the table yet (nor repeated) """
+        if not len(hashes):
+            return
+
+        if (self.count + len(hashes)) > KeySet.MAX_LOAD * len(self._table):
+            size = len(self._table)
+            while (self.count + len(hashes)) > KeySet.MAX_LOAD * size:
+                size *= 2
+            if size > self.max_slots and self.count:
+                self._spill()
+                size = len(self._table)
+                while len(hashes) > KeySet.MAX_LOAD * size:
+                    size *= 2
+            self._resize(size)
+
+        pending = hashes
+        while len(pending):
+            slots, _ = self._probe(pending)
+            # hashes probing to the same free slot take turns: the one written last keeps it, the others probe on
+            self._table[slots] = pending
+            pending = pending[self._table[slots] != pending]
+        self.count += len(hashes)
+
+    def _resize(self, size):
+        stored = self._table[self._table != KeySet.EMPTY]
+        self._table = numpy.zeros(size, dtype=numpy.uint64)
+        self.count = 0
+        self._insert(stored)
+
+    def _spill(self):
+        """ writes the hashes in the table to a sorted run on disk and empties the table """
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="datamonkey-keys-", dir=self.spill_dir)
+
+        path = os.path.join(self._directory, "run_%d.npy" % len(self.runs))
+        numpy.save(path, numpy.sort(self._table[self._table != KeySet.EMPTY]))
+        self.runs.append(numpy.load(path, mmap_mode="r"))
+        self._table = numpy.zeros(1024, dtype=numpy.uint64)
+        self.count = 0
+
+    def _bloom_positions(self, hashes):
+        """ the bits of each hash, by double hashing its two halves """
+        bits = numpy.uint64(len(self.bloom))
+        low, high = hashes & numpy.uint64(0xFFFFFFFF), (hashes >> numpy.uint64(32)) | numpy.uint64(1)
+        return [((low + numpy.uint64(i) * high) % bits).astype(numpy.int64) for i in range(KeySet.BLOOM_HASHES)]
+
+    def _bloom_test(self, hashes):
+        found = numpy.ones(len(hashes), dtype=bool)
+        for positions in self._bloom_positions(hashes):
+            found &= self.bloom[positions]
+        return found
+
+    def _bloom_add(self, hashes):
+        for positions in self._bloom_positions(hashes):
+            self.bloom[positions] = True
+
+
+def hash_keys(columns):
+    """
+    64-bit hashes of the rows of key columns (series with the same index). Whole numbers hash alike whether a chunk
+    stored them as integers or, because of nulls, as floats; nulls hash alike whatever their type.
+    """
+    combined = None
+    for column in columns:
+        nulls = column.isnull().values
+        if column.dtype.kind == "f":
+            values = column[~nulls]
+            if (values % 1 == 0).all() and (values.abs() < 2 ** 63).all():
+                column = column.fillna(0).astype(numpy.int64)
+
+        hashes = pandas.util.hash_pandas_object(column, index=False).values
+        hashes[nulls] = numpy.uint64(0x9E3779B97F4A7C15)
+        combined = hashes if combined is None else (combined * numpy.uint64(0x100000001B3)) ^ hashes
+    return combined
@@ -4,12 +4,30 @@
 """Tests for `datamonkey` package."""
 
 import pytest
+import numpy
 import pandas
 import os
+import sys
 import json
+import pickle
 import shutil
+import threading
+import subprocess
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from datamonkey import FileProcessor
+from datamonkey.models import Configuration, SourceFile
+from datamonkey.sources import SourceCache
+from datamonkey.templates import TemplateCache
+from datamonkey.results import ResultCache
+from datamonkey.fanout import FanOutProcessor
+from datamonkey.sampling import Sample
+from datamonkey.uniqueness import KeySet, hash_keys
+from datamonkey.references import ReferenceTable
+from datamonkey.patterns import SubstringMatcher, RegexMatcher
+from datamonkey.transformations import FUNCTION_MAP, prepare_parameters
+from datamonkey.instrumentation import Listener, PrometheusExporter, TransformationProfiler
 
 
 def load_json(file_path):
@@ -17,6 +35,19 @@ def load_json(file_path):
         # should probably use simplejson for better error handling
         return json.load(file)
 
+
+class Recorder(Listener):
+    """ keeps the chunk and run statistics a processor reports """
+    def __init__(self):
+        self.chunks, self.runs = [], []
+
+    def on_chunk(self, processor, chunk):
+        self.chunks.append(chunk)
+
+    def on_run(self, processor, run):
+        self.runs.append(run)
+
+
 @pytest.yield_fixture(autouse=True)
 def run_around_tests():
     if not os.path.exists("tests/test_output/"):
@@ -186,3 +217,1038 @@ def __test_output(expected, output):
         except AssertionError as e:
             e.args += (key,)
             raise
+
+
+def test_merge_fields_across_chunks(monkeypatch):
+    """ merged fields stay aligned with the source rows after the first chunk """
+    tests = [test for test in load_json("tests/config_tests/io_tests.json") if test["name"] == "merge_into_one"]
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    __test_configuration_files(tests)
+
+
+def test_source_field_projection():
+    """ source fields that no output field references are skipped by the readers """
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/io/projection.json")
+
+    assert [field.name for field in processor.projected_fields] == ["id", "email"]
+    assert processor.skipped_fields == ["first_name", "last_name", "gender", "ip_address"]
+
+    processor.source_files[0].file_path = "tests/test_files/csv/base_csv.csv"
+    processor._get_source_data()
+    assert list(processor._get_next_chunk().columns) == ["id", "email"]
+
+
+def test_error_log_truncation():
+    """ totals are counted past max_errors and retained details are streamed to a CSV errors file """
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", max_errors=2,
+                              template_file_path="tests/config_tests/configurations/transform/validators/validate_by_range.json")
+    error_file_path = "tests/test_output/truncated_errors.csv"
+    processor.process(["tests/test_files/json/base_json.json"], output_file_path="tests/test_output/truncated_output.json",
+                      error_file_path=error_file_path)
+
+    assert len(processor.warnings) == 2
+    assert processor.error_log.total_warnings == 5
+    assert processor.error_log.truncated == 3
+
+    errors = pandas.read_csv(error_file_path)
+    assert len(errors) == 2
+    assert list(errors["severity"]) == ["WARNING", "WARNING"]
+    assert list(errors["transformation"]) == [1, 1]
+
+
+def test_validate_only():
+    """ validation runs without writing output and stops at the first fatal error """
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/type/json/CSV_oto_header.json")
+    summary = processor.validate("tests/test_files/json/base_json.json")
+
+    assert summary.valid
+    assert summary.rows_read == 10
+    assert not summary.stopped_early
+    assert processor.output_items == 0
+
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/transform/validators/validate_stop_on_invalid.json")
+    summary = processor.validate("tests/test_files/json/validate_tests.json")
+
+    assert not summary.valid
+    assert summary.stopped_early
+    assert summary.total_errors == len(summary.errors) == 2
+
+
+def test_template_cache():
+    """ templates are cached on disk, revalidated with an ETag and used as a fallback when the API is down """
+    template = load_json("tests/config_tests/configurations/type/csv/JSON_oto_header.json")
+    requests_seen = []
+
+    class TemplateHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if "gone" in self.path:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            requests_seen.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+            else:
+                body = json.dumps(template).encode()
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), TemplateHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    template_id = "fc01da57-fake-fake-fake-3e634296ce3f"
+    cache_dir = "tests/test_output/template_cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    api_url = "http://127.0.0.1:%d/" % server.server_address[1]
+
+    try:
+        # first retrieval hits the API, a fresh entry is then served from disk
+        cache = TemplateCache(cache_dir=cache_dir, ttl=60, api_url=api_url)
+        assert FileProcessor(template_id, template_cache=cache).configuration.version == "VERSION_1"
+        FileProcessor(template_id, template_cache=cache)
+        assert requests_seen == [None]
+
+        # expired entries are revalidated with the stored ETag
+        cache = TemplateCache(cache_dir=cache_dir, ttl=0, api_url=api_url)
+        FileProcessor(template_id, template_cache=cache)
+        assert requests_seen == [None, '"v1"']
+
+        # templates the API no longer knows fail to revalidate, and leave the cache
+        missing_id = "fc01da57-gone-gone-gone-3e634296ce3f"
+        entry = load_json(os.path.join(cache_dir, "%s.json" % template_id))
+        entry["id"] = missing_id
+        with open(os.path.join(cache_dir, "%s.json" % missing_id), "w") as file:
+            json.dump(entry, file)
+        with pytest.raises(ValueError):
+            cache.retrieve(missing_id)
+        assert not os.path.isfile(os.path.join(cache_dir, "%s.json" % missing_id))
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    # the cached copy is used when the API can't be reached
+    processor = FileProcessor(template_id, template_cache=TemplateCache(cache_dir=cache_dir, ttl=0, api_url=api_url))
+    assert processor.configuration.version == "VERSION_1"
+
+    # without a cached copy, the connection error is raised
+    import requests
+    with pytest.raises(requests.exceptions.ConnectionError):
+        FileProcessor(template_id, template_cache=TemplateCache(cache_dir=None, ttl=0, api_url=api_url))
+
+
+def test_template_artifact():
+    """ compiled templates load without re-validation and are checked against their id, version and checksum """
+    template_id = "fc01da57-fake-fake-fake-3e634296ce3f"
+    artifact_path = "tests/test_output/template.dmkt"
+
+    processor = FileProcessor(template_id, template_file_path="tests/config_tests/configurations/type/csv/JSON_oto_header.json")
+    processor.configuration.save_artifact(artifact_path)
+
+    compiled = FileProcessor(template_id, template_file_path=artifact_path)
+    assert [field.name for field in compiled.output_fields] == [field.name for field in processor.output_fields]
+    assert all(field._operations is not None for field in compiled.output_fields)  # compiled into the artifact
+
+    output_file_path = "tests/test_output/artifact_output.json"
+    compiled.process("tests/test_files/csv/base_csv.csv", output_file_path=output_file_path, error_file_path="tests/test_output/")
+    assert len(_test_json_output(output_file_path)) == 10
+
+    with pytest.raises(ValueError):
+        FileProcessor("fc01da57-0000-0000-0000-3e634296ce3f", template_file_path=artifact_path)
+
+    with pytest.raises(ValueError):
+        Configuration.load_artifact(artifact_path, version="VERSION_2")
+
+    with open(artifact_path, "ab") as file:
+        file.write(b"tampered")
+
+    with pytest.raises(ValueError):
+        FileProcessor(template_id, template_file_path=artifact_path)
+
+
+def test_lazy_imports():
+    """ importing datamonkey and reading a template doesn't load heavy or format-specific dependencies """
+    script = ("import sys, datamonkey\n"
+              "from datamonkey.models import Configuration\n"
+              "Configuration('fc01da57-fake-fake-fake-3e634296ce3f', "
+              "'tests/config_tests/configurations/type/csv/JSON_oto_header.json')\n"
+              "heavy = ['numpy', 'pandas', 'requests', 's3fs', 'xlrd', 'xlsxwriter', 'datamonkey.transformations']\n"
+              "print(','.join(module for module in heavy if module in sys.modules))")
+
+    loaded = subprocess.check_output([sys.executable, "-c", script]).decode().strip()
+    assert loaded == ""
+
+
+def test_process_many():
+    """ many inputs are processed concurrently with one template and reported per file """
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/type/csv/JSON_oto_header.json")
+    output_dir = "tests/test_output/batch"
+    inputs = ["tests/test_files/csv/base_csv.csv",
+              {"source": "tests/test_files/csv/base_csv.csv", "output": os.path.join(output_dir, "renamed.json")},
+              "tests/test_files/csv/missing.csv"]
+
+    result = processor.process_many(inputs, output_dir=output_dir, error_dir=output_dir, max_workers=2)
+
+    assert [item.index for item in result] == [0, 1, 2]
+    assert [item.succeeded for item in result] == [True, True, False]
+    assert "FileNotFoundError" in result.results[2].exception
+    assert result.results[0].output_file_path == os.path.join(output_dir, "base_csv.json")
+    assert len(_test_json_output(result.results[0].output_file_path)) == 10
+    assert result.input_items == 20
+
+
+def test_process_small_files(monkeypatch):
+    """ small inputs are coalesced into one batch and split back into one output per input, or merged """
+    template = "tests/config_tests/configurations/validate/error_on_null_csv.json"
+    output_dir = "tests/test_output/small_files"
+    inputs = ["tests/test_files/csv/base_csv.csv",
+              {"source": "tests/test_files/csv/base_csv.csv", "output": os.path.join(output_dir, "renamed.json")},
+              "tests/test_files/csv/missing.csv"]
+
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template)
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    expected_output = _test_json_output(os.path.join(output_dir, processor.output_file.name))
+    expected_warnings = processor.error_log.total_warnings
+
+    result = processor.process_small_files(inputs, output_dir=output_dir, error_dir=output_dir)
+    assert [item.succeeded for item in result] == [True, True, False]
+    assert "FileNotFoundError" in result.results[2].exception
+    assert _test_json_output(result.results[0].output_file_path) == expected_output
+    assert _test_json_output(result.results[1].output_file_path) == expected_output
+    assert [item.total_warnings for item in result.results[:2]] == [expected_warnings] * 2
+
+    # one bad input falls back to per file processing without failing its neighbours
+    invalid_path = os.path.join(output_dir, "invalid.csv")
+    with open("tests/test_files/csv/base_csv.csv") as source, open(invalid_path, "w") as file:
+        file.write(source.read().replace("\n1,", "\nONE,"))
+
+    result = processor.process_small_files(inputs + [invalid_path], output_dir=output_dir, error_dir=output_dir)
+    assert [item.succeeded for item in result] == [True, True, False, False]
+    assert _test_json_output(result.results[1].output_file_path) == expected_output
+
+    merged_path = os.path.join(output_dir, "merged.json")
+    errors_path = os.path.join(output_dir, "merged_errors.txt")
+    result = processor.process_small_files(inputs[:2], merge=True, output_file_path=merged_path,
+                                           error_file_path=errors_path, batch_rows=5)
+    assert result.output_items == len(_test_json_output(merged_path)) == 2 * len(expected_output)
+    assert result.total_warnings == 2 * expected_warnings
+    with open(errors_path) as file:
+        assert "Row(s): 2, 6 of base_csv.csv" in file.read()
+
+    # a fatal error stops a merged run, as it stops process(); the errors file names the input it was found in
+    with pytest.raises(ValueError):
+        processor.process_small_files([inputs[0], invalid_path], merge=True, output_file_path=merged_path,
+                                      error_file_path=errors_path)
+    with open(errors_path) as file:
+        assert "(Row 1 of invalid.csv)" in file.read()
+
+    # split errors and warnings are limited per input, not per batch
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", max_errors=1,
+                              template_file_path="tests/config_tests/configurations/transform/unique.json")
+    result = processor.process_small_files(["tests/test_files/csv/duplicates.csv"], output_dir=output_dir,
+                                           error_dir=output_dir)
+    assert result.total_warnings == 2
+    with open(result.results[0].error_file_path) as file:
+        assert "1 additional errors and warnings were not recorded (max errors: 1)" in file.read()
+
+    # duplicates are only looked for within each input
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/transform/unique.json")
+    inputs = ["tests/test_files/csv/duplicates.csv",
+              {"source": "tests/test_files/csv/duplicates.csv", "output": os.path.join(output_dir, "again.json")}]
+    result = processor.process_small_files(inputs, output_dir=output_dir, error_dir=output_dir)
+    for item in result:
+        assert [row["id"] for row in _test_json_output(item.output_file_path)] == [1, 2, 4, 5, 6, 8, 9, 10]
+        assert item.output_items == 8 and item.total_warnings == 2
+
+    # the keys are released once the inputs are processed, so nothing spilled to disk outlives the run
+    opened, closed = [], []
+    key_set_init, key_set_close = KeySet.__init__, KeySet.close
+    monkeypatch.setattr(KeySet, "__init__", lambda self, *args, **kwargs: opened.append(self) or
+                        key_set_init(self, *args, **kwargs))
+    monkeypatch.setattr(KeySet, "close", lambda self: closed.append(self) or key_set_close(self))
+    processor.process_small_files(inputs, output_dir=output_dir, error_dir=output_dir)
+    processor.process_small_files(inputs, merge=True, output_file_path=merged_path, error_file_path=errors_path)
+    assert opened and all(key_set in closed for key_set in opened)
+
+
+def test_resume_from_checkpoint(monkeypatch):
+    """ an interrupted run resumes after its last written chunk and produces the same output and errors file """
+    # quoted fields with line breaks, quotes and delimiters, and a blank line, are split into records like pandas does
+    quoted_path = "tests/test_output/quoted_csv.csv"
+    os.makedirs("tests/test_output", exist_ok=True)
+    with open("tests/test_files/csv/base_csv.csv") as file:
+        lines = file.read().split("\n")
+    lines[2] = lines[2].replace("Vittet", '"Vit\ntet"')
+    lines[8] = lines[8].replace("Lanfranconi", '"Lan ""F"",\nfranconi"') + "\n"
+    with open(quoted_path, "w") as file:
+        file.write("\n".join(lines))
+
+    line_delimited = load_json("tests/config_tests/configurations/type/json/CSV_oto_header.json")
+    line_delimited["sourceFiles"][0]["lineDelimitedJSON"] = True
+    tests = [("tests/config_tests/configurations/validate/error_on_null_csv.json", "tests/test_files/csv/base_csv.csv"),
+             ("tests/config_tests/configurations/validate/error_on_null_csv.json", quoted_path),
+             ("tests/config_tests/configurations/type/fwf/CSV_oto_header.json", "tests/test_files/fwf/base_fwf.txt"),
+             (line_delimited, "tests/test_files/json/base_LD_json.json")]
+    output_dir = "tests/test_output/checkpoints"
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    read_records, readers = SourceFile.read_records, []
+
+    def create_processor(template):
+        if isinstance(template, dict):
+            return FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                                  template=template))
+        return FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template)
+
+    def record_reader(source_file, source_fields, used_fields=None, offset=0):
+        readers.append((offset, read_records(source_file, source_fields, used_fields, offset)))
+        return readers[-1][1]
+
+    monkeypatch.setattr(SourceFile, "read_records", record_reader)
+    for template, source in tests:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        checkpoint_path = os.path.join(output_dir, "checkpoint.json")
+        processor = create_processor(template)
+        expected_path = os.path.join(output_dir, "expected_" + processor.output_file.name)
+        processor.process(source, output_file_path=expected_path, error_file_path=output_dir + "/expected.txt")
+
+        # the third chunk fails to write, e.g. because the job was preempted
+        processor = create_processor(template)
+        flush_output, calls = processor.output_file.flush_output, []
+
+        def interrupt():
+            calls.append(None)
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+            flush_output()
+
+        processor.output_file.flush_output = interrupt
+        with pytest.raises(KeyboardInterrupt):
+            processor.process(source, output_file_path=output_dir, error_file_path=output_dir + "/errors.txt",
+                              checkpoint_file_path=checkpoint_path)
+        assert os.path.isfile(checkpoint_path)
+        offset = load_json(checkpoint_path)["offset"]
+
+        # only the rows after the two written chunks are processed again, read from where the second one ended
+        del readers[:]
+        processor = create_processor(template)
+        transform_chunk, transformed = processor._transform_chunk, []
+        processor._transform_chunk = lambda data: transformed.append(len(data)) or transform_chunk(data)
+        processor.process(source, output_file_path=output_dir, error_file_path=output_dir + "/errors.txt",
+                          checkpoint_file_path=checkpoint_path, resume=True)
+        assert not os.path.isfile(checkpoint_path)
+        assert sum(transformed) == 4
+        assert processor.input_items == 10
+        assert [(start, reader.rows) for start, reader in readers] == [(offset, 4)] and offset > 0
+
+        for expected, resumed in [(expected_path, os.path.join(output_dir, processor.output_file.name)),
+                                  (output_dir + "/expected.txt", output_dir + "/errors.txt")]:
+            assert os.path.isfile(resumed) == os.path.isfile(expected)
+            if os.path.isfile(expected):
+                with open(expected) as expected_file, open(resumed) as resumed_file:
+                    assert resumed_file.read() == expected_file.read()
+
+
+def test_result_cache():
+    """ re-processing unchanged inputs restores the earlier output and errors file instead of processing again """
+    output_dir = "tests/test_output/results"
+    cache_dir = os.path.join(output_dir, "cache")
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    cache = ResultCache(cache_dir=cache_dir)
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", result_cache=cache,
+                              template_file_path="tests/config_tests/configurations/validate/error_on_null_csv.json")
+    output_path = os.path.join(output_dir, processor.output_file.name)
+    error_path = os.path.join(output_dir, "errors.txt")
+
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=error_path)
+    with open(output_path) as output_file, open(error_path) as error_file:
+        expected = (output_file.read(), error_file.read())
+    os.remove(output_path)
+    os.remove(error_path)
+
+    processor._get_source_data = None  # a cache hit never reads the source file
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=error_path)
+    with open(output_path) as output_file, open(error_path) as error_file:
+        assert (output_file.read(), error_file.read()) == expected
+    assert (processor.input_items, processor.output_items, processor.error_log.total_warnings) == (10, 8, 1)
+
+    # an edited template misses the cache even though its id and version are the same
+    template = load_json("tests/config_tests/configurations/validate/error_on_null_csv.json")
+    template["outputFields"][0]["name"] = "renamed"
+    edited = FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                            template=template))
+    edited.result_cache = cache
+    edited.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=error_path)
+    assert edited.configuration.version == processor.configuration.version
+    assert len(os.listdir(cache_dir)) == 2
+    with open(output_path) as output_file:
+        assert '"renamed"' in output_file.read()
+
+    # so does a template whose reference file was edited, though the template itself wasn't
+    names_path = os.path.join(output_dir, "first_names.txt")
+    shutil.copy("tests/test_files/reference/first_names.txt", names_path)
+    template = load_json("tests/config_tests/configurations/transform/lookup.json")
+    template["outputFields"][1]["transformations"][0]["parameters"]["file"] = names_path
+    warnings = []
+    for names in [[], ["Fernando", "Winnah"]]:
+        with open(names_path, "a") as names_file:
+            names_file.write("".join(name + "\n" for name in names))
+        processor = FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                                   template=template))
+        processor.result_cache = cache
+        processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=error_path)
+        warnings.append(processor.error_log.total_warnings)
+    assert warnings == [2, 0]
+    assert len(os.listdir(cache_dir)) == 4
+
+    # entries are evicted once the cache is too large
+    cache.max_size = 0
+    cache.evict()
+    assert not os.listdir(cache_dir)
+
+
+def test_source_cache():
+    """ parsed source files are cached per column and re-used without parsing the file again """
+    tests = [("csv/JSON_oto_header.json", "csv/base_csv.csv"),
+             ("csv/JSON_oto_no_header.json", "csv/base_csv_no_header.csv"),
+             ("fwf/JSON_oto_header.json", "fwf/base_fwf.txt"),
+             ("excel/JSON_oto_header.json", "excel/base_excel.xls"),
+             ("json/JSON_oto_header.json", "json/base_json.json")]
+    output_dir = "tests/test_output/sources"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    cache = SourceCache(cache_dir=os.path.join(output_dir, "cache"))
+
+    for template, source in tests:
+        template = "tests/config_tests/configurations/type/" + template
+        source = "tests/test_files/" + source
+        output_path = os.path.join(output_dir, "output.json")
+
+        processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template)
+        processor.process(source, output_file_path=output_path, error_file_path=output_dir)
+        expected = _test_json_output(output_path)
+
+        processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template,
+                                  source_cache=cache)
+        processor.process(source, output_file_path=output_path, error_file_path=output_dir)
+        assert _test_json_output(output_path) == expected
+
+        # the second run reads the cached columns only
+        process_file = SourceFile.process_file
+        SourceFile.process_file = None
+        try:
+            processor.process(source, output_file_path=output_path, error_file_path=output_dir)
+        finally:
+            SourceFile.process_file = process_file
+        assert _test_json_output(output_path) == expected
+
+    # files are cached a chunk at a time; columns whose chunks pandas types differently are typed for the whole file
+    file_path = os.path.join(output_dir, "chunked.csv")
+    with open(file_path, "w", encoding="utf-8") as file:
+        file.write("id,amount,code,name\n")
+        for i in range(25):
+            file.write("%d,%s,%s,%s\n" % (i, "" if i == 12 else i * 2, "X%d" % i if i > 20 else i,
+                                         "" if i % 7 == 3 else "näme %d" % i if i % 2 else "name %d" % i))
+
+    template = load_json("tests/config_tests/configurations/transform/profile.json")
+    template["sourceFields"] = [{"name": name, "fileIndex": 0, "used": True} for name in ["id", "amount", "code", "name"]]
+    template["outputFields"] = [{"name": name, "type": type, "sourceFields": [i], "allowNull": True,
+                                 "transformations": []}
+                                for i, (name, type) in enumerate([("id", "INT"), ("amount", "FLOAT"),
+                                                                  ("code", "STRING"), ("name", "STRING")])]
+    configuration = Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "", template=template)
+    processor = FileProcessor.from_configuration(configuration)
+    processor.process(file_path, output_file_path=output_path, error_file_path=output_dir)
+    expected = _test_json_output(output_path)
+
+    chunk_rows = SourceCache.CHUNK_ROWS
+    SourceCache.CHUNK_ROWS = 10
+    try:
+        for _ in range(2):
+            processor = FileProcessor.from_configuration(configuration)
+            processor.source_cache = cache
+            processor.process(file_path, output_file_path=output_path, error_file_path=output_dir)
+            assert _test_json_output(output_path) == expected
+    finally:
+        SourceCache.CHUNK_ROWS = chunk_rows
+
+    # every column is a raw array, text included, nothing is pickled
+    for entry in os.listdir(cache.cache_dir):
+        with open(os.path.join(cache.cache_dir, entry, "manifest.json")) as file:
+            assert all(column["dtype"] != "|O" for column in json.load(file)["columns"].values())
+
+
+def test_fan_out():
+    """ several templates are run over one read of the source file, with the same results as separate runs """
+    output_dir = "tests/test_output/fan_out"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    templates = ["tests/config_tests/configurations/type/csv/CSV_oto_header.json",
+                 "tests/config_tests/configurations/type/csv/JSON_oto_header.json",
+                 "tests/config_tests/configurations/validate/error_on_null_csv.json",
+                 os.path.join(output_dir, "invalid_type.json")]
+
+    # a template that can't cast first names to integers fails on its own
+    template = load_json(templates[1])
+    template["outputFields"][1]["type"] = "INT"
+    with open(templates[3], "w") as file:
+        json.dump(template, file)
+
+    expected = []
+    for i, template in enumerate(templates[:3]):
+        processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template)
+        processor.process("tests/test_files/csv/base_csv.csv", output_file_path=os.path.join(output_dir, str(i)),
+                          error_file_path=os.path.join(output_dir, str(i)))
+        with open(processor.output_file.file_path) as file:
+            expected.append(file.read())
+
+    processors = [FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template)
+                  for template in templates]
+    result = FanOutProcessor(processors).process("tests/test_files/csv/base_csv.csv",
+                                                 [os.path.join(output_dir, "fan_out_%d" % i) for i in range(4)],
+                                                 [os.path.join(output_dir, "fan_out_%d" % i) for i in range(4)])
+
+    assert [item.succeeded for item in result] == [True, True, True, False]
+    assert [item.total_warnings for item in result][:3] == [0, 0, 1]
+    for item, output in zip(result.results, expected):
+        with open(item.output_file_path) as file:
+            assert file.read() == output
+
+    # each template's listeners and profiler see its own run, as they would in a separate run
+    template = load_json(templates[1])
+    template["outputFields"][1]["transformations"] = [{"operation": "MODIFY_CHANGE_CASE",
+                                                       "parameters": {"operator": "UPPER"}}]
+    processors = [FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                                 template=template)),
+                  FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=templates[3])]
+    recorders = [Recorder(), Recorder()]
+    for processor, recorder in zip(processors, recorders):
+        processor.add_listener(recorder)
+    profiler = processors[0].enable_profiling()
+    FanOutProcessor(processors).process("tests/test_files/csv/base_csv.csv",
+                                        [os.path.join(output_dir, "instrumented_%d" % i) for i in range(2)],
+                                        [os.path.join(output_dir, "instrumented_%d" % i) for i in range(2)])
+
+    assert [(chunk.rows_in, chunk.rows_out) for chunk in recorders[0].chunks] == [(10, 10)]
+    assert [(run.succeeded, run.rows_in) for run in recorders[0].runs] == [(True, 10)]
+    assert recorders[0].runs[0].bytes_read == os.path.getsize("tests/test_files/csv/base_csv.csv")
+    assert not recorders[1].chunks and [run.succeeded for run in recorders[1].runs] == [False]
+    assert [(entry["operation"], entry["rows"]) for entry in profiler.report()] == [("MODIFY_CHANGE_CASE", 10)]
+
+
+def test_instrumentation(monkeypatch):
+    """ listeners receive per-chunk and per-run statistics, which can be exported for Prometheus """
+    output_dir = "tests/test_output/instrumentation"
+    metrics_path = os.path.join(output_dir, "datamonkey.prom")
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/validate/error_on_null_csv.json")
+    recorder = Recorder()
+    processor.add_listener(recorder)
+    processor.add_listener(PrometheusExporter(metrics_path))
+
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+
+    assert [(chunk.rows_in, chunk.rows_out, chunk.warnings) for chunk in recorder.chunks] == \
+        [(3, 2, 1), (3, 2, 1), (3, 3, 0), (1, 1, 0)]
+    assert all(chunk.bytes_written > 0 for chunk in recorder.chunks)
+    assert all(stage in recorder.chunks[0].stage_seconds for stage in ["MAP", "VALIDATE", "TRANSFORM", "WRITING_DATA"])
+
+    run = recorder.runs[0]
+    assert (run.succeeded, run.chunks, run.rows_in, run.rows_out, run.filtered) == (True, 4, 10, 8, 2)
+    assert run.bytes_read == os.path.getsize("tests/test_files/csv/base_csv.csv")
+    assert run.bytes_written == os.path.getsize(processor.output_file.file_path) - 2  # the JSON output is closed last
+
+    with open(metrics_path) as file:
+        metrics = file.read()
+    assert 'datamonkey_rows_in{template="fc01da57-fake-fake-fake-3e634296ce3f"} 10.0' in metrics
+    assert 'datamonkey_last_run_success{template="fc01da57-fake-fake-fake-3e634296ce3f"} 1.0' in metrics
+    assert '# TYPE datamonkey_stage_seconds gauge' in metrics
+
+
+def test_transformation_profiler():
+    """ each transformation is timed separately, with the values it modified, filtered, warned or errored on """
+    output_dir = "tests/test_output/profile"
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/transform/profile.json")
+    profiler = processor.enable_profiling()
+    assert isinstance(profiler, TransformationProfiler) and processor.enable_profiling() is profiler
+
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    assert len(processor.warnings) == 2
+
+    report = profiler.report()
+    assert [entry["rank"] for entry in report] == [1, 2, 3, 4]
+    assert report == sorted(report, key=lambda entry: entry["seconds"], reverse=True)
+    assert abs(sum(entry["share"] for entry in report) - 1) < 1e-9
+
+    counts = {(entry["field"], entry["position"], entry["operation"]):
+              (entry["rows"], entry["modified"], entry["filtered"], entry["warnings"], entry["errors"])
+              for entry in report}
+    assert counts == {("first_name", 1, "MODIFY_CHANGE_CASE"): (10, 10, 0, 0, 0),
+                      ("first_name", 2, "FILTER_BY_SUBSTRING"): (10, 0, 1, 0, 0),  # ALLIE
+                      ("first_name", 3, "VALIDATE_BY_LENGTH"): (9, 0, 0, 2, 0),  # FERNANDO and BERTINA
+                      ("email", 1, "MODIFY_REMOVE_WHITESPACE"): (7, 0, 0, 0, 0)}  # two nulls and ALLIE's row
+
+    json_path = os.path.join(output_dir, "profile.json")
+    profiler.to_json(json_path)
+    assert load_json(json_path) == json.loads(profiler.to_json())
+    assert len(load_json(json_path)) == 4
+
+    # the counts accumulate over runs until the profiler is reset
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    assert sorted(entry["rows"] for entry in profiler.report()) == [14, 18, 20, 20]
+    profiler.reset()
+    assert profiler.report() == []
+
+
+def test_metrics(monkeypatch):
+    """ output fields are profiled with mergeable sketches while the file streams """
+    output_dir = "tests/test_output/metrics"
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/validate/error_on_null_csv.json")
+    processor.enable_metrics()
+
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+
+    fields = {field.name: field.metrics for field in processor.output_fields}
+    # rows 2 and 6 are dropped for their missing email, which are counted as nulls
+    assert (fields["email"].number_values, fields["email"].number_null, fields["email"].number_distinct) == (8, 2, 8)
+    assert (fields["id"].min_value, fields["id"].max_value, fields["id"].mean) == (1, 10, 5.875)
+    assert (fields["id"].common_sequence_value, fields["id"].is_sequential) == (1, False)
+    assert 7 in fields["id"].non_sequential_values and set(fields["id"].non_sequential_values) <= {3, 7}
+    assert fields["gender"].top_values == [["Male", 5], ["Female", 3]]
+    assert (fields["gender"].number_distinct, fields["gender"].num_duplicate_values) == (2, 6)
+    assert (fields["first_name"].min_length, fields["first_name"].max_length) == (4, 8)
+    assert fields["ip_address"].mask_matches[0][1] == 2
+
+    # values are profiled as they're output: modified, and without the rows a filter drops
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/transform/lookup.json")
+    processor.enable_metrics()
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    fields = {field.name: field.metrics for field in processor.output_fields}
+    assert fields["gender"].top_values == [["M", 6]]
+    assert (fields["id"].number_values, fields["id"].max_value) == (6, 9)
+    assert (fields["last_name"].min_length, fields["last_name"].max_length) == (1, 12)
+
+    # sketches of parts of the data merge into estimates for the whole
+    from datamonkey.sketches import FieldSketch
+    random = numpy.random.RandomState(1)
+    values = pandas.Series(numpy.concatenate([random.normal(100, 10, 60000), numpy.full(20000, 7.0)]))
+    random.shuffle(values.values)
+    whole, first, second = FieldSketch("FLOAT"), FieldSketch("FLOAT"), FieldSketch("FLOAT")
+    for start in range(0, len(values), 10000):
+        whole.update(values.iloc[start:start + 10000])
+    first.update(values.iloc[:30000])
+    second.update(values.iloc[30000:])
+    first.merge(second)
+
+    for sketch in [whole, first]:
+        metrics = FileProcessor.from_configuration(processor.configuration).output_fields[0].metrics
+        sketch.populate(metrics)
+        assert metrics.number_values == 80000
+        assert abs(metrics.number_distinct - values.nunique()) < 0.05 * values.nunique()
+        assert abs(metrics.mean - values.mean()) < 1e-6
+        assert abs(metrics.median - values.median()) < 1
+        value, count = metrics.top_values[0]
+        assert value == 7.0 and 20000 - 80000 / 101 <= count <= 20000  # counts are underestimated by at most n / (k + 1)
+        assert metrics.common_values == [7.0]
+
+    # workers of a batch each profile their input, and their sketches are merged
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/validate/error_on_null_csv.json")
+    processor.enable_metrics()
+    processor.process_many(["tests/test_files/csv/base_csv.csv", {"source": "tests/test_files/csv/base_csv.csv",
+                                                                  "output": os.path.join(output_dir, "second.json")}],
+                           output_dir=output_dir, error_dir=output_dir, use_processes=False)
+    metrics = processor.output_fields[0].metrics
+    assert (metrics.number_values, metrics.number_distinct, metrics.num_duplicate_values) == (16, 8, 8)
+
+
+def test_anomaly_detection(monkeypatch):
+    """ detectors find anomalies across chunk boundaries and report them as warnings """
+    output_dir = "tests/test_output/anomalies"
+    expected = ["'amount', Row 26: 10000.0 is 6.2 standard deviations from the mean (347.471).",
+                "'id', Row 41: 42 follows 40; consecutive values usually differ by 1.",
+                "'note', Row 111: missing value, while only 0.83% of the values are missing.",
+                "'created', Row 81: 2020-03-23 follows 2020-03-20; the dates are usually one day apart."]
+
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 40)  # the id gap and the missing days are between chunks
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                              template_file_path="tests/config_tests/configurations/validate/anomalies.json")
+    processor.enable_anomaly_detection()
+    processor.process("tests/test_files/csv/anomalies.csv", output_file_path=output_dir,
+                      error_file_path=output_dir)
+
+    assert [processor.error_log.format(i) for i in range(len(processor.error_log))] == expected
+    fields = {field.name: field.metrics for field in processor.output_fields}
+    assert (fields["id"].is_sequential, fields["id"].common_sequence_value) == (False, 1)
+    assert fields["id"].non_sequential_values == [42]
+    assert fields["created"].date_interval == "DAY" and not fields["created"].contains_future_dates
+    assert fields["amount"].statistical_outliers == [10000.0]
+    assert fields["note"].null_outliers == [111]
+
+    # warnings are bounded per field and detector
+    from datamonkey.sketches import MetricsCollector
+    processor.error_log.reset()
+    collector = MetricsCollector(processor.output_fields, processor.error_log, max_warnings=3)
+    ids = numpy.arange(100) + numpy.arange(100) // 10  # a gap every ten values
+    collector.update(pandas.DataFrame({"id": ids, "created": pandas.date_range("2020-01-01", periods=100),
+                                       "amount": numpy.ones(100), "note": "ok"}))
+    assert processor.error_log.total_warnings == 3
+    collector.populate(processor.output_fields)
+    assert processor.output_fields[0].metrics.non_sequential_values == [11 * i for i in range(1, 10)]
+
+    # interval classes follow the calendar for months and years
+    from datamonkey.sketches import IntervalDetector
+    dates = pandas.to_datetime(["2020-01-31", "2020-02-29", "2020-03-31", "2020-04-30", "2021-04-30"]).values
+    intervals = IntervalDetector.classify(dates[:-1].astype(numpy.int64), dates[1:].astype(numpy.int64))
+    assert list(intervals) == ["MONTH", "MONTH", "MONTH", "YEAR"]
+
+
+def test_schema_inference():
+    """ templates are inferred from a head sample plus blocks read at random offsets """
+    output_dir = "tests/test_output/inference"
+    os.makedirs(output_dir, exist_ok=True)
+    file_path = os.path.join(output_dir, "source.txt")
+    rows = 20000
+    with open(file_path, "w") as file:
+        file.write("id;code;amount;created;note\n")
+        for i in range(rows):
+            # notes are only missing past the head
+            file.write("%d;%05d;%.2f;2020-01-%02d;%s\n" % (i, i % 1000, i / 3.0, i % 28 + 1,
+                                                           "" if i > 100 and i % 50 == 0 else "x"))
+
+    configuration = Configuration.infer(file_path, head_rows=100, samples=20, sample_bytes=4096)
+    source_file = configuration.source_files[0]
+    assert (source_file.type, source_file.has_header, source_file.delimiter) == ("CSV", True, ";")
+    assert [(field.name, field.type) for field in configuration.output_fields] == \
+        [("id", "INT"), ("code", "STRING"), ("amount", "FLOAT"), ("created", "DATE"), ("note", "STRING")]
+    assert [field.allow_null for field in configuration.output_fields] == [False, False, False, False, True]
+
+    # the saved template processes the whole file
+    template_path = os.path.join(output_dir, "template.json")
+    configuration.save(template_path)
+    processor = FileProcessor(configuration.id, template_file_path=template_path)
+    processor.process(file_path, output_file_path=output_dir, error_file_path=output_dir)
+    assert (processor.input_items, processor.output_items, processor.error_log.total_errors) == (rows, rows, 0)
+
+    configuration = Configuration.infer("tests/test_files/fwf/base_fwf_no_header.txt")
+    assert not configuration.source_files[0].has_header
+    assert [field.col_specs for field in configuration.source_fields][:2] == [[1, 5], [6, 19]]
+    assert Configuration.infer("tests/test_files/json/base_LD_json.json").source_files[0].line_delimited_JSON
+
+
+def test_sampling(monkeypatch):
+    """ runs can be restricted to a head, a row range or a random sample of the rows, which keep their row numbers """
+    output_dir = "tests/test_output/sampling"
+    samples = [(Sample.head(3), [1, 3], [2]),
+               (Sample.rows(4, 8), [5, 7, 8], [6]),
+               (Sample.bernoulli(0.5, seed=2), [1, 4, 5, 7, 9, 10], [2, 6]),
+               (Sample.reservoir(4, seed=1), [4, 8, 9, 10], [])]
+
+    # chunked CSV files are sampled while parsing, JSON files chunk by chunk; both draw the same rows
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    for template, source in [("error_on_null_csv.json", "csv/base_csv.csv"), ("error_on_null_json.json", "json/base_json.json")]:
+        processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f",
+                                  template_file_path="tests/config_tests/configurations/validate/" + template)
+        for sample, ids, missing in samples:
+            processor.process("tests/test_files/" + source, output_file_path=output_dir,
+                              error_file_path=output_dir, sample=sample)
+            with open(processor.output_file.file_path) as file:
+                assert [row["id"] for row in json.load(file)] == ids
+            # e.g. "Missing values found in field 'email' for Row(s): 2, 6. ..."
+            messages = [processor.error_log.format(i) for i in range(len(processor.error_log))]
+            assert [int(row) for message in messages
+                    for row in message.split("(s): ")[1].split(".")[0].split(", ")] == missing
+
+    summary = processor.validate("tests/test_files/json/base_json.json", sample=Sample.head(1))
+    assert (summary.valid, summary.rows_read) == (True, 1)
+
+    # reservoir samples are uniform and don't depend on the size of the chunks
+    data = pandas.DataFrame({"row": numpy.arange(1000)})
+    counts = numpy.zeros(1000)
+    for seed in range(100):
+        rows = []
+        for size in [1000, 7] if seed < 3 else [1000, 1000]:
+            sample = Sample.reservoir(50, seed=seed)
+            chunks = iter([data.iloc[start:start + size] for start in range(0, 1000, size)])
+            rows.append(list(sample.next_chunk(lambda: next(chunks, None)).index))
+        assert rows[0] == rows[1] and len(set(rows[0])) == 50
+        counts[rows[0]] += 1
+    assert abs(counts[:500].sum() - counts[500:].sum()) < 500
+
+    with pytest.raises(ValueError):
+        Sample.bernoulli(1.5)
+
+
+def test_uniqueness(monkeypatch):
+    """ duplicates are found across chunks, on a field or a composite key, and reported by the first transformation """
+    output_dir = "tests/test_output/unique"
+    template_path = "tests/config_tests/configurations/transform/unique.json"
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template_path)
+    for _ in range(2):  # the keys seen don't carry over to the next run
+        processor.process("tests/test_files/csv/duplicates.csv", output_file_path=output_dir,
+                          error_file_path=output_dir)
+        data = load_json(processor.output_file.file_path)
+        assert [row["id"] for row in data] == [1, 2, 4, 5, 6, 8, 9, 10]  # ann and bob in the US again
+        assert [row["email"] for row in data][2:5] == ["ann@a.com", "cid@c.com>", "cid@c.com"]
+        assert [processor.error_log.format(i) for i in range(len(processor.error_log))] == \
+            ["'email', Row 4, transformation #2: 'ann@a.com' was already found in an earlier row.",
+             "'email', Row 6, transformation #2: 'cid@c.com' was already found in an earlier row."]
+        assert processor.key_sets == {}
+
+    # the keys aren't kept in checkpoints, a resumed run would miss duplicates of the rows processed before
+    with pytest.raises(ValueError):
+        processor.process("tests/test_files/csv/duplicates.csv", output_file_path=output_dir,
+                          error_file_path=output_dir, checkpoint_file_path=output_dir + "/checkpoint.json")
+    assert not os.path.isfile(output_dir + "/checkpoint.json")
+
+    template = load_json(template_path)
+    template["outputFields"][2]["transformations"][0]["parameters"]["fields"] = ["region"]
+    with pytest.raises(ValueError):
+        Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "", template=template)
+
+    # the same answers once the keys spill to disk, with or without a Bloom filter
+    values = pandas.Series(numpy.random.RandomState(0).randint(0, 50000, 200000))
+    expected = values.duplicated().values
+    for bloom_filter in [False, True]:
+        keys = KeySet(max_memory=64 * 1024, bloom_filter=bloom_filter)
+        seen = numpy.concatenate([keys.add(hash_keys([chunk])) for chunk in numpy.array_split(values, 7)])
+        assert (seen == expected).all() and len(keys) == values.nunique() and keys.runs
+        keys.close()
+
+    # whole numbers are the same key whether a chunk has them as integers or floats
+    assert (hash_keys([pandas.Series([1, 2])]) == hash_keys([pandas.Series([1.0, 2.0])])).all()
+
+
+def test_reference_tables(monkeypatch):
+    """ list operations and lookups use reference files, indexed once and summarized in messages """
+    output_dir = "tests/test_output/lookup"
+    template_path = "tests/config_tests/configurations/transform/lookup.json"
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 3)  # the last chunk only has a female row, which is filtered
+    processor = FileProcessor("fc01da57-fake-fake-fake-3e634296ce3f", template_file_path=template_path)
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+
+    data = load_json(processor.output_file.file_path)
+    assert [(row["id"], row["last_name"], row["gender"]) for row in data][:3] == \
+        [(1, "K", "M"), (2, "V", "M"), (3, "McGillacoell", "M")]
+    assert [row["id"] for row in data] == [1, 2, 3, 4, 5, 9]
+    assert [processor.error_log.format(i) for i in range(len(processor.error_log))] == \
+        ["'first_name', Row %d, transformation #1: '%s' is not in the list of accepted values (8 values in "
+         "first_names.txt)." % (row, name) for row, name in [(4, "Fernando"), (6, "Winnah")]]
+
+    # files are indexed once per process, and reloaded rather than pickled
+    table = processor.output_fields[1].operations[0][1]["values"]
+    assert ReferenceTable.from_file("tests/test_files/reference/first_names.txt", type="STRING") is table
+    assert pickle.loads(pickle.dumps(table)).__dict__ is not table.__dict__ and "Allie" in pickle.loads(
+        pickle.dumps(table)) and len(pickle.dumps(table)) < 200
+
+    # an edited file is indexed again, and its earlier version released
+    from datamonkey.references import _TABLES
+    names_path = os.path.abspath(os.path.join(output_dir, "first_names.txt"))
+    shutil.copy("tests/test_files/reference/first_names.txt", names_path)
+    before = ReferenceTable.from_file(names_path)
+    with open(names_path, "a") as names_file:
+        names_file.write("Fernando\n")
+    after = ReferenceTable.from_file(names_path)
+    assert "Fernando" not in before and "Fernando" in after
+    assert [table for key, table in _TABLES.items() if key[0] == names_path] == [after]
+
+    # keys missing from a lookup table can be reported or filtered; long lists are summarized in messages
+    template = load_json(template_path)
+    gender = template["outputFields"][3]["transformations"]
+    gender[0]["parameters"] = {"values": {"Male": "M"}, "onMissing": "WARN"}
+    values = ["Male", "Female"] + ["X%d" % i for i in range(20)]
+    gender[1] = {"operation": "VALIDATE_BY_LIST",
+                 "parameters": {"values": values, "operator": "INCLUDE", "stopOnInvalid": False}}
+    processor = FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                               template=template))
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    messages = [processor.error_log.format(i) for i in range(len(processor.error_log))]
+    assert "'gender', Row 6, transformation #1: 'Female' was not found in the lookup table." in messages
+    assert "'gender', Row 1, transformation #2: 'M' is not in the list of accepted values (Male, Female, X0, X1, X2, " \
+           "X3, X4, X5, X6, X7, ... 22 values)." in messages
+
+    gender[0]["parameters"]["onMissing"] = "IGNORE"
+    with pytest.raises(ValueError):
+        FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                       template=template)).output_fields[3].operations
+
+
+def test_pattern_sets():
+    """ substring and regex operations match sets of patterns in one pass and report the pattern that matched """
+    output_dir = "tests/test_output/patterns"
+    template = load_json("tests/config_tests/configurations/transform/profile.json")
+    template["outputFields"][1]["transformations"] = [
+        {"operation": "FILTER_BY_REGEX", "parameters": {"values": ["^B", "^F", "^[LG]"]}}]
+    template["outputFields"][2]["transformations"] = [
+        {"operation": "VALIDATE_BY_SUBSTRING", "parameters": {"file": "tests/test_files/reference/blocked_domains.txt",
+                                                              "operator": "EXCLUDE", "stopOnInvalid": False}}]
+
+    processor = FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                               template=template))
+    profiler = processor.enable_profiling()
+    processor.process("tests/test_files/csv/base_csv.csv", output_file_path=output_dir, error_file_path=output_dir)
+    assert [row["id"] for row in load_json(processor.output_file.file_path)] == [1, 3, 4, 5, 7, 8]
+    assert [processor.error_log.format(i) for i in range(len(processor.error_log))] == \
+        ["'email', Row %d, transformation #1: '%s ' contained the invalid value '%s'." % (row, email, domain)
+         for row, email, domain in [(3, "fmcgillacoell2@fda.gov", "fda.gov"), (5, "lsleigh4@noaa.gov", "noaa.gov"),
+                                    (7, "bbrewis6@myspace.com", "myspace.com")]]
+
+    # profiles count the rows each pattern matched first
+    profiles = dict((entry["operation"], entry["patterns"]) for entry in profiler.report())
+    assert profiles["FILTER_BY_REGEX"] == {"^B": 2, "^F": 2, "^[LG]": 2}
+    assert sum(profiles["VALIDATE_BY_SUBSTRING"].values()) == 3 and profiles["VALIDATE_BY_SUBSTRING"]["noaa.gov"] == 1
+
+    parameters = prepare_parameters("VALIDATE_BY_SUBSTRING", {"values": ["x", "y"], "operator": "INCLUDE",
+                                                              "stopOnInvalid": True}, "STRING")
+    assert FUNCTION_MAP["VALIDATE_BY_SUBSTRING"]("abc", parameters) == \
+        ("abc", "ERROR", "'abc 'did not contain any of the expected values (x, y)")
+
+    # the automaton finds the substring that ends first, like searching each prefix of the value
+    patterns = ["he", "she", "his", "hers", "s", "rs", "ushe", "x", "yz", "hi"]
+    matcher = SubstringMatcher(patterns)
+    for value in ["ushers", "ahis", "yyz", "nothing", "", "hhhhe"]:
+        ends = [end for end in range(len(value) + 1) if any(value[:end].endswith(p) for p in patterns)]
+        found = matcher.find(value)
+        assert found is None if not ends else value[:ends[0]].endswith(patterns[found])
+
+    # regexes with backreferences are matched one by one
+    for matcher in [RegexMatcher(["a+b", "c(d)", "e\\d"]), RegexMatcher(["(a)\\1", "c(d)", "e\\d"])]:
+        assert [matcher.find(value) for value in ["aab", "aa", "cd", "e1", "f"]][2:] == [1, 2, None]
+        assert matcher.matches("cd") and not matcher.matches("dc")
+
+
+def test_memoized_transformations(monkeypatch):
+    """ columns that repeat few values are transformed once per distinct value, with the same results and messages """
+    import datamonkey.core
+    output_dir = "tests/test_output/memoize"
+    os.makedirs(output_dir, exist_ok=True)
+    file_path = os.path.join(output_dir, "source.csv")
+    statuses = ["open", "pending", "closed", "lost", "open "]
+    with open(file_path, "w") as file:
+        file.write("id,status,created\n")
+        for i in range(3000):
+            file.write("%d,%s,2020-01-%02d\n" % (i, statuses[i * 7 % 5], i % 28 + 1))
+
+    template = load_json("tests/config_tests/configurations/transform/profile.json")
+    template["outputFile"] = {"type": "CSV", "name": "test_output.csv", "hasHeader": True, "delimiter": ","}
+    template["sourceFields"] = [{"name": name, "fileIndex": 0, "used": True} for name in ["id", "status", "created"]]
+    template["outputFields"] = [
+        {"name": "id", "type": "INT", "sourceFields": [0], "transformations": []},
+        {"name": "status", "type": "STRING", "sourceFields": [1], "transformations": [
+            {"operation": "MODIFY_CHANGE_CASE", "parameters": {"operator": "UPPER"}},
+            {"operation": "FILTER_BY_LIST", "parameters": {"values": ["CLOSED"], "operator": "EXCLUDE"}},
+            {"operation": "VALIDATE_BY_LIST", "parameters": {"values": ["OPEN", "PENDING"], "operator": "INCLUDE",
+                                                             "stopOnInvalid": False}}]},
+        {"name": "created", "type": "DATE", "sourceFields": [2], "transformations": [
+            {"operation": "MODIFY_CHANGE_DATE_FORMAT", "parameters": {"operator": "MM/DD/YYYY"}}]}]
+    configuration = Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "", template=template)
+
+    runs = []
+    min_rows = datamonkey.core.MEMOIZE_MIN_ROWS
+    monkeypatch.setattr(FileProcessor, "CHUNKSIZE", 1500)
+    for memoize_min_rows in [min_rows, 10 ** 9]:
+        monkeypatch.setattr(datamonkey.core, "MEMOIZE_MIN_ROWS", memoize_min_rows)
+        processor = FileProcessor.from_configuration(configuration)
+        profiler = processor.enable_profiling()
+        calls = []
+
+        def wrap(field_id, field, wrap=profiler.wrap):
+            apply = wrap(field_id, field)
+
+            def counted(*args):
+                calls.append(field.name)
+                return apply(*args)
+            return counted
+        profiler.wrap = wrap
+
+        processor.process(file_path, output_file_path=output_dir, error_file_path=output_dir)
+        counts = ["rows", "modified", "filtered", "warnings", "errors"]
+        with open(processor.output_file.file_path) as file:
+            runs.append((file.read(), [processor.error_log.format(i) for i in range(len(processor.error_log))],
+                         dict(((entry["field"], entry["position"]), [entry[count] for count in counts])
+                              for entry in profiler.report()), calls))
+
+    (memoized, memoized_messages, memoized_counts, memoized_calls), (output, messages, counts, calls) = runs
+    assert memoized == output and memoized_messages == messages
+    assert len(messages) == 1200 and "'status', Row 5, transformation #3: 'LOST' is not in the list" in messages[1]
+    # each chunk evaluates the transformations once per distinct value, which the profiles count for all their rows
+    assert calls.count("status") == 3000 and memoized_calls.count("status") == 5 + 5
+    assert calls.count("created") == 2400 and memoized_calls.count("created") == 28 + 28
+    assert memoized_counts == counts and counts[("status", 1)][0] == 3000
+
+
+def test_null_rendering():
+    """ columns keep their types until output, where each writer renders nulls its own way """
+    output_dir = "tests/test_output/nulls"
+    template = load_json("tests/config_tests/configurations/transform/profile.json")
+    template["sourceFields"] = [{"name": name, "fileIndex": 0, "used": True}
+                                for name in ["id", "amount", "created", "name"]]
+    template["outputFields"] = [{"name": name, "type": type, "sourceFields": [i], "allowNull": i > 0,
+                                 "colSpecs": specs, "transformations": []}
+                                for i, (name, type, specs) in enumerate([("id", "INT", [0, 2]),
+                                                                         ("amount", "FLOAT", [3, 8]),
+                                                                         ("created", "DATE", [9, 18]),
+                                                                         ("name", "STRING", [19, 23])])]
+
+    def process(output_type, name, **kwargs):
+        template["outputFile"] = {"type": output_type, "name": name, "hasHeader": False, "delimiter": ","}
+        processor = FileProcessor.from_configuration(Configuration("fc01da57-fake-fake-fake-3e634296ce3f", "",
+                                                                   template=template))
+        data = processor.process("tests/test_files/csv/nulls.csv", output_file_path=output_dir,
+                                 error_file_path=output_dir, **kwargs)
+        if output_type == "PYTHON":
+            return data
+        with open(processor.output_file.file_path) as file:
+            return file.read()
+
+    assert process("CSV", "nulls.csv").splitlines() == ["1,1.5,2020-01-01,ann", "2,,2020-01-02,", "3,2.25,,bob"]
+    assert json.loads(process("JSON", "nulls.json"))[1] == {"id": 2, "amount": None, "created": 1577923200000,
+                                                            "name": None}
+
+    # nulls are blanks of the column's width, the other values keep their formats
+    lines = process("FWF", "nulls.txt").splitlines()
+    assert lines[1] == "2        2020-01-02     " and lines[2].endswith(" " * 10 + "bob  ")
+
+    assert process("PYTHON", None)[1] == {"id": 2, "amount": None, "created": pandas.Timestamp("2020-01-02"),
+                                          "name": None}
+    row = process("PYTHON", None, python_null=numpy.nan)[2]
+    assert numpy.isnan(row["created"]) and row["name"] == "bob"
+    with pytest.raises(ValueError):
+        process("PYTHON", None, python_null="")
+
+
+def test_benchmarks():
+    """ the benchmark scripts run from anywhere, without datamonkey installed or on the path """
+    output_dir = os.path.abspath("tests/test_output/benchmarks")
+    os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ)
+    env.pop("PYTHONPATH", None)
+
+    suite = subprocess.check_output([sys.executable, os.path.abspath("benchmarks/suite.py"), "--sizes", "100",
+                                     "--only", "^operation/MODIFY_CHANGE_CASE$", "--data-dir", output_dir],
+                                    cwd=output_dir, env=env).decode()
+    assert "operation/MODIFY_CHANGE_CASE                  100" in suite
+
+    startup = subprocess.check_output([sys.executable, os.path.abspath("benchmarks/template_startup.py"),
+                                       "--fields", "3", "--repeat", "1"], cwd=output_dir, env=env).decode()
+    assert "compiled artifact" in startup